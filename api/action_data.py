@@ -1,85 +1,184 @@
+import logging
+import time
+from collections import namedtuple
+from typing import Callable, Dict, Iterable, List
+
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404
+from rest_framework.exceptions import ValidationError
+
+from betting.actions import accept_deposit, accept_transfer, accept_withdraw, cancel_deposit, cancel_transfer, \
+    cancel_withdraw, end_match_now, end_question_now, go_live_match, hide_match, hide_question, lock_match, \
+    lock_question, make_game_editor, refund_bet, refund_match, refund_question, remove_game_editor, \
+    select_question_winner, unselect_question_winner
 from betting.choices import A_MATCH_LOCK, A_MATCH_HIDE, A_MATCH_GO_LIVE, A_MATCH_END_NOW, A_QUESTION_LOCK, \
     A_QUESTION_HIDE, A_QUESTION_END_NOW, A_QUESTION_SELECT_WINNER, A_QUESTION_UNSELECT_WINNER, \
     A_QUESTION_REFUND, A_MAKE_GAME_EDITOR, A_REMOVE_GAME_EDITOR, A_REFUND_BET, A_TRANSFER_ACCEPT, A_WITHDRAW_ACCEPT, \
-    A_DEPOSIT_ACCEPT, A_DEPOSIT_CANCEL, A_WITHDRAW_CANCEL, A_TRANSFER_CANCEL
+    A_DEPOSIT_ACCEPT, A_DEPOSIT_CANCEL, A_WITHDRAW_CANCEL, A_TRANSFER_CANCEL, A_MATCH_REFUND
+from users.models import InsufficientBalance
+
+logger = logging.getLogger(__name__)
+
+BATCH_LIMIT = getattr(settings, 'ACTION_BATCH_LIMIT', 500)
+
+# One field of an action's payload, parsed with `type`
+Argument = namedtuple('Argument', 'name type required', defaults=(True,))
+# Outcome of an action, `result` is the dict the action returned if any
+ActionResult = namedtuple('ActionResult', 'code ok result elapsed')
+
+
+def boolean(value) -> bool:
+    return value in (True, 'true', 'True', '1', 1)
+
+
+def game_editor(user) -> bool:
+    return bool(user.is_staff or getattr(user, 'game_editor', False) or user.is_superuser)
+
+
+def superuser(user) -> bool:
+    return bool(user.is_superuser)
+
+
+class Action:
+    """An admin action: the function run, who may run it and the payload it takes."""
 
-action_data = {
+    def __init__(self, code: str, function: Callable, permission: Callable[..., bool],
+                 arguments: Iterable[Argument] = ()):
+        self.code = code
+        self.function = function
+        self.permission = permission
+        self.arguments = tuple(arguments)
+
+    def allowed(self, user) -> bool:
+        return user is not None and user.is_authenticated and self.permission(user)
+
+    def parse(self, data) -> Dict[str, object]:
+        """Keyword arguments of the function from the payload, ValidationError naming bad fields."""
+        kwargs, errors = {}, {}
+        for argument in self.arguments:
+            value = data.get(argument.name)
+            if value in (None, ''):
+                if argument.required:
+                    errors[argument.name] = 'This field is required.'
+                continue
+            try:
+                kwargs[argument.name] = argument.type(value)
+            except (TypeError, ValueError):
+                errors[argument.name] = f'Expected {argument.type.__name__}, got {value!r}.'
+        if errors:
+            raise ValidationError(errors)
+        return kwargs
+
+    def run(self, data) -> ActionResult:
+        kwargs = self.parse(data)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = self.function(**kwargs)
+            outcome = 'ok' if response else 'failed'
+        finally:
+            elapsed = time.perf_counter() - started
+            logger.info('Action %s %s in %.3fs', self.code, outcome, elapsed,
+                        extra={'action': self.code, 'outcome': outcome, 'elapsed': elapsed})
+        return ActionResult(self.code, bool(response), response if isinstance(response, dict) else None, elapsed)
+
+
+def register(*actions: Action) -> Dict[str, Action]:
+    return {action.code: action for action in actions}
+
+
+action_data = register(
     # Match Actions
-    A_MATCH_LOCK: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'lock_match(data.get("match_id"))',
-    },
-    A_MATCH_HIDE: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'hide_match(data.get("match_id"))',
-    },
-    A_MATCH_GO_LIVE: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'go_live_match(data.get("match_id"))',
-    },
-    A_MATCH_END_NOW: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'end_match_now(data.get("match_id"))',
-    },
+    Action(A_MATCH_LOCK, lock_match, game_editor, [Argument('match_id', int)]),
+    Action(A_MATCH_HIDE, hide_match, game_editor, [Argument('match_id', int)]),
+    Action(A_MATCH_GO_LIVE, go_live_match, game_editor, [Argument('match_id', int)]),
+    Action(A_MATCH_END_NOW, end_match_now, game_editor, [Argument('match_id', int)]),
+    Action(A_MATCH_REFUND, refund_match, game_editor, [Argument('match_id', int)]),
     # Question Actions
-    A_QUESTION_LOCK: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'lock_question(data.get("question_id"))',
-    },
-    A_QUESTION_HIDE: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'hide_question(data.get("question_id"))',
-    },
-    A_QUESTION_END_NOW: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'end_question_now(data.get("question_id"))',
-    },
-    A_QUESTION_SELECT_WINNER: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'select_question_winner(data.get("question_id"), data.get("option_id"))',
-    },
-    A_QUESTION_UNSELECT_WINNER: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'unselect_question_winner(data.get("question_id"))',
-    },
-    A_QUESTION_REFUND: {
-        'permission': 'user.is_staff or user.game_editor or user.is_superuser',
-        'function': 'refund_question(data.get("question_id"))',
-    },
-    A_MAKE_GAME_EDITOR: {
-        'permission': 'user.is_superuser',
-        'function': 'make_game_editor(data.get("user_id"))',
-    },
-    A_REMOVE_GAME_EDITOR: {
-        'permission': 'user.is_superuser',
-        'function': 'remove_game_editor(data.get("user_id"))',
-    },
-    A_REFUND_BET: {
-        'permission': 'user.is_superuser',
-        'function': 'refund_bet(data.get("bet_id"), data.get("percent"))',
-    },
-    A_DEPOSIT_ACCEPT: {
-        'permission': 'user.is_superuser',
-        'function': 'accept_deposit(data.get("deposit_id"))',
-    },
-    A_DEPOSIT_CANCEL: {
-        'permission': 'user.is_superuser',
-        'function': 'cancel_deposit(data.get("deposit_id"))',
-    },
-    A_WITHDRAW_ACCEPT: {
-        'permission': 'user.is_superuser',
-        'function': 'accept_withdraw(data.get("withdraw_id"))',
-    },
-    A_WITHDRAW_CANCEL: {
-        'permission': 'user.is_superuser',
-        'function': 'cancel_withdraw(data.get("withdraw_id"))',
-    },
-    A_TRANSFER_ACCEPT: {
-        'permission': 'user.is_superuser',
-        'function': 'accept_transfer(data.get("transfer_id"))',
-    },
-    A_TRANSFER_CANCEL: {
-        'permission': 'user.is_superuser',
-        'function': 'cancel_transfer(data.get("transfer_id"))',
-    },
-}
+    Action(A_QUESTION_LOCK, lock_question, game_editor, [Argument('question_id', int)]),
+    Action(A_QUESTION_HIDE, hide_question, game_editor, [Argument('question_id', int)]),
+    Action(A_QUESTION_END_NOW, end_question_now, game_editor, [Argument('question_id', int)]),
+    Action(A_QUESTION_SELECT_WINNER, select_question_winner, game_editor,
+           [Argument('question_id', int), Argument('option_id', int)]),
+    Action(A_QUESTION_UNSELECT_WINNER, unselect_question_winner, game_editor,
+           [Argument('question_id', int), Argument('dry_run', boolean, False)]),
+    Action(A_QUESTION_REFUND, refund_question, game_editor, [Argument('question_id', int)]),
+    # User Actions
+    Action(A_MAKE_GAME_EDITOR, make_game_editor, superuser, [Argument('user_id', int)]),
+    Action(A_REMOVE_GAME_EDITOR, remove_game_editor, superuser, [Argument('user_id', int)]),
+    Action(A_REFUND_BET, refund_bet, superuser, [Argument('bet_id', int), Argument('percent', float, False)]),
+    # Transaction Actions
+    Action(A_DEPOSIT_ACCEPT, accept_deposit, superuser, [Argument('deposit_id', int)]),
+    Action(A_DEPOSIT_CANCEL, cancel_deposit, superuser, [Argument('deposit_id', int)]),
+    Action(A_WITHDRAW_ACCEPT, accept_withdraw, superuser, [Argument('withdraw_id', int)]),
+    Action(A_WITHDRAW_CANCEL, cancel_withdraw, superuser, [Argument('withdraw_id', int)]),
+    Action(A_TRANSFER_ACCEPT, accept_transfer, superuser, [Argument('transfer_id', int)]),
+    Action(A_TRANSFER_CANCEL, cancel_transfer, superuser, [Argument('transfer_id', int)]),
+)
+
+
+def item_result(code, status: int, details: str, **extra) -> dict:
+    return {'action_code': code, 'status': status, 'details': details, **extra}
+
+
+def run_item(action: Action, item) -> dict:
+    """Run one batch item in a savepoint, rolled back unless the action succeeds."""
+    with transaction.atomic():
+        try:
+            result = action.run(item)
+        except Http404:
+            transaction.set_rollback(True)
+            return item_result(action.code, 404, 'Not found')
+        except InsufficientBalance as error:
+            transaction.set_rollback(True)
+            return item_result(action.code, 400, str(error) or 'Insufficient balance')
+        except Exception:
+            logger.exception('Action %s failed in a batch', action.code)
+            transaction.set_rollback(True)
+            return item_result(action.code, 500, 'Failed with an error')
+        if not result.ok:
+            transaction.set_rollback(True)
+            return item_result(action.code, 400, 'Failed to complete the action due to data')
+        extra = {'result': result.result} if result.result is not None else {}
+        return item_result(action.code, 200, 'Successfully completed action', **extra)
+
+
+def run_batch(user, items: List[dict], atomic=False) -> List[dict]:
+    """
+    Run many actions in one transaction, grouped by action code so the same
+    function runs back to back, and return one result per item in the order
+    given. Every item is checked for permission and arguments first. Each
+    item runs in its own savepoint, so a failed item is rolled back alone,
+    unless `atomic`: then nothing runs if any item is rejected and a failed
+    item rolls back the whole batch, the others reported with status 424.
+    """
+    results: List[dict] = [None] * len(items)
+    groups: Dict[str, List[int]] = {}
+    for index, item in enumerate(items):
+        code = item.get('action_code') if isinstance(item, dict) else None
+        action = action_data.get(code)
+        if action is None:
+            results[index] = item_result(code, 400, 'Invalid action')
+        elif not action.allowed(user):
+            results[index] = item_result(code, 403, 'User does not have enough permission')
+        else:
+            try:
+                action.parse(item)
+            except ValidationError as error:
+                results[index] = item_result(code, 400, 'Invalid arguments', errors=error.detail)
+            else:
+                groups.setdefault(code, []).append(index)
+    if atomic and any(result is not None for result in results):
+        return [result or item_result(items[index]['action_code'], 424, 'Not run, another item was rejected')
+                for index, result in enumerate(results)]
+    with transaction.atomic():
+        for code, indexes in groups.items():
+            for index in indexes:
+                results[index] = run_item(action_data[code], items[index])
+                if atomic and results[index]['status'] != 200:
+                    transaction.set_rollback(True)
+                    return [result if result is not None and result['status'] != 200 else
+                            item_result(items[i]['action_code'], 424, 'Rolled back, another item failed')
+                            for i, result in enumerate(results)]
+    return results
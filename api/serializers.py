@@ -1,15 +1,18 @@
 from django.core.validators import MaxValueValidator
+from django.db import transaction
 from django.db.models import Sum
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from api.validators import MinMaxLimitValidator, CountLimitValidator, UniqueMultiQuerysetValidator, \
     BetQuestionValidator, QuestionOptionValidator, TransferUserValidator
+from betting.accruals import pending_commission
+from betting.config import config_float
 from betting.models import Announcement, Bet, BetQuestion, Deposit, Match, Withdraw, Transfer, \
     QuestionOption, DepositMethod, ConfigModel
 from betting.views import get_last_bet, get_config_from_model
 from users.backends import jwt_writer, get_current_club
-from users.models import User, Club, Notification
+from users.models import User, Club, Notification, InsufficientBalance
 
 
 def jwt_from_user(user: User):
@@ -32,6 +35,23 @@ def jwt_from_user(user: User):
     return jwt_writer(**data)
 
 
+class BalanceFloorMixin:
+    """
+    Saves the instance with min_balance as floor of the debit done on creation,
+    so concurrent requests can not overdraw an account that passed validation.
+    """
+
+    def create(self, validated_data):
+        instance = self.Meta.model(**validated_data)
+        instance.balance_floor = config_float('min_balance')
+        try:
+            with transaction.atomic():
+                instance.save()
+        except InsufficientBalance:
+            raise ValidationError('Not enough balance')
+        return instance
+
+
 class AnnouncementSerializer(serializers.ModelSerializer):
     class Meta:
         model = Announcement
@@ -51,9 +71,10 @@ class QuestionOptionSerializer(serializers.ModelSerializer):
 
     def get_details(self, option: QuestionOption) -> dict:
         details = {
-            'bet_count': option.bet_set.all().count(),
-            'bet': option.bet_set.all().aggregate(Sum('amount'))[f'amount__sum'] or 0,
-            'to_return': option.bet_set.all().aggregate(Sum('win_amount'))[f'win_amount__sum'] or 0,
+            'bet_count': option.total_bet_count,
+            'bet': option.total_staked,
+            'to_return': option.total_to_return,
+            'liability': option.liability,
         }
         return details
 
@@ -94,6 +115,12 @@ class BetQuestionSerializer(serializers.ModelSerializer):
                   'options', 'question', 'status', 'winner',)
 
 
+class UserListSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ('id', 'first_name', 'last_name', 'username', 'user_club',)
+
+
 # noinspection PyMethodMayBeStatic
 class BetSerializer(serializers.ModelSerializer):
     answer = serializers.SerializerMethodField(read_only=True)
@@ -101,15 +128,12 @@ class BetSerializer(serializers.ModelSerializer):
     match_name = serializers.SerializerMethodField(read_only=True)
     question = serializers.SerializerMethodField(read_only=True)
     your_answer = serializers.SerializerMethodField(read_only=True)
-    user_details = serializers.SerializerMethodField(read_only=True)
+    user_details = UserListSerializer(source='user', read_only=True)
     useless = serializers.SerializerMethodField(read_only=True)
 
     def get_answer(self, bet: Bet) -> str:
         return bet.bet_question.winner and bet.bet_question.winner.option
 
-    def get_user_details(self, bet: Bet) -> dict:
-        return UserListSerializer(bet.user).data
-
     def get_match_name(self, bet: Bet) -> str:
         return bet.bet_question.match.__str__()
 
@@ -130,20 +154,20 @@ class BetSerializer(serializers.ModelSerializer):
         fields = ('answer', 'amount', 'bet_question', 'choice', 'id', 'match_start_time', 'match_name', 'question',
                   'win_rate', 'is_winner', 'user', 'your_answer', 'win_amount', 'status',
                   'created_at', 'user_details', 'user_balance', 'useless',)
-        read_only_fields = ('id', 'user', 'win_rate', 'is_winner')
+        read_only_fields = ('id', 'user', 'win_rate', 'is_winner', 'win_amount', 'status', 'user_balance')
         extra_kwargs = {
             'amount': {'validators': [MinMaxLimitValidator('bet')]},
             'bet_question': {'validators': [BetQuestionValidator()]},
-            'choice': {'validators': [QuestionOptionValidator(Bet)]},
+            'choice': {'validators': [QuestionOptionValidator()]},
         }
 
     def validate(self, attrs):
         attrs['user'] = self.context['request'].user
         amount = attrs.get('amount')
         user: User = attrs.get('user')
-        MaxValueValidator(user.balance - float(get_config_from_model('min_balance')), 'Not enough balance').__call__(
+        MaxValueValidator(user.balance - config_float('min_balance'), 'Not enough balance').__call__(
             amount)
-        CountLimitValidator('withdraw', Withdraw).__call__(attrs.get('user'))
+        CountLimitValidator('bet', Bet).__call__(attrs.get('user'))
         return attrs
 
 
@@ -151,17 +175,27 @@ class BetSerializer(serializers.ModelSerializer):
 class ClubSerializer(serializers.ModelSerializer):
     total_user = serializers.SerializerMethodField(read_only=True)
     total_user_balance = serializers.SerializerMethodField(read_only=True)
+    pending_commission = serializers.SerializerMethodField(read_only=True)
 
     def get_total_user(self, club: Club) -> int:
-        return club.user_set.all().count()
+        if hasattr(club, 'member_count'):
+            return club.member_count
+        return club.total_user
 
     def get_total_user_balance(self, club: Club):
-        return club.user_set.all().aggregate(Sum('balance'))['balance__sum'] or 0
+        if hasattr(club, 'member_balance'):
+            return club.member_balance
+        return club.total_user_balance
+
+    def get_pending_commission(self, club: Club) -> float:
+        if hasattr(club, 'unpaid_commission'):
+            return club.unpaid_commission
+        return pending_commission(club.id)
 
     class Meta:
         model = Club
         fields = ('admin', 'balance', 'club_commission', 'id', 'name', 'password', 'username',
-                  'total_user', 'total_user_balance')
+                  'total_user', 'total_user_balance', 'pending_commission')
         read_only_fields = ('admin', 'id',)
         extra_kwargs = {
             'password': {'write_only': True},
@@ -233,7 +267,7 @@ class NotificationSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class TransferSerializer(serializers.ModelSerializer):
+class TransferSerializer(BalanceFloorMixin, serializers.ModelSerializer):
     account_type = serializers.SerializerMethodField(read_only=True)
 
     def get_account_type(self, *args, **kwargs):
@@ -258,13 +292,13 @@ class TransferSerializer(serializers.ModelSerializer):
         if get_config_from_model('disable_user_transfer') != '0':
             raise ValidationError('Money transfer is temporary disabled.')
         TransferUserValidator(user).__call__(attrs.get('recipient'))
-        MaxValueValidator(user.balance - float(get_config_from_model('min_balance')), 'Not enough balance').__call__(
+        MaxValueValidator(user.balance - config_float('min_balance'), 'Not enough balance').__call__(
             amount)
         CountLimitValidator('transfer', Transfer, field_check='sender').__call__(attrs.get('sender'))
         return attrs
 
 
-class TransferClubSerializer(serializers.ModelSerializer):
+class TransferClubSerializer(BalanceFloorMixin, serializers.ModelSerializer):
     account_type = serializers.CharField(max_length=255, read_only=True, default='club')
 
     class Meta:
@@ -283,18 +317,12 @@ class TransferClubSerializer(serializers.ModelSerializer):
         attrs['recipient'] = club.admin
         if get_config_from_model('disable_club_transfer') != '0':
             raise ValidationError('Money transfer is temporary disabled.')
-        MaxValueValidator(club.balance - float(get_config_from_model('min_balance')), 'Not enough balance').__call__(
+        MaxValueValidator(club.balance - config_float('min_balance'), 'Not enough balance').__call__(
             amount)
         CountLimitValidator('transfer', Transfer, field_check='club').__call__(attrs.get('club'))
         return attrs
 
 
-class UserListSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = User
-        fields = ('id', 'first_name', 'last_name', 'username', 'user_club',)
-
-
 # noinspection PyMethodMayBeStatic
 class UserListSerializerClub(serializers.ModelSerializer):
     join_date = serializers.SerializerMethodField(read_only=True)
@@ -307,7 +335,10 @@ class UserListSerializerClub(serializers.ModelSerializer):
         return user.userclubinfo.date_joined
 
     def get_last_bet(self, user):
-        return get_last_bet(user) and get_last_bet(user).created_at
+        if hasattr(user, 'last_bet_at'):
+            return user.last_bet_at
+        last_bet = get_last_bet(user)
+        return last_bet and last_bet.created_at
 
     def get_full_name(self, user):
         return user.get_full_name()
@@ -382,7 +413,7 @@ class UserDetailsSerializer(serializers.ModelSerializer):
         }
 
 
-class WithdrawSerializer(serializers.ModelSerializer):
+class WithdrawSerializer(BalanceFloorMixin, serializers.ModelSerializer):
     class Meta:
         model = Withdraw
         fields = '__all__'
@@ -397,7 +428,7 @@ class WithdrawSerializer(serializers.ModelSerializer):
         user, amount = attrs.get('user'), attrs.get('amount')
         if get_config_from_model('disable_withdraw') != '0':
             raise ValidationError('Money withdraw is temporary disabled.')
-        MaxValueValidator(user.balance - float(get_config_from_model('min_balance')), 'Not enough balance').__call__(
+        MaxValueValidator(user.balance - config_float('min_balance'), 'Not enough balance').__call__(
             amount)
         CountLimitValidator('withdraw', Withdraw).__call__(attrs.get('user'))
         return attrs
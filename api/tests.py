@@ -1,8 +1,12 @@
 import json
 from datetime import timedelta
 
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from api.serializers import UserDetailsSerializer
 from betting.choices import A_MATCH_LOCK, A_MATCH_HIDE, A_MATCH_GO_LIVE, A_MATCH_END_NOW, A_QUESTION_LOCK, \
@@ -10,7 +14,11 @@ from betting.choices import A_MATCH_LOCK, A_MATCH_HIDE, A_MATCH_GO_LIVE, A_MATCH
     A_QUESTION_REFUND, \
     STATUS_LOCKED, STATUS_HIDDEN, STATUS_LIVE, STATUS_CLOSED, A_REMOVE_GAME_EDITOR, A_MAKE_GAME_EDITOR, STATUS_REFUNDED, \
     METHOD_BKASH, METHOD_ROCKET, STATUS_PENDING, A_REFUND_BET, STATUS_ACCEPTED, A_DEPOSIT_ACCEPT, A_DEPOSIT_CANCEL, \
-    STATUS_CANCELLED, A_WITHDRAW_ACCEPT, A_WITHDRAW_CANCEL, A_TRANSFER_ACCEPT, A_TRANSFER_CANCEL
+    STATUS_CANCELLED, A_WITHDRAW_ACCEPT, A_WITHDRAW_CANCEL, A_TRANSFER_ACCEPT, A_TRANSFER_CANCEL, \
+    STATUS_PAID
+from betting.accruals import flush_commissions
+from betting.actions import select_question_winner, refund_question
+from betting.config import config_int
 from betting.models import Match, BetQuestion, QuestionOption, Deposit, Withdraw, Transfer, DepositMethod, Announcement, \
     Bet
 from betting.views import set_config_to_model
@@ -25,6 +33,7 @@ def increase_balance(user: User, amount):
 
 
 def set_up_helper() -> (Club, Club, User, User, str, str, str, dict, dict, int, int, int):
+    cache.clear()
     club1 = Club.objects.create(name='Test Club1', balance=5000, username='test_club1', password='test_pass1')
     club2 = Club.objects.create(name='Test Club2', balance=5000, username='test_club2', password='test_pass2')
     user1 = User.objects.create_superuser(username='test1', email='teng@gmail.com',
@@ -200,6 +209,33 @@ class ActionTestCase(TestCase):
         self.assertEqual(4900, self.user2.balance, 'Should be able to refund')
 
 
+    def test_action_arguments_are_typed(self):
+        response = c.post(self.api, {'action_code': A_QUESTION_SELECT_WINNER, 'question_id': 'first'},
+                          **self.headers_super)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('question_id', response.json())
+        self.assertIn('option_id', response.json())
+        response = c.post(self.api, {'action_code': 'no_such_action'}, **self.headers_super)
+        self.assertEqual(response.status_code, 400)
+
+    def test_action_anonymous(self):
+        response = c.post(self.api, {'action_code': A_MATCH_LOCK, 'match_id': self.match_id},
+                          content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_action_timing(self):
+        with self.assertLogs('api.action_data', 'INFO') as logs:
+            response = c.post(self.api, {'action_code': A_MATCH_LOCK, 'match_id': self.match_id},
+                              **self.headers_super)
+        self.assertTrue(response['Server-Timing'].startswith(f'action;desc="{A_MATCH_LOCK}";dur='))
+        self.assertEqual(logs.records[0].action, A_MATCH_LOCK)
+        self.assertEqual(logs.records[0].outcome, 'ok')
+        with self.assertLogs('api.action_data', 'INFO') as logs:
+            response = c.post(self.api, {'action_code': A_MATCH_LOCK, 'match_id': 0}, **self.headers_super)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(logs.records[0].outcome, 'failed')
+
+
 class TransactionTest(TestCase):
     def setUp(self) -> None:
         data = set_up_helper()
@@ -337,10 +373,55 @@ class AllTransactionTestCase(TestCase):
         response = c.get(f'{self.api}?limit=10&offset=5', **self.headers_user)
         self.assertEqual(response.status_code, 200)
 
+    def test_cursor_pagination(self):
+        for _ in range(3):
+            Transfer.objects.create(amount=500, sender=self.user2, recipient=self.user1)
+            Deposit.objects.create(amount=500, user=self.user2)
+            Withdraw.objects.create(amount=500, user=self.user2)
+        expected = [(row['type'], row['id']) for row in c.get(self.api, **self.headers_user).json()['results']]
+        self.assertEqual(len(expected), 9)
+        seen, cursor = [], ''
+        while True:
+            response = c.get(f'{self.api}?limit=4&cursor={cursor}', **self.headers_user).json()
+            seen += [(row['type'], row['id']) for row in response['results']]
+            cursor = response['next']
+            if not cursor:
+                break
+        self.assertEqual(seen, expected, 'Pages should follow each other without gaps')
+        transfer = next(row for row in c.get(self.api, **self.headers_user).json()['results']
+                        if row['type'] == 'transfer')
+        self.assertEqual(transfer['recipient'], self.user1.username)
+
+    def test_invalid_cursor(self):
+        response = c.get(f'{self.api}?cursor=abc', **self.headers_user)
+        self.assertEqual(response.status_code, 400)
+        response = c.get(f'{self.api}?cursor=NQ==', **self.headers_user)
+        self.assertEqual(response.status_code, 400, 'Cursor of a number')
+
+    def test_invalid_limit_offset(self):
+        for query, field in (('limit=ten', 'limit'), ('limit=-1', 'limit'), ('limit=10&offset=five', 'offset'),
+                             ('limit=10&offset=-5', 'offset')):
+            response = c.get(f'{self.api}?{query}', **self.headers_user)
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn(field, response.json())
+
+    def test_query_count_does_not_grow(self):
+        Transfer.objects.create(amount=500, sender=self.user2, recipient=self.user1)
+        c.get(self.api, **self.headers_user)  # Authentication is cached after the first request
+        with CaptureQueriesContext(connection) as few:
+            c.get(self.api, **self.headers_user)
+        for _ in range(10):
+            Transfer.objects.create(amount=500, sender=self.user2, recipient=self.user1)
+            Deposit.objects.create(amount=500, user=self.user2)
+        with CaptureQueriesContext(connection) as many:
+            c.get(self.api, **self.headers_user)
+        self.assertEqual(len(many), len(few))
+
     def test_get_all_club(self):
         increase_balance(self.user2, 5000)
         c.post('/api/bet/', data={'amount': 100, 'bet_question': self.question_id, 'choice': self.option_id},
                **self.headers_user)
+        flush_commissions()
         Deposit.objects.create(club=self.club1, amount=500)
         response = c.get(f'{self.api}?club=true', **self.club_header)
         self.assertEqual(response.status_code, 200, 'Should be able to get list')
@@ -452,6 +533,51 @@ class BetTestCase(TestCase):
         self.assertEqual(self.user2.balance, 4900,
                          msg=f'User balance is not correct, {UserDetailsSerializer(self.user2).data}')
 
+    def test_create_bet_ignores_read_only_fields(self):
+        increase_balance(self.user2, 5000)
+        response = c.post('/api/bet/', data={'amount': 100, 'bet_question': self.question_id, 'choice': self.option_id,
+                                             'status': STATUS_PAID, 'win_amount': 100000, 'user_balance': 100000},
+                          **self.headers_user)
+        self.assertEqual(response.status_code, 201, msg=f'Should be able to bet\n {response.content}')
+        bet = Bet.objects.get(pk=response.json()['id'])
+        self.assertNotEqual(bet.status, STATUS_PAID)
+        self.assertLess(bet.win_amount, 100000)
+        self.assertEqual(bet.user_balance, 4900)
+
+    def test_list_query_count_is_constant(self):
+        club_jwt = c.post('/api/login/', data={'username': 'test_club1', 'password': 'test_pass1'}).json()['jwt']
+        club_header = {'HTTP_club-token': club_jwt, **self.headers_super}
+        for i in range(12):
+            match = Match.objects.create(team_a_name=f'A{i}', team_b_name='B', game_name='football')
+            question = BetQuestion.objects.create(match=match, question='Winner?')
+            option = QuestionOption.objects.create(option=f'Option {i}', rate=1.5)
+            question.options.add(option)
+            Bet.objects.create(user=self.user2, bet_question=question, choice=option, amount=100)
+            question.winner = option
+            question.save()
+        for url, headers in (('/api/bet/', self.headers_user), ('/api/bet/?club=true', club_header)):
+            c.get(url, **headers)  # Authentication is cached after the first request
+            with CaptureQueriesContext(connection) as small:
+                response = c.get(f'{url}{"&" if "?" in url else "?"}limit=2', **headers)
+            self.assertEqual(len(response.json()['results']), 2)
+            with CaptureQueriesContext(connection) as large:
+                response = c.get(f'{url}{"&" if "?" in url else "?"}limit=12', **headers)
+            self.assertEqual(len(response.json()['results']), 12)
+            self.assertEqual(response.json()['results'][0]['user_details']['username'], self.user2.username)
+            self.assertEqual(len(large), len(small), f'{url} should not run queries per row')
+
+    def test_create_bet_option_limit(self):
+        increase_balance(self.user2, 5000)
+        QuestionOption.objects.filter(pk=self.option_id).update(limit=100)
+        data = {'amount': 100, 'bet_question': self.question_id, 'choice': self.option_id}
+        response = c.post('/api/bet/', data=data, **self.headers_user)
+        self.assertEqual(response.status_code, 201, msg=f'Should be able to bet\n {response.content}')
+        response = c.post('/api/bet/', data=data, **self.headers_user)
+        self.assertEqual(response.status_code, 400, msg='Option is full')
+        self.assertIn('Bet limit for this option exceeded', response.content.decode())
+        option = QuestionOption.objects.get(pk=self.option_id)
+        self.assertEqual((option.bet_count, option.staked), (1, 100))
+
     def test_create_bet_before_start(self):
         increase_balance(self.user2, 5000)
         Match.objects.update(id=self.question_id, start_time=timezone.now() + timedelta(minutes=10))
@@ -539,6 +665,26 @@ class ClubTest(TestCase):
                           **self.headers_user)
         self.assertEqual(response.status_code, 403, 'Should not be able to create club')
 
+    def test_get_club_totals(self):
+        increase_balance(self.user2, 300)
+        response = c.get(self.api, **self.headers_super)
+        club = next(club for club in response.json()['results'] if club['id'] == self.club1.id)
+        self.assertEqual((club['total_user'], club['total_user_balance']), (2, 300))
+        detail = UserDetailsSerializer(User.objects.get(pk=self.user2.pk)).data['club_detail']
+        self.assertEqual((detail['total_user'], detail['total_user_balance']), (2, 300))
+
+    def test_get_club_query_count_is_constant(self):
+        c.get(self.api, **self.headers_super)
+        with CaptureQueriesContext(connection) as few:
+            c.get(self.api, **self.headers_super)
+        for i in range(5):
+            club = Club.objects.create(name=f'Club {i}', username=f'club_{i}', password='123456')
+            User.objects.create_user(username=f'member_{i}', email=f'member_{i}@gmail.com', phone=f'0199{i}',
+                                     user_club=club, password='1234')
+        with CaptureQueriesContext(connection) as many:
+            c.get(self.api, **self.headers_super)
+        self.assertEqual(len(many), len(few))
+
     # Update club details
     def test_update_club(self):
         response = c.patch(f'{self.api}{self.club1.id}/', {'name': 'Hi Club2', 'club_commission': 5.0,
@@ -605,6 +751,17 @@ class ConfigTestCase(TestCase):
         response = c.delete(f'{self.api}max_bet/', **self.headers_super)
         self.assertEqual(response.status_code, 405)
 
+    def test_config_snapshot_cached(self):
+        config_int('max_bet')
+        with self.assertNumQueries(0):
+            self.assertEqual(config_int('max_bet'), 25000)
+            self.assertEqual(config_int('min_bet'), 10)
+
+    def test_config_snapshot_invalidated(self):
+        self.assertEqual(config_int('max_bet'), 25000)
+        c.patch(f'{self.api}max_bet/', {'value': 10000}, **self.headers_super)
+        self.assertEqual(config_int('max_bet'), 10000, 'Snapshot should reload after update')
+
 
 class DashboardTest(TestCase):
     def setUp(self) -> None:
@@ -827,6 +984,39 @@ class MatchTest(TestCase):
         response = c.get(f"{self.api}?fast=true")
         self.assertEqual(response.status_code, 200)
 
+    def test_get_match_option_details(self):
+        increase_balance(self.user2, 5000)
+        option_id = BetQuestion.objects.get(pk=self.question_id).options.get().id
+        for amount in (100, 200):
+            c.post('/api/bet/', data={'amount': amount, 'bet_question': self.question_id, 'choice': option_id},
+                   **self.headers_user)
+        match = next(match for match in c.get(self.api).json()['results'] if match['id'] == self.match_id)
+        details = match['questions'][0]['options'][0]['details']
+        to_return = sum(Bet.objects.values_list('win_amount', flat=True))
+        self.assertEqual((details['bet_count'], details['bet']), (2, 300))
+        self.assertEqual((details['to_return'], details['liability']), (to_return, to_return))
+        select_question_winner(self.question_id, option_id)
+        refund_question(self.question_id)
+        match = next(match for match in c.get(self.api).json()['results'] if match['id'] == self.match_id)
+        details = match['questions'][0]['options'][0]['details']
+        self.assertEqual((details['bet_count'], details['bet'], details['to_return']), (2, 300, to_return),
+                         'Settled and refunded bets stay in the totals')
+        self.assertEqual(details['liability'], 0)
+
+    def test_get_match_query_count_is_constant(self):
+        with CaptureQueriesContext(connection) as few:
+            c.get(self.api)
+        for i in range(3):
+            match = Match.objects.create(team_a_name=f'A{i}', team_b_name='B', game_name='football')
+            for j in range(3):
+                question = BetQuestion.objects.create(match=match, question=f'Question {j}')
+                question.options.add(QuestionOption.objects.create(option='Yes', rate=1.5),
+                                     QuestionOption.objects.create(option='No', rate=2))
+        with CaptureQueriesContext(connection) as many:
+            response = c.get(self.api)
+        self.assertEqual(response.json()['count'], 4)
+        self.assertEqual(len(many), len(few))
+
     def test_create_match_superuser(self):
         headers = {'HTTP_x-auth-token': self.jwt1, 'content_type': 'application/json', }
         response = c.post('/api/match/', self.match_data, **headers)
@@ -875,6 +1065,30 @@ class QuestionOptionTest(TestCase):
         self.assertEqual(response.status_code, 403, msg=f'Should be able to update option\n{response.content}')
 
 
+class ReferralSummaryTestCase(TestCase):
+    def setUp(self):
+        data = set_up_helper()
+        (self.club1, self.club2, self.user1, self.user2, self.jwt1, self.jwt2, self.headers_super, self.headers_user,
+         self.match_id, self.question_id, self.option_id) = (data[i] for i in range(11))
+        self.api = '/api/referral-summary/'
+
+    def test_referral_summary(self):
+        self.user2.referred_by = self.user1
+        self.user2.save()
+        increase_balance(self.user2, 5000)
+        c.post('/api/bet/', data={'amount': 100, 'bet_question': self.question_id, 'choice': self.option_id},
+               **self.headers_user)
+        response = c.get(self.api, **self.headers_super)
+        self.assertEqual(response.status_code, 200, f'Should be able to get summary\n{response.content}')
+        self.assertEqual(response.json()['bet_count'], 1)
+        self.assertEqual(response.json()['users'][0]['username'], self.user2.username)
+        self.assertEqual(response.json()['pending'], response.json()['amount'], 'Not paid before flush')
+
+    def test_referral_summary_unauthenticated(self):
+        response = c.get(self.api)
+        self.assertIn(response.status_code, (401, 403), 'Should not get summary without login')
+
+
 class UserTestCase(TestCase):
     def setUp(self):
         data = set_up_helper()
@@ -886,6 +1100,23 @@ class UserTestCase(TestCase):
         response = c.get(self.api)
         self.assertEqual(response.status_code, 200)
 
+    def test_get_club_users_query_count_is_constant(self):
+        option = QuestionOption.objects.create(option='Yes', rate=1.5)
+        for i in range(10):
+            user = User.objects.create_user(username=f'member{i}', email=f'member{i}@gmail.com', phone=f'0180{i}',
+                                            user_club=self.club, password='1234')
+            Bet.objects.create(user=user, bet_question_id=self.question_id, choice=option, amount=100)
+        api = f'{self.api}?club=true&user_club={self.club.id}'
+        c.get(api, **self.headers_user)  # Authentication is cached after the first request
+        with CaptureQueriesContext(connection) as small:
+            c.get(f'{api}&limit=2', **self.headers_user)
+        with CaptureQueriesContext(connection) as large:
+            response = c.get(f'{api}&limit=12', **self.headers_user)
+        self.assertEqual(len(large), len(small))
+        member = next(row for row in response.json()['results'] if row['username'] == 'member0')
+        self.assertEqual(parse_datetime(member['last_bet']), Bet.objects.get(user__username='member0').created_at)
+        self.assertEqual(member['total_bet'], 0)
+
     def test_get_users_logged(self):
         response = c.get(self.api, {}, **self.headers_super)
         self.assertEqual(response.status_code, 200)
@@ -1119,3 +1350,74 @@ class WithdrawTestCase(TestCase):
         response = c.patch(f'{self.api}{self.withdraw_id}/',
                            data={'amount': 800, 'site_account': '014454548', 'method': 'rocket'}, **self.headers_super)
         self.assertEqual(response.status_code, 405, msg=f'Not updatable')
+
+
+class ActionBatchTest(TestCase):
+    def setUp(self) -> None:
+        data = set_up_helper()
+        (self.club1, self.club2, self.user1, self.user2, self.jwt1, self.jwt2, self.headers_super, self.headers_user,
+         self.match_id, self.question_id, self.option_id) = (data[i] for i in range(11))
+        self.api = '/api/actions/batch/'
+        self.deposits = [Deposit.objects.create(user=self.user2, amount=100 * (i + 1), method=METHOD_BKASH)
+                         for i in range(5)]
+        self.user2.refresh_from_db()
+        self.balance = self.user2.balance
+
+    def accept(self, deposit):
+        return {'action_code': A_DEPOSIT_ACCEPT, 'deposit_id': deposit.id}
+
+    def test_accept_many(self):
+        actions = [self.accept(deposit) for deposit in self.deposits]
+        actions.insert(2, {'action_code': A_MATCH_LOCK, 'match_id': self.match_id})
+        actions.append({'action_code': A_DEPOSIT_CANCEL, 'deposit_id': 0})
+        actions.append({'action_code': A_DEPOSIT_ACCEPT, 'deposit_id': 'abc'})
+        response = c.post(self.api, {'actions': actions}, **self.headers_super)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['succeeded'], data['failed']), (6, 2))
+        self.assertEqual([result['status'] for result in data['results']], [200] * 6 + [404, 400])
+        self.assertEqual(data['results'][2]['action_code'], A_MATCH_LOCK)
+        self.assertIn('deposit_id', data['results'][7]['errors'])
+        self.assertIn('Server-Timing', response)
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.balance, self.balance + 1500)
+        self.assertEqual(Deposit.objects.filter(status=STATUS_ACCEPTED).count(), 5)
+        self.assertEqual(Match.objects.get(pk=self.match_id).status, STATUS_LOCKED)
+
+    def test_failed_item_rolled_back_alone(self):
+        transfer = Transfer.objects.create(sender=self.user1, recipient=self.user2, amount=50)
+        actions = [{'action_code': A_TRANSFER_ACCEPT, 'transfer_id': transfer.id}] * 2 + [self.accept(self.deposits[0])]
+        data = c.post(self.api, {'actions': actions}, **self.headers_super).json()
+        self.assertEqual([result['status'] for result in data['results']], [200, 400, 200])
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.balance, self.balance + 150)
+
+    def test_atomic(self):
+        transfer = Transfer.objects.create(sender=self.user1, recipient=self.user2, amount=50)
+        actions = [self.accept(deposit) for deposit in self.deposits]
+        actions += [{'action_code': A_TRANSFER_ACCEPT, 'transfer_id': transfer.id}] * 2
+        response = c.post(self.api, {'actions': actions, 'atomic': True}, **self.headers_super)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['status'] for result in response.json()['results']], [424] * 6 + [400])
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.balance, self.balance)
+        self.assertFalse(Deposit.objects.filter(status=STATUS_ACCEPTED).exists())
+        response = c.post(self.api, {'actions': actions[:5] + [{'action_code': 'unknown'}], 'atomic': True},
+                          **self.headers_super)
+        self.assertEqual([result['status'] for result in response.json()['results']], [424] * 5 + [400])
+        self.assertFalse(Deposit.objects.filter(status=STATUS_ACCEPTED).exists())
+
+    def test_batch_permission(self):
+        actions = [self.accept(deposit) for deposit in self.deposits]
+        response = c.post(self.api, {'actions': actions}, **self.headers_user)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual({result['status'] for result in response.json()['results']}, {403})
+        response = c.post(self.api, {'actions': actions}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Deposit.objects.filter(status=STATUS_ACCEPTED).exists())
+
+    def test_batch_limits(self):
+        response = c.post(self.api, {'actions': []}, **self.headers_super)
+        self.assertEqual(response.status_code, 400)
+        response = c.post(self.api, {'actions': [self.accept(self.deposits[0])] * 501}, **self.headers_super)
+        self.assertEqual(response.status_code, 400)
@@ -46,7 +46,9 @@ urlpatterns = [
 
     path('', include(router.urls), name='main_api'),
     path('actions/', views.ActionView.as_view()),
+    path('actions/batch/', views.ActionBatchView.as_view()),
     path('all-transactions/', views.AllTransactionView.as_view()),
     path('dashboard/', views.DashboardView.as_view()),
     path('login/', csrf_exempt(views.Login.as_view()), name='api_login'),
+    path('referral-summary/', views.ReferralSummaryView.as_view()),
 ]
@@ -1,12 +1,12 @@
 from typing import Type, Union
 
 from django.db import DataError
-from django.db.models import Model, Sum, ObjectDoesNotExist
-from django.utils import timezone
+from django.db.models import Model, ObjectDoesNotExist
 from rest_framework.exceptions import ValidationError
 from rest_framework.validators import UniqueValidator
 
-from betting.views import get_config_from_model
+from betting.config import config_int
+from betting.counters import WINDOW_DAY, WINDOW_LABELS, RateCounter
 from users.models import User
 
 
@@ -18,8 +18,8 @@ def qs_exists(queryset):
 
 
 def count_limit_validator(user: User, model, des, md=0):
-    limit_count = int(get_config_from_model(f'limit_{des}'))
-    total_today = model.objects.filter(user=user, created_at__day=timezone.now().day).count()
+    limit_count = config_int(f'limit_{des}')
+    total_today = RateCounter(model).count(user)
     if total_today >= limit_count + md:
         raise ValidationError(f"Maximum limit of {limit_count} per day exceed. {total_today}")
 
@@ -99,17 +99,21 @@ class TransferUserValidator:
 
 
 class QuestionOptionValidator:
-    def __init__(self, model):
-        self.model = model
+    """Early check of the option's staked counter, place_bet enforces the limit atomically."""
 
     def __call__(self, value, *args, **kwargs):
-        total_bet = self.model.objects.filter(choice=value).aggregate(Sum('amount'))['amount__sum'] or 0
-        if total_bet >= value.limit:
+        if value.staked >= value.limit:
             raise ValidationError('Bet limit for this option exceeded')
 
 
 class CountLimitValidator:
-    def __init__(self, des: str, model: Type[Model], limit: Union[int, callable] = None, when='day',
+    """
+    Rejects a new row once the account (the `field_check` foreign key) created
+    `limit` rows, limit_<des> config when not given, in the window `when`: day,
+    month, year or rolling (last 24 hours).
+    """
+
+    def __init__(self, des: str, model: Type[Model], limit: Union[int, callable] = None, when=WINDOW_DAY,
                  field_time='created_at', field_check='user'):
         self.des = des
         self.model = model
@@ -117,24 +121,14 @@ class CountLimitValidator:
         self.field_time = field_time
         self.field_check = field_check
         self.limit = limit() if callable(limit) else limit
-
-    def generate_query_params(self, value):
-        query = {}
-        if self.when == 'day':
-            query[f'{self.field_time}__day'] = timezone.now().day
-        elif self.when == 'month':
-            query[f'{self.field_time}__month'] = timezone.now().month
-        elif self.when == 'year':
-            query[f'{self.field_time}__year'] = timezone.now().year
-        query[self.field_check] = value
-        return query
+        self.counter = RateCounter(model, field_check, when, field_time)
 
     def __call__(self, value, **kwargs):
-        limit_count = int(get_config_from_model(f'limit_{self.des}'))
-        query = self.generate_query_params(value)
-        total_count = self.model.objects.filter(**query).count()
+        limit_count = config_int(f'limit_{self.des}') if self.limit is None else self.limit
+        total_count = self.counter.count(value)
         if total_count >= limit_count:
-            raise ValidationError(f"Maximum limit of {limit_count} per day exceed. {total_count}")
+            raise ValidationError(f"Maximum limit of {limit_count} per {WINDOW_LABELS[self.when]} exceed. "
+                                  f"{total_count}")
 
 
 class MaximumLimitValidator:
@@ -142,7 +136,7 @@ class MaximumLimitValidator:
         self.des = des
 
     def __call__(self, value, *args, **kwargs):
-        maximum = int(get_config_from_model(f'max_{self.des}'))
+        maximum = config_int(f'max_{self.des}')
         if value > maximum:
             raise ValidationError(f"{value} exceed maximum {maximum} limit of {self.des}")
 
@@ -152,7 +146,7 @@ class MinimumLimitValidator:
         self.des = des
 
     def __call__(self, value, *args, **kwargs):
-        minimum = int(get_config_from_model(f'min_{self.des}'))
+        minimum = config_int(f'min_{self.des}')
         if minimum > value:
             raise ValidationError(f"{value} is below minimum {minimum} limit of {self.des}")
 
@@ -162,8 +156,8 @@ class MinMaxLimitValidator:
         self.des = des
 
     def __call__(self, value, *args, **kwargs):
-        minimum = int(get_config_from_model(f'min_{self.des}'))
-        maximum = int(get_config_from_model(f'max_{self.des}'))
+        minimum = config_int(f'min_{self.des}')
+        maximum = config_int(f'max_{self.des}')
         if value > maximum:
             raise ValidationError(f"{value} exceed maximum {maximum} limit of {self.des}")
         if minimum > value:
@@ -1,22 +1,30 @@
+import base64
+import json
+import time
+
 from django.contrib.auth import get_user_model
-from django.db.models import Sum
+from django.db.models import Sum, F, Q, Value, CharField, QuerySet
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, permissions, views, mixins
+from rest_framework.exceptions import ValidationError
 from rest_framework.filters import SearchFilter
 from rest_framework.response import Response
 
+from betting.accruals import referral_summary
 from betting.actions import *
 from betting.choices import A_MATCH_LOCK, A_MATCH_HIDE, A_MATCH_GO_LIVE, A_MATCH_END_NOW, A_QUESTION_LOCK, \
     A_QUESTION_HIDE, A_QUESTION_END_NOW, A_QUESTION_SELECT_WINNER, A_QUESTION_UNSELECT_WINNER, \
     A_QUESTION_REFUND, A_REMOVE_GAME_EDITOR, A_MAKE_GAME_EDITOR, SOURCE_BANK, A_REFUND_BET, A_DEPOSIT_ACCEPT, \
-    A_DEPOSIT_CANCEL, A_WITHDRAW_ACCEPT, A_WITHDRAW_CANCEL, A_TRANSFER_ACCEPT, A_TRANSFER_CANCEL
+    A_DEPOSIT_CANCEL, A_WITHDRAW_ACCEPT, A_WITHDRAW_CANCEL, A_TRANSFER_ACCEPT, A_TRANSFER_CANCEL, A_MATCH_REFUND
 from betting.models import Bet, BetQuestion, Match, DepositMethod, Announcement, Deposit, Withdraw, Transfer, \
     QuestionOption, ConfigModel
+from betting.views import questions_with_details, matches_with_details, users_with_last_bet, clubs_with_totals
 from users.backends import jwt_writer, get_current_club
 from users.models import Club, User as MainUser, Notification
 from users.views import total_user_balance, total_club_balance
-from .action_data import action_data
+from .action_data import BATCH_LIMIT, action_data, boolean, run_batch
 from .custom_permissions import MatchPermissionClass, BetPermissionClass, ClubPermissionClass, \
     TransactionPermissionClass, UserViewPermission, IsAdminOrReadOnly, TransferPermissionClass
 from .serializers import ClubSerializer, BetSerializer, MatchSerializer, \
@@ -28,12 +36,76 @@ from .serializers import ClubSerializer, BetSerializer, MatchSerializer, \
 User: MainUser = get_user_model()
 
 
-def determine_type(query):
-    if hasattr(query, 'recipient'):
-        return 'transfer'
-    if hasattr(query, 'club'):
-        return 'deposit'
-    return 'withdraw'
+# Response key of every column selected by transaction_values, in select order
+TRANSACTION_COLUMNS = {
+    't_id': 'id',
+    't_type': 'type',
+    't_method': 'method',
+    't_recipient': 'recipient',
+    't_user_account': 'user_account',
+    't_site_account': 'site_account',
+    't_amount': 'amount',
+    't_balance': 'user_balance',
+    't_reference': 'transaction_id',
+    't_status': 'status',
+    't_created_at': 'created_at',
+}
+
+
+def transaction_values(queryset: QuerySet, t_type: str, cursor=None) -> QuerySet:
+    """
+    Select the same columns, in the same order, from Deposit, Withdraw or
+    Transfer rows so the querysets can be combined with UNION ALL. Columns a
+    model does not have are NULL. cursor is (created_at, id) of the last row seen.
+    """
+    fields = {field.name for field in queryset.model._meta.get_fields()}
+
+    def column(name, lookup=''):
+        return F(name + lookup) if name in fields else Value(None, output_field=CharField())
+
+    if cursor:
+        created_at, pk = cursor
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    return queryset.order_by().annotate(
+        t_id=F('id'),
+        t_type=Value(t_type, output_field=CharField()),
+        t_method=column('method'),
+        t_recipient=column('recipient', '__username'),
+        t_user_account=column('user_account'),
+        t_site_account=column('site_account'),
+        t_amount=F('amount'),
+        t_balance=F('balance'),
+        t_reference=column('reference'),
+        t_status=F('status'),
+        t_created_at=F('created_at'),
+    ).values(*TRANSACTION_COLUMNS)
+
+
+def encode_cursor(row: dict) -> str:
+    data = json.dumps([row['created_at'].isoformat(), row['id']])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at = parse_datetime(created_at)
+        if created_at is None:
+            raise ValueError
+        return created_at, int(pk)
+    except (TypeError, ValueError):
+        raise ValidationError({'cursor': 'Invalid cursor'})
+
+
+def query_count(params, name: str) -> int:
+    """Whole number query parameter such as limit or offset, 0 when missing."""
+    try:
+        value = int(params.get(name) or 0)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise ValidationError({name: 'Expected a whole number of zero or more.'})
+    return value
 
 
 def permission_error():
@@ -44,26 +116,25 @@ def failed_to_do(data):
     return Response({'details': f'Failed to complete the action due to data.\n{data}'}, status=400)
 
 
-def completed_successfully(data):
-    return Response({'details': f'Successfully completed action.'}, status=200)
+def completed_successfully(data, result=None):
+    response = {'details': f'Successfully completed action.'}
+    if isinstance(result, dict):
+        response['result'] = result
+    return Response(response, status=200)
 
 
 class ActionView(views.APIView):
     def post(self, request):
-        user: User = self.request.user
-        club: Club = get_current_club(self.request)
-        data = dict(self.request.data)
-        action_code = data.get('action_code')
-        to_do = action_data.get(action_code, None)
-        if not to_do:
+        data = self.request.data
+        action = action_data.get(data.get('action_code'))
+        if not action:
             return Response({'details': 'Invalid action'}, status=400)
-        if eval(to_do['permission']):
-            eval(to_do.get('prepare', 'True'))
-            response = eval(to_do['function'])
-            if not response:
-                return failed_to_do(data)
-            return completed_successfully(data)
-        return permission_error()
+        if not action.allowed(self.request.user):
+            return permission_error()
+        result = action.run(data)
+        response = completed_successfully(data, result.result) if result.ok else failed_to_do(dict(data))
+        response['Server-Timing'] = f'action;desc="{result.code}";dur={result.elapsed * 1000:.1f}'
+        return response
 
     def get(self, request):
         return Response({'details': f"""
@@ -81,6 +152,9 @@ class ActionView(views.APIView):
         End Match now\n
         To hide a match. payload should be\n
         ['action_code': {A_MATCH_END_NOW}, 'match_id': match id]\n\n
+        Refund Match\n
+        Refund every question of a match. payload should be\n
+        ['action_code': {A_MATCH_REFUND}, 'match_id': match id]\n\n
         **************** Question Actions *****************\n
         Lock Question\n
         To lock a question. payload should be\n
@@ -96,8 +170,9 @@ class ActionView(views.APIView):
         ['action_code': {A_QUESTION_SELECT_WINNER}, 'question_id': question id, 'option_id': option id]\n\n
         Unselect Question Winner\n
         If a question is paid and you use this, everything will be changed 
-        to as it was before payment. payload should be\n
-        ['action_code': {A_QUESTION_UNSELECT_WINNER}, 'question_id': question id]\n\n
+        to as it was before payment. Add 'dry_run': true to only get the balance changes
+        in 'result'. payload should be\n
+        ['action_code': {A_QUESTION_UNSELECT_WINNER}, 'question_id': question id, 'dry_run': false]\n\n
         Refund a question\n
         Refund a question. payload should be\n
         ['action_code': {A_QUESTION_REFUND}, 'question_id': question id]\n\n
@@ -127,48 +202,71 @@ class ActionView(views.APIView):
         """})
 
 
+class ActionBatchView(views.APIView):
+    """
+    post:
+    Run many actions in one request and one transaction.\n
+    payload: {'actions': [action payloads as for /api/actions/], 'atomic': false}\n
+    Actions are grouped by action_code and each runs in its own savepoint, so
+    a failed one is rolled back alone. With 'atomic': true nothing runs if any
+    action is rejected, and one failing rolls back all of them.\n
+    results has one entry per action, in the order given, with its status,
+    details and result.
+    """
+
+    def post(self, request):
+        data = self.request.data
+        items = data if isinstance(data, list) else data.get('actions')
+        if not isinstance(items, list) or not items:
+            return Response({'details': 'actions must be a non empty list'}, status=400)
+        if len(items) > BATCH_LIMIT:
+            return Response({'details': f'At most {BATCH_LIMIT} actions per batch'}, status=400)
+        if self.request.user is None or not self.request.user.is_authenticated:
+            return permission_error()
+        atomic = not isinstance(data, list) and boolean(data.get('atomic', False))
+        started = time.perf_counter()
+        results = run_batch(self.request.user, items, atomic=atomic)
+        elapsed = time.perf_counter() - started
+        succeeded = sum(result['status'] == 200 for result in results)
+        response = Response({'succeeded': succeeded, 'failed': len(results) - succeeded, 'atomic': atomic,
+                             'results': results}, status=200 if succeeded else 400)
+        response['Server-Timing'] = f'batch;desc="{len(items)} actions";dur={elapsed * 1000:.1f}'
+        return response
+
+
 class AllTransactionView(views.APIView):
     """
     get:
-    User must be logged in
+    User must be logged in\n
+    Deposits, withdraws and transfers together, newest first.\n
+    Query params: limit, offset, club=true for club transactions and cursor.
+    Pass next of the previous response as cursor to get the page after it.
     """
 
     def get(self, *args, **kwargs):
+        cursor = self.request.GET.get('cursor')
+        cursor = cursor and decode_cursor(cursor)
+        limit, offset = query_count(self.request.GET, 'limit'), query_count(self.request.GET, 'offset')
         if self.request.GET.get('club'):
             club = get_current_club(self.request)
-            all_deposit = Deposit.objects.filter(club=club)
-            all_withdraw = []
-            all_transfer = Transfer.objects.filter(club=club)
+            all_transaction = [transaction_values(Deposit.objects.filter(club=club), 'deposit', cursor),
+                               transaction_values(Transfer.objects.filter(club=club), 'transfer', cursor)]
         else:
             if not (self.request.user and self.request.user.is_authenticated):
                 return Response({'details': 'User is not authenticated'}, status=401)
-            all_deposit = Deposit.objects.filter(user=self.request.user)
-            all_withdraw = Withdraw.objects.filter(user=self.request.user)
-            all_transfer = Transfer.objects.filter(sender=self.request.user)
-        all_transaction = []
-        for query in list(all_deposit) + list(all_withdraw) + list(all_transfer):
-            all_transaction.append({
-                'id': query.id,
-                'type': determine_type(query),
-                'method': (hasattr(query, 'method') and query.method) or None,
-                'recipient': (hasattr(query, 'recipient') and query.recipient.username) or None,
-                'user_account': (hasattr(query, 'user_account') and query.user_account) or None,
-                'site_account': (hasattr(query, 'site_account') and query.site_account) or None,
-                'amount': query.amount,
-                'user_balance': query.balance,
-                'transaction_id': (hasattr(query, 'reference') and query.reference) or None,
-                'status': query.status,
-                'created_at': query.created_at
-            })
-        all_transaction.sort(key=lambda x: x['created_at'], reverse=True)
-        try:
-            limit = int(self.request.GET.get('limit', 0))
-            offset = int(self.request.GET.get('offset', 0))
-            if limit:
-                all_transaction = all_transaction[offset: offset + limit]
-        except Exception as e:
-            print(e)
-        return Response({'results': all_transaction, 'count': len(all_transaction)})
+            user = self.request.user
+            all_transaction = [transaction_values(Deposit.objects.filter(user=user), 'deposit', cursor),
+                               transaction_values(Withdraw.objects.filter(user=user), 'withdraw', cursor),
+                               transaction_values(Transfer.objects.filter(sender=user), 'transfer', cursor)]
+        all_transaction = all_transaction[0].union(*all_transaction[1:], all=True).order_by('-t_created_at', '-t_id')
+        if limit:
+            all_transaction = all_transaction[offset: offset + limit]
+        results = [{key: row[column] for column, key in TRANSACTION_COLUMNS.items()} for row in all_transaction]
+        for result in results:
+            for key in ('method', 'recipient', 'user_account', 'site_account', 'transaction_id'):
+                result[key] = result[key] or None
+        next_cursor = encode_cursor(results[-1]) if limit and len(results) == limit else None
+        return Response({'results': results, 'count': len(results), 'next': next_cursor})
 
 
 class AnnouncementViewSet(viewsets.ModelViewSet):
@@ -198,10 +296,25 @@ class BetViewSet(mixins.CreateModelMixin,
     """
 
     def get_queryset(self):
+        # Everything BetSerializer reads is joined, so a page costs the same queries whatever its size
+        bets = (Bet.objects.select_related('bet_question__match', 'bet_question__winner', 'choice', 'user')
+                .order_by('-created_at', '-id'))
         if self.request.GET.get('club'):
             club = get_current_club(self.request)
-            return Bet.objects.filter(user__user_club=club)
-        return Bet.objects.filter(user=self.request.user)
+            return bets.filter(user__user_club=club)
+        return bets.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        data = serializer.validated_data
+        bet = place_bet(data['user'], data['bet_question'], data['choice'], data['amount'])
+        if not bet:
+            if BetQuestion.objects.get(pk=data['bet_question'].pk).is_locked():
+                raise ValidationError('Bet Question is locked or closed')
+            choice = QuestionOption.objects.get(pk=data['choice'].pk)
+            if choice.staked + data['amount'] > choice.limit:
+                raise ValidationError('Bet limit for this option exceeded')
+            raise ValidationError('Not enough balance')
+        serializer.instance = bet
 
     serializer_class = BetSerializer
     permission_classes = [BetPermissionClass]
@@ -225,7 +338,7 @@ class BetQuestionViewSet(viewsets.ModelViewSet):
     """
 
     serializer_class = BetQuestionSerializer
-    queryset = BetQuestion.objects.select_related('match').all()
+    queryset = questions_with_details().order_by('-created_at', '-id')
     permission_classes = [MatchPermissionClass]
     filter_backends = [SearchFilter, DjangoFilterBackend]
     search_fields = ['question', 'match__team_a_name', 'match__team_b_name']
@@ -244,6 +357,11 @@ class ClubViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter]
     search_fields = ['name']
 
+    def get_queryset(self):
+        if self.action in ('list', 'retrieve'):
+            return clubs_with_totals()
+        return super().get_queryset()
+
 
 class ConfigModelViewSet(viewsets.ModelViewSet):
     """
@@ -280,7 +398,9 @@ class DashboardView(views.APIView):
             'total_user_withdraw': Withdraw.objects.filter(status=STATUS_ACCEPTED
                                                            ).aggregate(Sum('amount'))['amount__sum'] or 0,
             'total_club_transfer': Transfer.objects.filter(club__isnull=False, status=STATUS_ACCEPTED
-                                                           ).aggregate(Sum('amount'))['amount__sum'] or 0
+                                                           ).aggregate(Sum('amount'))['amount__sum'] or 0,
+            'total_bet': QuestionOption.objects.aggregate(Sum('staked'))['staked__sum'] or 0,
+            'total_liability': QuestionOption.objects.aggregate(Sum('liability'))['liability__sum'] or 0,
 
         }
         return Response({'details': data})
@@ -301,8 +421,8 @@ class DepositViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         if self.request.GET.get('club'):
             club = get_current_club(self.request)
-            return Deposit.objects.filter(club=club)
-        return Deposit.objects.filter(user=self.request.user)
+            return Deposit.objects.filter(club=club).order_by('-created_at', '-id')
+        return Deposit.objects.filter(user=self.request.user).order_by('-created_at', '-id')
 
     serializer_class = DepositSerializer
     permission_classes = [TransactionPermissionClass]
@@ -340,7 +460,7 @@ class Login(views.APIView):
             user = user[0]
         if user.check_password(password):
             user.last_login = timezone.now()
-            user.save()
+            user.save(update_fields=['last_login'])
             data = UserDetailsSerializer(user).data
             data.pop('jwt')
             jwt_str = jwt_writer(**data)
@@ -376,7 +496,11 @@ class MatchViewSet(viewsets.ModelViewSet):
             return MatchSerializer
         return MatchDetailsSerializer
 
-    queryset = Match.objects.all()
+    def get_queryset(self):
+        if self.request.GET.get('fast'):
+            return Match.objects.order_by('-created_at', '-id')
+        return matches_with_details().order_by('-created_at', '-id')
+
     permission_classes = [MatchPermissionClass]
     filter_backends = [SearchFilter, DjangoFilterBackend]
     search_fields = ['game_name', 'team_a_name', 'team_b_name']
@@ -388,7 +512,7 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Notification.objects.filter(user=self.request.user)
+        return Notification.objects.filter(user=self.request.user).order_by('-created_at', '-id')
 
 
 class WithdrawViewSet(viewsets.ModelViewSet):
@@ -399,13 +523,31 @@ class WithdrawViewSet(viewsets.ModelViewSet):
     """
 
     def get_queryset(self):
-        return Withdraw.objects.filter(user=self.request.user)
+        return Withdraw.objects.filter(user=self.request.user).order_by('-created_at', '-id')
 
     serializer_class = WithdrawSerializer
     permission_classes = [TransactionPermissionClass]
     http_method_names = ['get', 'post', 'head', 'options']
 
 
+class ReferralSummaryView(views.APIView):
+    """
+    get:
+    User must be logged in\n
+    Referral earnings of the user from the referral accrual table. amount is
+    paid and pending together, pending is not yet added to balance.\n
+    Query param days (default 30) limits the daily list.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            raise ValidationError({'days': 'Must be a number'})
+        return Response(referral_summary(request.user, days))
+
+
 class TransferViewSet(viewsets.ModelViewSet):
     """
         list:
@@ -419,8 +561,8 @@ class TransferViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         if self.request.GET.get('club'):
             club = get_current_club(self.request)
-            return Transfer.objects.filter(club=club)
-        return Transfer.objects.filter(sender=self.request.user)
+            return Transfer.objects.filter(club=club).order_by('-created_at', '-id')
+        return Transfer.objects.filter(sender=self.request.user).order_by('-created_at', '-id')
 
     def get_serializer_class(self):
         if self.request.GET.get('club'):
@@ -454,6 +596,11 @@ class UserViewSet(viewsets.ModelViewSet):
         else:
             return UserListSerializer
 
+    def get_queryset(self):
+        if self.get_serializer_class() is UserListSerializerClub:
+            return users_with_last_bet().order_by('balance', 'id')
+        return User.objects.order_by('balance', 'id')
+
     permission_classes = [UserViewPermission]
     queryset = User.objects.all()
     http_method_names = ['get', 'post', 'patch', 'head', 'options']
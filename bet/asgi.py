@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bet.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the apps are loaded, it imports models
+from betting.streams import market_router  # noqa: E402
+
+# Live market deltas over WebSocket and server sent events, the rest to Django
+application = market_router(django_application)
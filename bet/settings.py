@@ -63,6 +63,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.middleware.CurrentClubMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -92,11 +93,12 @@ WSGI_APPLICATION = 'bet.wsgi.application'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
 
-if 'test' in sys.argv:
+# DB_ENGINE=sqlite runs commands such as bench_settlement on sqlite instead of MySQL
+if 'test' in sys.argv or os.environ.get('DB_ENGINE') == 'sqlite':
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': BASE_DIR / 'test.sqlite3',
+            'NAME': os.environ.get('SQLITE_NAME', BASE_DIR / 'test.sqlite3'),
         }
     }
 else:
@@ -195,6 +197,42 @@ ADMIN_AUTH_TOKEN = os.environ.get('ADMIN_AUTH_TOKEN', 'eyJhbGciOiJIUzI1NiJ9.eyJi
                                                       'lcm5hbWUiOiJtYWgifQ.CqB1e1u9vIs5'
                                                       'nbgZZrnlvDFlMCiV3fU13yZMy24VDUU')
 
+# Shared by every worker process: cached auth rows and config versions must be seen and invalidated by all
+# of them. Memcached at CACHE_LOCATION in production. CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache
+# keeps the cache in the table created by `manage.py migrate` instead, the default of runs on sqlite. Users
+# and clubs are then not cached, a read of the table costs as much as the query it would save
+DATABASE_CACHE = 'django.core.cache.backends.db.DatabaseCache'
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', DATABASE_CACHE if os.environ.get('DB_ENGINE') == 'sqlite'
+                               else 'django.core.cache.backends.memcached.PyMemcacheCache')
+SHARED_CACHE = {
+    'BACKEND': CACHE_BACKEND,
+    'LOCATION': os.environ.get('CACHE_LOCATION', 'django_cache' if CACHE_BACKEND == DATABASE_CACHE
+                               else '127.0.0.1:11211'),
+}
+# Tests run in a single process
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'} if 'test' in sys.argv
+          else SHARED_CACHE}
+
+# Seconds a worker serves its configuration snapshot before checking the shared version again. Tests
+# roll the rows back and clear the cache between cases, so they check it on every lookup
+CONFIG_VERSION_CHECK_INTERVAL = 0 if 'test' in sys.argv else 5
+
+# Verified JWTs kept per process and seconds an authenticated user row is cached, in Memcached only
+JWT_CACHE_SIZE = 4096
+AUTH_USER_CACHE_TIMEOUT = 300
+
+# Write committed notifications from a background thread instead of the request thread
+NOTIFICATION_OUTBOX_WORKER = os.environ.get('NOTIFICATION_OUTBOX_WORKER') == 'True'
+
+# Broker fanning live market deltas out to WebSocket and event stream clients. The database one carries
+# them between the web worker processes, each serving its own clients, tests run in a single process
+MARKET_BROKER = os.environ.get('MARKET_BROKER', 'betting.live.InProcessBroker' if 'test' in sys.argv
+                               else 'betting.live.DatabaseBroker')
+MARKET_HEARTBEAT = 15
+# Seconds between reads of new market events by each process with clients and seconds events are kept
+MARKET_POLL_INTERVAL = 0.5
+MARKET_EVENT_RETENTION = 3600
+
 SWAGGER_SETTINGS = {
     'SECURITY_DEFINITIONS': {
         'Bearer': {
@@ -0,0 +1,130 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from betting.choices import SOURCE_COMMISSION, SOURCE_REFER, STATUS_ACCEPTED
+from betting.config import config_float
+from betting.models import CommissionAccrual, Deposit, ReferralAccrual
+from users.models import Club, User, change_club_totals
+from users.views import notify_club, notify_user
+
+logger = logging.getLogger(__name__)
+
+
+def pending_commission(club_id: int) -> float:
+    """Commission accrued for the club that is not paid into its balance yet."""
+    pending = CommissionAccrual.objects.filter(club_id=club_id, deposit__isnull=True)
+    return pending.aggregate(Sum('amount'))['amount__sum'] or 0
+
+
+def flush_club_commission(club: Club) -> int:
+    """
+    Pay all pending accruals of one club with a single Deposit and one balance
+    update. Rows are claimed by pointing them at the new deposit before they are
+    summed, so accruals committed while flushing wait for the next run.
+    Returns number of accruals paid.
+    """
+    with transaction.atomic():
+        deposit = Deposit.objects.create(club=club, amount=0, deposit_source=SOURCE_COMMISSION,
+                                         method=SOURCE_COMMISSION, status=STATUS_ACCEPTED)
+        count = CommissionAccrual.objects.filter(club=club, deposit__isnull=True).update(deposit=deposit)
+        if not count:
+            transaction.set_rollback(True)
+            return 0
+        amount = deposit.commissionaccrual_set.aggregate(Sum('amount'))['amount__sum'] or 0
+        deposit.amount = amount
+        deposit.balance = club.credit(amount)
+        deposit.save(update_fields=['amount', 'balance'])
+        notify_club(club, f'{club.name} has earned {amount} commission from {count} bets')
+    return count
+
+
+def flush_commissions() -> dict:
+    """Roll pending commission accruals of every club into club deposits."""
+    started = time.perf_counter()
+    clubs = Club.objects.filter(pk__in=CommissionAccrual.objects.filter(deposit__isnull=True).values('club_id'))
+    report = {'clubs': 0, 'accruals': 0}
+    for club in clubs:
+        count = flush_club_commission(club)
+        report['clubs'] += bool(count)
+        report['accruals'] += count
+    report['elapsed'] = time.perf_counter() - started
+    logger.info('Flushed %(accruals)s commission accruals of %(clubs)s clubs in %(elapsed).3fs', report)
+    return report
+
+
+def accrue_referral(user: User, amount: float) -> None:
+    """
+    Add the referral commission of one bet to the pending row of the referrer,
+    user and day, so heavy bettors keep one row per day instead of one per bet.
+    """
+    pending = ReferralAccrual.objects.filter(referrer_id=user.referred_by_id, user=user,
+                                             date=timezone.localdate(), deposit__isnull=True)
+    if not pending.update(amount=F('amount') + amount, bet_count=F('bet_count') + 1):
+        ReferralAccrual.objects.create(referrer_id=user.referred_by_id, user=user, date=timezone.localdate(),
+                                       amount=amount, bet_count=1)
+
+
+def flush_referrer(referrer: User) -> int:
+    """
+    Pay all pending referral accruals of one referrer with a single Deposit,
+    one balance update and one digest notification. Returns number of accruals paid.
+    """
+    with transaction.atomic():
+        deposit = Deposit.objects.create(user=referrer, amount=0, deposit_source=SOURCE_REFER,
+                                         method=SOURCE_REFER, status=STATUS_ACCEPTED)
+        count = ReferralAccrual.objects.filter(referrer=referrer, deposit__isnull=True).update(deposit=deposit)
+        if not count:
+            transaction.set_rollback(True)
+            return 0
+        totals = deposit.referralaccrual_set.aggregate(amount=Sum('amount'), bets=Sum('bet_count'),
+                                                       users=Count('user', distinct=True))
+        users = User.objects.filter(pk=referrer.pk)
+        users.update(balance=F('balance') + totals['amount'], earn_from_refer=F('earn_from_refer') + totals['amount'])
+        change_club_totals(Club.objects.filter(user=referrer.pk), balance=totals['amount'])
+        referrer.balance, referrer.earn_from_refer = users.values_list('balance', 'earn_from_refer').get()
+        referrer.invalidate_cache()
+        deposit.amount = totals['amount']
+        deposit.balance = referrer.balance
+        deposit.save(update_fields=['amount', 'balance'])
+        notify_user(referrer, f"You earned {totals['amount']} from {totals['bets']} bets of {totals['users']} "
+                              f"referred users. Keep referring and earn {config_float('refer_commission')}% "
+                              f"commission from each bet")
+    return count
+
+
+def flush_referrals() -> dict:
+    """Roll pending referral accruals of every referrer into user deposits."""
+    started = time.perf_counter()
+    referrers = User.objects.filter(pk__in=ReferralAccrual.objects.filter(deposit__isnull=True).values('referrer_id'))
+    report = {'referrers': 0, 'accruals': 0}
+    for referrer in referrers:
+        count = flush_referrer(referrer)
+        report['referrers'] += bool(count)
+        report['accruals'] += count
+    report['elapsed'] = time.perf_counter() - started
+    logger.info('Flushed %(accruals)s referral accruals of %(referrers)s referrers in %(elapsed).3fs', report)
+    return report
+
+
+def referral_summary(referrer: User, days=30) -> dict:
+    """Paid and pending referral earnings of the referrer, per referred user and per day."""
+    accruals = ReferralAccrual.objects.filter(referrer=referrer).order_by()
+    pending = Sum('amount', filter=Q(deposit__isnull=True))
+    users = (accruals.values('user_id', 'user__username')
+             .annotate(total=Sum('amount'), pending=pending, bets=Sum('bet_count')).order_by('-total'))
+    daily = (accruals.filter(date__gte=timezone.localdate() - timedelta(days=days))
+             .values('date').annotate(total=Sum('amount'), bets=Sum('bet_count')).order_by('-date'))
+    totals = accruals.aggregate(total=Sum('amount'), pending=pending, bets=Sum('bet_count'))
+    return {
+        'amount': totals['total'] or 0,
+        'pending': totals['pending'] or 0,
+        'bet_count': totals['bets'] or 0,
+        'users': [{'user': row['user_id'], 'username': row['user__username'], 'amount': row['total'],
+                   'pending': row['pending'] or 0, 'bet_count': row['bets']} for row in users],
+        'daily': [{'date': row['date'], 'amount': row['total'], 'bet_count': row['bets']} for row in daily],
+    }
@@ -1,11 +1,20 @@
 from typing import Union, Type
 
+from django.db import transaction
+from django.db.models import F
 from django.shortcuts import get_object_or_404
 
 from betting.choices import STATUS_PAID, STATUS_PENDING, STATUS_REFUNDED, STATUS_LOCKED, STATUS_HIDDEN, \
     STATUS_LIVE, STATUS_CLOSED, STATUS_ACCEPTED, STATUS_CANCELLED, SOURCE_BANK
-from betting.models import Match, BetQuestion, Deposit, Transfer, Withdraw, Bet, QuestionOption, DepositMethod
-from users.models import User
+from betting.accruals import accrue_referral
+from betting.config import config_float
+from betting.live import publish_updated
+from betting.models import Match, BetQuestion, Deposit, Transfer, Withdraw, Bet, QuestionOption, DepositMethod, \
+    CommissionAccrual
+from betting.settlement import settle_question, reverse_settlement, refund_question_bets, refund_match_bets
+from log.views import data_error_log
+from users.cache import invalidate_users
+from users.models import User, Club, UserClubInfo, InsufficientBalance
 from users.views import notify_user, notify_club
 
 
@@ -24,98 +33,160 @@ def create_deposit(user_id: Union[int, Type[int]], amount: Union[int, float],
     return deposit
 
 
+def set_status(model, pk: int, status: str) -> int:
+    """Update the status of one row and push the change to live clients, update sends no signal."""
+    updated = model.objects.filter(pk=pk).update(status=status)
+    publish_updated(model, [pk], status=status)
+    return updated
+
+
 # Match
 def lock_match(match_id: int) -> Union[Match, bool]:
     if not match_id or not Match.objects.filter(pk=match_id).exists():
         return False
-    return Match.objects.filter(pk=match_id).update(status=STATUS_LOCKED)
+    return set_status(Match, match_id, STATUS_LOCKED)
 
 
 def hide_match(match_id: int) -> Union[Match, bool]:
     if not match_id or not Match.objects.filter(pk=match_id).exists():
         return False
-    return Match.objects.filter(pk=match_id).update(status=STATUS_HIDDEN)
+    return set_status(Match, match_id, STATUS_HIDDEN)
 
 
 def go_live_match(match_id) -> Union[Match, bool]:
     if not match_id or not Match.objects.filter(pk=match_id).exists():
         return False
-    return Match.objects.filter(pk=match_id).update(status=STATUS_LIVE)
+    return set_status(Match, match_id, STATUS_LIVE)
 
 
 def end_match_now(match_id) -> Union[Match, bool]:
     if not match_id or not Match.objects.filter(pk=match_id).exists():
         return False
-    return Match.objects.filter(pk=match_id).update(status=STATUS_CLOSED)
+    return set_status(Match, match_id, STATUS_CLOSED)
 
 
 # Bet Question
 def hide_question(question_id: int) -> Union[BetQuestion, bool]:
     if not question_id or not BetQuestion.objects.filter(pk=question_id).exists():
         return False
-    return BetQuestion.objects.filter(pk=question_id).update(status=STATUS_HIDDEN)
+    return set_status(BetQuestion, question_id, STATUS_HIDDEN)
 
 
 def end_question_now(question_id: int) -> Union[BetQuestion, bool]:
     if not question_id or not BetQuestion.objects.filter(pk=question_id).exists():
         return False
-    return BetQuestion.objects.filter(pk=question_id).update(status=STATUS_CLOSED)
+    return set_status(BetQuestion, question_id, STATUS_CLOSED)
 
 
 def lock_question(question_id: int) -> Union[BetQuestion, bool]:
     if not question_id or not BetQuestion.objects.filter(pk=question_id).exists():
         return False
-    return BetQuestion.objects.filter(pk=question_id).update(status=STATUS_LOCKED)
+    return set_status(BetQuestion, question_id, STATUS_LOCKED)
 
 
 def select_question_winner(question_id: int, option_id: int) -> Union[BetQuestion, bool]:
     if not question_id or not BetQuestion.objects.filter(pk=question_id).exists():
         return False
-    if not option_id or not QuestionOption.objects.filter(pk=option_id).exists():
+    winner = QuestionOption.objects.filter(pk=option_id).first() if option_id else None
+    if not winner:
         return False
     question = BetQuestion.objects.get(pk=question_id)
-    winner = QuestionOption.objects.get(pk=option_id)
-    question.status = STATUS_PAID
-    question.winner = winner
-    bet_winners = question.bet_set.values('id').filter(choice=winner)
-    bet_losers = question.bet_set.exclude(choice=winner)
-    for bet in bet_winners:
-        pay_bet(bet.id)
-    bet_losers.update(is_winner=False, status=STATUS_PAID)
-    question.save()  # To avoid reprocessing the bet scope
+    if settle_question(question, winner) is None:
+        return False
+    question.refresh_from_db()
     return question
 
 
-def unselect_question_winner(question_id: int) -> Union[BetQuestion, bool]:
+def unselect_question_winner(question_id: int, dry_run=False) -> Union[BetQuestion, dict, bool]:
+    """
+    Take back payment of a settled question. With dry_run the balance changes
+    are returned without being applied.
+    """
     if not question_id or not BetQuestion.objects.filter(pk=question_id).exists():
         return False
     question = BetQuestion.objects.get(pk=question_id)
     if not question.winner:
         return False
-    winner = QuestionOption.objects.get(pk=question.winner_id)
-    question.status = STATUS_LOCKED
-    question.winner = None
-    bet_winners = question.bet_set.values('id').filter(choice=winner)
-    bet_losers = question.bet_set.exclude(choice=winner)
-    for bet in bet_winners:
-        un_pay_bet(bet.id)
-    bet_losers.update(is_winner=None, status=STATUS_PENDING)
-    question.save()  # To avoid reprocessing the bet scope
+    report = reverse_settlement(question, dry_run=dry_run)
+    if dry_run:
+        return report
+    question.refresh_from_db()
     return question
 
 
 def refund_question(question_id: int) -> bool:
     if not question_id or not BetQuestion.objects.filter(pk=question_id).exists():
         return False
-    question = BetQuestion.objects.get(pk=question_id)
-    for bet in question.bet_set.all():
-        refund_bet(bet.id)
-    question.status = STATUS_REFUNDED
-    question.save()  # To avoid reprocessing the bet scope
+    refund_question_bets(BetQuestion.objects.get(pk=question_id))
+    return True
+
+
+def refund_match(match_id: int) -> bool:
+    if not match_id or not Match.objects.filter(pk=match_id).exists():
+        return False
+    refund_match_bets(Match.objects.get(pk=match_id))
     return True
 
 
 # Bet
+def place_bet(user: User, bet_question: BetQuestion, choice: QuestionOption, amount: int) -> Union[Bet, bool]:
+    """
+    Debit the user and insert the bet in one transaction. The question row is
+    locked first so a bet can not land on a question settle_question is paying,
+    then the user row, the debit only happens if min_balance is kept and
+    win_amount is known before the insert. The option counters are raised by a
+    conditional UPDATE that fails if the bet would take the option past its
+    limit. Club and referral commissions are appended to accrual ledgers and
+    paid in batches by flush_commissions and flush_referrals. Returns False if
+    the question is locked, the user does not have enough balance or the option
+    is full.
+    """
+    with transaction.atomic():
+        bet_question = BetQuestion.objects.select_for_update().get(pk=bet_question.pk)
+        if bet_question.is_locked():
+            return False
+        user = User.objects.select_for_update().get(pk=user.pk)
+        try:
+            user.debit(amount, floor=config_float('min_balance'))
+        except InsufficientBalance:
+            return False
+        refer_paid = amount * config_float('refer_commission') / 100 if user.referred_by_id else 0
+        club_commission = Club.objects.filter(pk=user.user_club_id).values_list('club_commission', flat=True).first()
+        club_paid = amount * club_commission / 100 if club_commission is not None else 0
+        win_amount = (amount - club_paid - refer_paid) * choice.rate
+        if not QuestionOption.objects.filter(pk=choice.pk, staked__lte=F('limit') - amount).update(
+                bet_count=F('bet_count') + 1, staked=F('staked') + amount, liability=F('liability') + win_amount,
+                total_bet_count=F('total_bet_count') + 1, total_staked=F('total_staked') + amount,
+                total_to_return=F('total_to_return') + win_amount):
+            transaction.set_rollback(True)
+            return False
+        bet = Bet.objects.create(user=user, bet_question=bet_question, choice=choice, amount=amount,
+                                 win_rate=choice.rate, win_amount=win_amount, user_balance=user.balance)
+        if club_commission is not None:
+            CommissionAccrual.objects.create(club_id=user.user_club_id, user=user, bet=bet, amount=club_paid)
+        else:
+            data_error_log(description=f'User {user.pk} does not have valid club')
+        UserClubInfo.objects.filter(user_id=user.pk).update(total_bet=F('total_bet') + amount,
+                                                            total_commission=F('total_commission') + club_paid)
+        if refer_paid:
+            accrue_referral(user, refer_paid)
+    return bet
+
+
+def release_option(bet: Bet) -> int:
+    """Take a bet that is refunded or deleted out of its option's counters."""
+    liability = 0 if bet.status == STATUS_PAID else bet.win_amount
+    return QuestionOption.objects.filter(pk=bet.choice_id).update(
+        bet_count=F('bet_count') - 1, staked=F('staked') - bet.amount, liability=F('liability') - liability)
+
+
+def forget_option_bet(bet: Bet) -> int:
+    """Take a deleted bet out of its option's totals, which keep refunded bets."""
+    return QuestionOption.objects.filter(pk=bet.choice_id).update(
+        total_bet_count=F('total_bet_count') - 1, total_staked=F('total_staked') - bet.amount,
+        total_to_return=F('total_to_return') - bet.win_amount)
+
+
 def refund_bet(bet_id: int, percent=None) -> Union[Bet, bool]:
     # TODO: Verify logic
     if not bet_id or not Bet.objects.filter(pk=bet_id).exists():
@@ -127,8 +198,9 @@ def refund_bet(bet_id: int, percent=None) -> Union[Bet, bool]:
         change = bet.win_amount / bet.win_rate
     if percent:
         change = bet.amount * float(percent) / 100
-    bet.user.balance += change
-    bet.user.save()
+    if bet.status != STATUS_REFUNDED:
+        release_option(bet)
+    bet.user.credit(change)
     notify_user(bet.user, f'Bet cancelled for match ##{bet.bet_question.match.__str__()}## '
                           f'on ##{bet.bet_question.question}##. Balance '
                           f'refunded by {change} BDT')
@@ -141,10 +213,10 @@ def pay_bet(bet_id: int):
     if not bet_id or not Bet.objects.filter(pk=bet_id).exists():
         return False
     bet = Bet.objects.select_related('bet_question', 'bet_question__match', 'user').get(pk=bet_id)
-    bet.user.balance += bet.amount
-    bet.user.save()
-    notify_user(bet.user, f'You won bdt {bet.amount} for match ##{bet.bet_question.match.title}## '
-                          f'on question ##{bet.bet_question.question}##. Balance ')
+    bet.user.credit(bet.win_amount)
+    QuestionOption.objects.filter(pk=bet.choice_id).update(liability=F('liability') - bet.win_amount)
+    notify_user(bet.user, f'You won bdt {bet.win_amount} for match ##{bet.bet_question.match}## '
+                          f'on question ##{bet.bet_question.question}##.')
     bet.is_winner = True
     bet.status = STATUS_PAID
     bet.user_balance = bet.user.balance
@@ -155,9 +227,9 @@ def un_pay_bet(bet_id: int):
     if not bet_id or not Bet.objects.filter(pk=bet_id).exists():
         return False
     bet = Bet.objects.select_related('bet_question', 'bet_question__match', 'user').get(pk=bet_id)
-    bet.user.balance -= bet.amount
-    bet.user.save()
-    notify_user(bet.user, f'match ##{bet.bet_question.match.title}## '
+    bet.user.debit(bet.win_amount)
+    QuestionOption.objects.filter(pk=bet.choice_id).update(liability=F('liability') + bet.win_amount)
+    notify_user(bet.user, f'match ##{bet.bet_question.match}## '
                           f'on question ##{bet.bet_question.question}## one of your'
                           f'bet win status cancelled')
     bet.is_winner = None
@@ -174,15 +246,11 @@ def accept_deposit(deposit_id: int, message=None) -> Union[Deposit, bool]:
     if deposit_method_q.exists() and deposit.deposit_source == SOURCE_BANK:
         rate = DepositMethod.objects.filter(method=deposit.method).first().convert_rate
     if deposit.user:
-        deposit.user.balance += deposit.amount * rate
-        deposit.user.save()
-        deposit.balance = deposit.user.balance
+        deposit.balance = deposit.user.credit(deposit.amount * rate)
         notify_user(deposit.user, message or f"Deposit request on {deposit.created_at} amount"
                                              f"{deposit.amount} confirmed")
     elif deposit.club:
-        deposit.club.balance += deposit.amount
-        deposit.club.save()
-        deposit.balance = deposit.club.balance
+        deposit.balance = deposit.club.credit(deposit.amount)
         notify_club(deposit.club, message or f"Deposit request on {deposit.created_at} amount"
                                              f"{deposit.amount} confirmed")
     deposit.status = STATUS_ACCEPTED
@@ -201,7 +269,6 @@ def accept_withdraw(withdraw_id: int) -> Withdraw:
         withdraw.save()
     else:
         withdraw.status = STATUS_ACCEPTED
-        withdraw.user.save()
         withdraw.balance = withdraw.user.balance
         withdraw.save()
     notify_user(withdraw.user, f'Withdraw request create on {withdraw.created_at} is accepted.')
@@ -216,16 +283,13 @@ def accept_transfer(transfer_id: int) -> Union[Transfer, bool]:
         return False
     elif transfer.status == STATUS_CANCELLED:
         sender = transfer.sender or transfer.club
-        sender.balance -= transfer.amount
-        sender.save()
-        transfer.recipient.balance += transfer.amount
-        transfer.recipient.save()
+        sender.debit(transfer.amount)
+        transfer.recipient.credit(transfer.amount)
         notify_user(transfer.recipient, f'You  received {transfer.amount} tk '
                                         f'with transfer id ##{transfer.id}##')
     elif transfer.status == STATUS_PENDING:
         sender = transfer.sender or transfer.club
-        transfer.recipient.balance += transfer.amount
-        transfer.recipient.save()
+        transfer.recipient.credit(transfer.amount)
         notify_user(transfer.recipient, f'You  received {transfer.amount} tk '
                                         f'with transfer id ##{transfer.id}##')
     else:
@@ -241,8 +305,7 @@ def cancel_deposit(deposit_id: int, delete=False) -> Deposit:
     if deposit.status == STATUS_ACCEPTED:
         # Change user Balance
         if deposit.user:
-            deposit.user.balance -= deposit.amount
-            deposit.user.save()
+            deposit.user.debit(deposit.amount)
             # Change deposit status
             notify_user(deposit.user, f"Deposit request has been canceled placed on {deposit.created_at}."
                                       f"Contact admin if you think it was wrong. Transaction id: "
@@ -250,9 +313,7 @@ def cancel_deposit(deposit_id: int, delete=False) -> Deposit:
                                       f"account: {deposit.user_account} To account {deposit.site_account} "
                                       f"Method: {deposit.method}")
         elif deposit.club:
-            deposit.club.balance -= deposit.amount
-            deposit.club.save()
-            deposit.balance = deposit.club.balance
+            deposit.balance = deposit.club.debit(deposit.amount)
             # Change deposit status
             notify_club(deposit.club, f"Deposit request has been canceled placed on {deposit.created_at}."
                                       f"Contact admin if you think it was wrong. Transaction id: "
@@ -271,9 +332,7 @@ def cancel_withdraw(withdraw_id: int) -> Withdraw:
     """
     withdraw = get_object_or_404(Withdraw, pk=withdraw_id)
     withdraw.status = STATUS_CANCELLED
-    withdraw.user.balance += withdraw.amount
-    withdraw.user.save()
-    withdraw.balance = withdraw.user.balance
+    withdraw.balance = withdraw.user.credit(withdraw.amount)
     withdraw.save()
     notify_user(withdraw.user,
                 f"Withdraw of {withdraw.amount}BDT via {withdraw.method} to number {withdraw.user_account} "
@@ -295,15 +354,12 @@ def cancel_transfer(transfer_id: int) -> Transfer:
         notify_user(transfer.recipient, f"Transfer of {transfer.amount}BDT to you from {transfer.club.name} "
                                         f"placed on {transfer.created_at} has been canceled")
     if transfer.status == STATUS_ACCEPTED:
-        transfer.recipient.balance -= transfer.amount
-        transfer.recipient.save()
+        transfer.recipient.debit(transfer.amount)
     if transfer.status is None:
         if transfer.sender:
-            transfer.sender.balance += transfer.amount
-            transfer.sender.save()
+            transfer.sender.credit(transfer.amount)
         if transfer.club:
-            transfer.club.balance += transfer.amount
-            transfer.club.save()
+            transfer.club.credit(transfer.amount)
     transfer.status = STATUS_CANCELLED
     transfer.save()
     return transfer
@@ -313,10 +369,14 @@ def cancel_transfer(transfer_id: int) -> Transfer:
 def make_game_editor(user_id: int) -> Union[User, int]:
     if not user_id or not User.objects.filter(pk=user_id).exists():
         return False
-    return User.objects.filter(pk=user_id).update(game_editor=True)
+    updated = User.objects.filter(pk=user_id).update(game_editor=True)
+    invalidate_users(user_id)
+    return updated
 
 
 def remove_game_editor(user_id: int) -> Union[User, int]:
     if not user_id or not User.objects.filter(pk=user_id).exists():
         return False
-    return User.objects.filter(pk=user_id).update(game_editor=False)
+    updated = User.objects.filter(pk=user_id).update(game_editor=False)
+    invalidate_users(user_id)
+    return updated
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from betting.models import Bet, BetQuestion, ConfigModel, Deposit, Match, QuestionOption
+from betting.models import Bet, BetQuestion, CommissionAccrual, ConfigModel, Deposit, Match, QuestionOption, \
+    ReferralAccrual
 
 
 @admin.register(Bet)
@@ -13,6 +14,11 @@ class BetQuestionAdmin(admin.ModelAdmin):
     pass
 
 
+@admin.register(CommissionAccrual)
+class CommissionAccrualAdmin(admin.ModelAdmin):
+    list_display = ('club', 'user', 'amount', 'created_at', 'deposit')
+
+
 @admin.register(ConfigModel)
 class ConfigModelAdmin(admin.ModelAdmin):
     pass
@@ -30,4 +36,10 @@ class MatchAdmin(admin.ModelAdmin):
 
 @admin.register(QuestionOption)
 class QuestionOptionAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('option', 'rate', 'limit', 'bet_count', 'staked', 'liability')
+    readonly_fields = ('bet_count', 'staked', 'liability', 'total_bet_count', 'total_staked', 'total_to_return')
+
+
+@admin.register(ReferralAccrual)
+class ReferralAccrualAdmin(admin.ModelAdmin):
+    list_display = ('referrer', 'user', 'date', 'amount', 'bet_count', 'deposit')
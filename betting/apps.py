@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.core.management import call_command
+from django.db.models.signals import post_migrate
+
+
+def create_cache_table(using: str, *args, **kwargs):
+    # The shared cache holds the config version, a fresh database needs its table before the first lookup
+    call_command('createcachetable', database=using, verbosity=0)
 
 
 class BettingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'betting'
+
+    def ready(self):
+        post_migrate.connect(create_cache_table, sender=self)
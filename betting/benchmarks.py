@@ -0,0 +1,154 @@
+import json
+import logging
+import platform
+import statistics
+import time
+import tracemalloc
+from math import ceil
+from typing import Callable, Dict, Iterable, List
+
+import django
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from betting.actions import refund_question, select_question_winner, unselect_question_winner
+from betting.models import Bet, BetQuestion
+from betting.seeding import BenchSeeder
+
+logger = logging.getLogger(__name__)
+
+SIZES = (1000, 10000, 100000)
+ACTIONS = ('select_winner', 'unselect_winner', 'refund')
+# Relative growth of time and peak memory over the baseline tolerated before it counts as a regression
+THRESHOLD = 0.25
+
+
+def measure(function: Callable[[], object]) -> dict:
+    """
+    Run `function` once, recording wall time, queries issued and peak memory
+    allocated by Python while it ran. Tracing memory slows Python code a little,
+    the same for baseline and current runs.
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            function()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'elapsed': elapsed, 'queries': len(queries), 'peak_kb': peak / 1024}
+
+
+def build_question(bets: int, options=3, bets_per_user=10, seed=0, batch_size=5000) -> BetQuestion:
+    """A live question with `bets` bets (rounded up to whole users) spread over its options."""
+    prefix = f'settle{bets}_{int(time.time() * 1000)}_'
+    BenchSeeder(seed=seed, users=ceil(bets / bets_per_user), clubs=10, matches=1, questions_per_match=1,
+                options_per_question=options, bets_per_user=bets_per_user, bets_distribution='fixed',
+                transactions_per_user=0, prefix=prefix, batch_size=batch_size, log=logger.debug).run()
+    return BetQuestion.objects.get(match__team_a_name__startswith=prefix)
+
+
+def bench_question(question: BetQuestion, repeat=1) -> Dict[str, dict]:
+    """
+    Settle the question, take the result back `repeat` times over, then refund
+    it, so every action runs on the full set of bets.
+    """
+    winner = question.options.order_by('id').first()
+    runs = {action: [] for action in ACTIONS}
+    for _ in range(repeat):
+        runs['select_winner'].append(measure(lambda: select_question_winner(question.id, winner.id)))
+        runs['unselect_winner'].append(measure(lambda: unselect_question_winner(question.id)))
+    runs['refund'].append(measure(lambda: refund_question(question.id)))
+    return {action: summarize(results) for action, results in runs.items()}
+
+
+def summarize(results: List[dict]) -> dict:
+    """Median time, most queries and highest peak over repeated runs."""
+    return {
+        'runs': len(results),
+        'elapsed': statistics.median(result['elapsed'] for result in results),
+        'elapsed_min': min(result['elapsed'] for result in results),
+        'queries': max(result['queries'] for result in results),
+        'peak_kb': max(result['peak_kb'] for result in results),
+    }
+
+
+def run_benchmarks(sizes: Iterable[int] = SIZES, options=3, repeat=1, seed=0,
+                   log: Callable[[str], None] = None) -> dict:
+    """Benchmark the settlement actions on a fresh question of every size."""
+    log = log or logger.info
+    results = {}
+    for size in sizes:
+        started = time.perf_counter()
+        question = build_question(size, options=options, seed=seed)
+        bets = Bet.objects.filter(bet_question=question).count()
+        log(f'Built question {question.id} with {bets} bets in {time.perf_counter() - started:.2f}s')
+        actions = bench_question(question, repeat=repeat)
+        for action, result in actions.items():
+            log(f"{size:>8} {action:<16} {result['elapsed'] * 1000:10.1f}ms {result['queries']:>5} queries "
+                f"{result['peak_kb']:10.1f}KB peak")
+        results[str(size)] = {'bets': bets, 'actions': actions}
+    return {
+        'created_at': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'database_version': database_version(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'options': options,
+        'repeat': repeat,
+        'sizes': results,
+    }
+
+
+def database_version() -> str:
+    """Server version of the default database, from its driver when the backend does not tell."""
+    if connection.vendor == 'mysql':
+        return '.'.join(map(str, connection.mysql_version))
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version
+    if connection.vendor == 'postgresql':
+        # 130004 is 13.4, 90603 is 9.6.3
+        major, minor = divmod(connection.pg_version, 10000)
+        return f'{major}.{minor}' if major >= 10 else f'{major}.{minor // 100}.{minor % 100}'
+    connection.ensure_connection()
+    return str(getattr(connection.connection, 'server_version', None) or getattr(connection.connection, 'version', ''))
+
+
+def compare(report: dict, baseline: dict, threshold=THRESHOLD) -> List[str]:
+    """
+    Regressions of `report` against `baseline`, for sizes and actions both have:
+    time or peak memory grown beyond the threshold, or any extra query since
+    the queries of a size only change with the code.
+    """
+    regressions = []
+    if report.get('database') != baseline.get('database'):
+        logger.warning('Comparing %s results with a %s baseline', report.get('database'), baseline.get('database'))
+    for size, current in report['sizes'].items():
+        previous = baseline.get('sizes', {}).get(size)
+        if previous is None:
+            continue
+        for action, result in current['actions'].items():
+            before = previous['actions'].get(action)
+            if before is None:
+                continue
+            for metric in ('elapsed', 'peak_kb'):
+                if result[metric] > before[metric] * (1 + threshold):
+                    regressions.append(f'{size} bets {action}: {metric} {result[metric]:.3f} '
+                                       f'over baseline {before[metric]:.3f}')
+            if result['queries'] > before['queries']:
+                regressions.append(f"{size} bets {action}: {result['queries']} queries "
+                                   f"over baseline {before['queries']}")
+    return regressions
+
+
+def load_report(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_report(report: dict, path: str) -> None:
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
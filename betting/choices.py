@@ -108,6 +108,7 @@ A_QUESTION_END_NOW = 'end_now_question'
 A_QUESTION_SELECT_WINNER = 'select_winner_question'
 A_QUESTION_UNSELECT_WINNER = 'unselect_winner_question'
 A_QUESTION_REFUND = 'refund_question'
+A_MATCH_REFUND = 'refund_match'
 A_MAKE_GAME_EDITOR = 'make_game_editor'
 A_REMOVE_GAME_EDITOR = 'remove_game_editor'
 A_REFUND_BET = 'refund_bet'
@@ -0,0 +1,118 @@
+import threading
+import time
+from typing import Dict, Optional, Union
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+
+from .models import ConfigModel, default_configs
+
+CONFIG_VERSION_KEY = 'betting:config-version'
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def _to_number(value: str) -> Optional[Union[int, float]]:
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class ConfigSnapshot:
+    """
+    Every ConfigModel row loaded with one query. Numeric values are parsed once
+    so validators can read them without touching the database.
+    """
+
+    def __init__(self, values: Dict[str, str], version: str):
+        self.values = values
+        self.numbers = {name: _to_number(value) for name, value in values.items()}
+        self.version = version
+        self.checked = time.monotonic()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.values
+
+    def get(self, name: str) -> str:
+        return self.values[name]
+
+    def get_float(self, name: str) -> float:
+        number = self.numbers[name]
+        if number is None:
+            raise ValueError(f'Configuration {name} is not a number: {self.values[name]}')
+        return float(number)
+
+    def get_int(self, name: str) -> int:
+        return int(self.get_float(name))
+
+
+def _shared_version() -> str:
+    version = cache.get(CONFIG_VERSION_KEY)
+    if version is None:
+        cache.add(CONFIG_VERSION_KEY, get_random_string(12), None)
+        version = cache.get(CONFIG_VERSION_KEY)
+    return version
+
+
+def _load(version: str) -> ConfigSnapshot:
+    values = dict(ConfigModel.objects.values_list('name', 'value'))
+    missing = [ConfigModel(name=name, value=str(value)) for name, value in default_configs.items()
+               if name not in values]
+    if missing:
+        ConfigModel.objects.bulk_create(missing, ignore_conflicts=True)
+        values.update({config.name: config.value for config in missing})
+    return ConfigSnapshot(values, version)
+
+
+def get_snapshot() -> ConfigSnapshot:
+    """
+    Return the process wide snapshot. The shared version is read at most once
+    every CONFIG_VERSION_CHECK_INTERVAL seconds, the snapshot is reloaded when
+    another worker bumped it since it was loaded.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    interval = getattr(settings, 'CONFIG_VERSION_CHECK_INTERVAL', 5)
+    if snapshot is not None and time.monotonic() - snapshot.checked < interval:
+        return snapshot
+    version = _shared_version()
+    with _lock:
+        snapshot = _snapshot
+        if snapshot is None or snapshot.version != version:
+            snapshot = _snapshot = _load(version)
+        else:
+            snapshot.checked = time.monotonic()
+    return snapshot
+
+
+def invalidate_config() -> None:
+    global _snapshot
+    _snapshot = None
+    cache.set(CONFIG_VERSION_KEY, get_random_string(12), None)
+
+
+def config_value(name: str, default=False) -> str:
+    snapshot = get_snapshot()
+    if name in snapshot:
+        return snapshot.get(name)
+    value = str(default or default_configs[name])
+    ConfigModel.objects.get_or_create(name=name, defaults={'value': value})
+    return value
+
+
+def config_float(name: str) -> float:
+    snapshot = get_snapshot()
+    if name in snapshot:
+        return snapshot.get_float(name)
+    return float(config_value(name))
+
+
+def config_int(name: str) -> int:
+    return int(config_float(name))
@@ -0,0 +1,67 @@
+from datetime import date, datetime, time, timedelta
+from typing import Tuple
+
+from django.utils import timezone
+
+WINDOW_DAY = 'day'
+WINDOW_MONTH = 'month'
+WINDOW_YEAR = 'year'
+WINDOW_ROLLING = 'rolling'
+WINDOW_LABELS = {
+    WINDOW_DAY: 'day',
+    WINDOW_MONTH: 'month',
+    WINDOW_YEAR: 'year',
+    WINDOW_ROLLING: '24 hours',
+}
+ROLLING_PERIOD = timedelta(hours=24)
+
+
+def local_midnight(day: date) -> datetime:
+    """Start of the day in the current time zone."""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def window_bounds(window: str, now: datetime = None) -> Tuple[datetime, datetime]:
+    """
+    Start and end of the window holding `now`. Day, month and year follow the
+    calendar of the current time zone, rolling is the last 24 hours.
+    """
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    if window == WINDOW_DAY:
+        return local_midnight(today), local_midnight(today + timedelta(days=1))
+    if window == WINDOW_MONTH:
+        first = today.replace(day=1)
+        return local_midnight(first), local_midnight((first + timedelta(days=32)).replace(day=1))
+    if window == WINDOW_YEAR:
+        return local_midnight(date(today.year, 1, 1)), local_midnight(date(today.year + 1, 1, 1))
+    if window == WINDOW_ROLLING:
+        return now - ROLLING_PERIOD, now
+    raise ValueError(f'Unknown window {window}')
+
+
+class RateCounter:
+    """
+    Number of `model` rows an account (the `field` foreign key) created in a
+    window, counted with a `time_field` range query on the (field, time_field)
+    index. Counted in the database on every check so limits hold across worker
+    processes, and rows of a transaction rolled back are not counted.
+    """
+
+    def __init__(self, model, field='user', window=WINDOW_DAY, time_field='created_at'):
+        window_bounds(window)  # Fails early on unknown windows
+        self.model = model
+        self.field = field
+        self.window = window
+        self.time_field = time_field
+
+    def queryset(self, account_id, start: datetime, end: datetime):
+        return self.model.objects.filter(**{self.field: account_id, f'{self.time_field}__gte': start,
+                                            f'{self.time_field}__lt': end})
+
+    def count(self, account, now: datetime = None) -> int:
+        account_id = getattr(account, 'pk', account)
+        if account_id is None:
+            return 0
+        start, end = window_bounds(self.window, now)
+        return self.queryset(account_id, start, end).count()
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+from typing import Iterable, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from betting.models import BetQuestion, Match, MarketEvent, QuestionOption
+
+logger = logging.getLogger(__name__)
+
+# Fields pushed to live clients, the ones the match list shows changing
+TRACKED_FIELDS = {
+    Match: ('status', 'score', 'start_time'),
+    BetQuestion: ('status', 'winner'),
+    QuestionOption: ('rate', 'hidden', 'option'),
+}
+MODEL_NAMES = {Match: 'match', BetQuestion: 'question', QuestionOption: 'option'}
+QUEUE_SIZE = 1000
+# Seconds an event id skipped by a poll is looked for again, its insert may not have committed yet
+GAP_TIMEOUT = 10
+# Skipped ids looked for again at most, after a larger jump of the ids
+MAX_GAPS = 1000
+
+
+class Subscription:
+    """
+    Messages waiting for one client, read from the event loop it subscribed
+    in. A client too slow to keep up gets a resync message instead of the
+    messages it missed, and should fetch the match list again.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, size: int):
+        self.loop = loop
+        self.queue = asyncio.Queue(size)
+
+    def deliver(self, text: str) -> None:
+        """Queue a message, from any thread."""
+        self.loop.call_soon_threadsafe(self._put, text)
+
+    def _put(self, text: str) -> None:
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(json.dumps({'type': 'resync'}))
+
+    async def get(self) -> str:
+        return await self.queue.get()
+
+
+class InProcessBroker:
+    """
+    Fans market deltas out to the clients connected to this process. Deltas
+    are published where rows are saved, so with several server processes set
+    MARKET_BROKER to DatabaseBroker instead.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscriptions = set()
+        self.last_seq = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        """Whether anyone listens, nothing is built or sent otherwise."""
+        return bool(self.subscriptions)
+
+    def subscribe(self) -> Subscription:
+        """Subscribe from a running event loop."""
+        subscription = Subscription(asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    async def wait_started(self) -> None:
+        """Wait until last_seq is current, it always is in this process."""
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, message: dict) -> int:
+        """Number the message and send it to every subscriber, encoded once. Returns its seq."""
+        with self._lock:
+            self.last_seq += 1
+            seq = self.last_seq
+        self.deliver(json.dumps(dict(message, seq=seq), cls=DjangoJSONEncoder))
+        return seq
+
+    def deliver(self, text: str) -> None:
+        """Send an encoded message to every subscriber of this process."""
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.deliver(text)
+            except RuntimeError:  # Its event loop is closed
+                self.unsubscribe(subscription)
+
+
+class DatabaseBroker(InProcessBroker):
+    """
+    Shares deltas between server processes through the MarketEvent table, so
+    a row saved by one web worker reaches the clients of every worker.
+    publish inserts a row whose id is the seq. The first subscription of a
+    process starts a thread reading rows past the last one seen every
+    MARKET_POLL_INTERVAL seconds and delivering them to that process's
+    clients. Rows older than MARKET_EVENT_RETENTION seconds are deleted by
+    publishers and readers alike, at most every tenth of it per process.
+    """
+    # Publishers can not see the clients of other processes
+    active = True
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        super().__init__(queue_size)
+        self.interval = getattr(settings, 'MARKET_POLL_INTERVAL', 0.5)
+        self.retention = getattr(settings, 'MARKET_EVENT_RETENTION', 3600)
+        # Skipped event ids and when they were first missed
+        self.gaps = {}
+        self._pruned = float('-inf')
+        self._started = threading.Event()
+        self._poller = None
+
+    def publish(self, message: dict) -> int:
+        seq = MarketEvent.objects.create(message=json.dumps(message, cls=DjangoJSONEncoder)).pk
+        try:
+            self.prune_due()
+        except DatabaseError:
+            logger.exception('Pruning market events failed')
+        return seq
+
+    def subscribe(self) -> Subscription:
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self.run, name='market-broker', daemon=True)
+                self._poller.start()
+        return super().subscribe()
+
+    async def wait_started(self) -> None:
+        # Once per process, so the hello message of the first clients carries the current seq
+        if not self._started.is_set():
+            await sync_to_async(self._started.wait, thread_sensitive=False)(self.interval * 2)
+
+    def start(self) -> None:
+        """Start from the latest event, clients fetch the match list for what happened before."""
+        self.last_seq = MarketEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def poll(self) -> int:
+        """
+        Deliver the events stored since the last poll. Ids skipped on the way
+        belong to inserts that may commit after later ones, they are read again
+        for GAP_TIMEOUT seconds and delivered late. Returns how many were.
+        """
+        now = time.monotonic()
+        self.gaps = {seq: since for seq, since in self.gaps.items() if now - since < GAP_TIMEOUT}
+        events = list(MarketEvent.objects.filter(Q(id__gt=self.last_seq) | Q(id__in=list(self.gaps)))
+                      .order_by('id').values_list('id', 'message'))
+        for seq, text in events:
+            if seq > self.last_seq:
+                self.gaps.update(dict.fromkeys(range(max(self.last_seq + 1, seq - MAX_GAPS), seq), now))
+                self.last_seq = seq
+            else:
+                self.gaps.pop(seq, None)
+            self.deliver(json.dumps(dict(json.loads(text), seq=seq)))
+        return len(events)
+
+    def prune(self) -> int:
+        cutoff = timezone.now() - timedelta(seconds=self.retention)
+        return MarketEvent.objects.filter(created_at__lt=cutoff).delete()[0]
+
+    def prune_due(self) -> int:
+        """Prune unless this process did less than a tenth of the retention ago."""
+        with self._lock:
+            if time.monotonic() - self._pruned < self.retention / 10:
+                return 0
+            self._pruned = time.monotonic()
+        return self.prune()
+
+    def run(self) -> None:
+        while True:
+            try:
+                if not self._started.is_set():
+                    self.start()
+                    self._started.set()
+                self.poll()
+                self.prune_due()
+            except DatabaseError:
+                logger.exception('Reading market events failed')
+            finally:
+                close_old_connections()
+            time.sleep(self.interval)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(getattr(settings, 'MARKET_BROKER', 'betting.live.InProcessBroker'))()
+
+
+def publish(model, pk, changes: dict, **extra) -> None:
+    """Publish a delta once the current transaction commits, right away outside one."""
+    if not get_broker().active:
+        return
+    message = {'type': 'delta', 'model': MODEL_NAMES[model], 'id': pk, 'changes': changes, **extra}
+    transaction.on_commit(lambda: get_broker().publish(message))
+
+
+def publish_saved(instance, created: bool, update_fields: Optional[Iterable[str]] = None) -> None:
+    """Delta of the tracked fields of a saved row, nothing if none of them was saved."""
+    model = type(instance)
+    fields = TRACKED_FIELDS[model]
+    if update_fields is not None:
+        fields = [field for field in fields if field in update_fields]
+        if not fields:
+            return
+    extra = {'created': True} if created else {}
+    if model is BetQuestion:
+        extra['match'] = instance.match_id
+    # Foreign keys are sent as ids under the field name
+    changes = {field: getattr(instance, model._meta.get_field(field).attname) for field in fields}
+    publish(model, instance.pk, changes, **extra)
+
+
+def publish_updated(model, pks: Iterable[int], **values) -> None:
+    """Deltas for rows changed by a bulk update, which sends no signals."""
+    if not get_broker().active or not any(field in TRACKED_FIELDS[model] for field in values):
+        return
+    for pk in list(pks):
+        publish(model, pk, values)
+
+
+def publish_deleted(instance) -> None:
+    publish(type(instance), instance.pk, {}, deleted=True)
+
+
+def publish_options_changed(question_id: int, added=(), removed=()) -> None:
+    changes = {}
+    if added:
+        changes['added_options'] = sorted(added)
+    if removed:
+        changes['removed_options'] = sorted(removed)
+    if changes:
+        publish(BetQuestion, question_id, changes)
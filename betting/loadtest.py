@@ -0,0 +1,341 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List
+
+from django.db import connection, connections, transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from betting.choices import A_QUESTION_SELECT_WINNER, METHOD_BKASH, STATUS_PAID, STATUS_REFUNDED
+from betting.config import config_float
+from betting.models import Bet, BetQuestion, CommissionAccrual, Deposit, Match, QuestionOption, ReferralAccrual
+from betting.seeding import BenchSeeder
+from users.models import Club, User, recount_club_totals
+
+logger = logging.getLogger(__name__)
+
+# One request of a scenario, `token` of None is an anonymous request
+RequestSpec = namedtuple('RequestSpec', 'label method path token data')
+# Outcome of one request, queries is None when they can not be counted
+Result = namedtuple('Result', 'label status latency queries')
+
+BALANCE = 1_000_000
+
+
+class ClientTransport:
+    """Runs requests in process through the Django test client, counting the queries of each."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __call__(self, spec: RequestSpec) -> Result:
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            # Failures are reported as 500 responses instead of ending the run
+            client = self.local.client = Client(raise_request_exception=False)
+        headers = {'HTTP_x-auth-token': spec.token} if spec.token else {}
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            if spec.method == 'get':
+                response = client.get(spec.path, spec.data or {}, **headers)
+            else:
+                response = client.post(spec.path, spec.data or {}, content_type='application/json', **headers)
+        return Result(spec.label, response.status_code, time.perf_counter() - started, len(queries))
+
+
+class HttpTransport:
+    """Runs requests against a running server with one requests session per thread."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self.local = threading.local()
+
+    def __call__(self, spec: RequestSpec) -> Result:
+        import requests
+
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        headers = {'x-auth-token': spec.token} if spec.token else {}
+        started = time.perf_counter()
+        try:
+            if spec.method == 'get':
+                response = session.get(self.url + spec.path, params=spec.data, headers=headers, timeout=60)
+            else:
+                response = session.post(self.url + spec.path, json=spec.data or {}, headers=headers, timeout=60)
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        return Result(spec.label, status, time.perf_counter() - started, None)
+
+
+_process_transport = None
+
+
+def _start_process(url):
+    # Connections inherited from the parent must not be shared with it
+    global _process_transport
+    connections.close_all()
+    _process_transport = HttpTransport(url) if url else ClientTransport()
+
+
+def _run_in_process(spec: RequestSpec) -> Result:
+    return _process_transport(spec)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def is_throwaway_database() -> bool:
+    """Whether the default database is SQLite, the only one a run is let to fill without asking."""
+    return connection.vendor == 'sqlite'
+
+
+class LoadData:
+    """Users with tokens, a superuser and one live question, created for a run and deleted by clean_up."""
+
+    def __init__(self, users: int, options: int, seed: int):
+        from api.serializers import jwt_from_user
+
+        self.prefix = prefix = f'load{int(time.time() * 1000)}_'
+        BenchSeeder(seed=seed, users=users, clubs=max(1, users // 100), matches=1, questions_per_match=1,
+                    options_per_question=options, bets_per_user=0, transactions_per_user=0, prefix=prefix,
+                    log=logger.debug).run()
+        members = User.objects.filter(username__startswith=prefix)
+        members.update(balance=BALANCE)
+        recount_club_totals(Club.objects.filter(username__startswith=prefix))
+        self.users = list(members.order_by('id'))
+        self.tokens = [jwt_from_user(user) for user in self.users]
+        # Only its token logs in, it stops working once clean_up deletes the user
+        admin = User.objects.create_superuser(username=f'{prefix}admin', email=f'{prefix}admin@bench.local',
+                                              phone=f'{prefix}admin', password=None)
+        self.admin_token = jwt_from_user(admin)
+        self.question = BetQuestion.objects.filter(match__team_a_name__startswith=prefix).get()
+        self.options = list(self.question.options.order_by('id'))
+        self.balance_before = self.total_balance()
+        self.last_bet = Bet.objects.aggregate(last=Max('id'))['last'] or 0
+
+    def members(self):
+        return User.objects.filter(pk__in=[user.pk for user in self.users])
+
+    def total_balance(self) -> float:
+        return self.members().aggregate(Sum('balance'))['balance__sum']
+
+    def new_bets(self):
+        return Bet.objects.filter(pk__gt=self.last_bet, user__in=self.users)
+
+    def clean_up(self) -> None:
+        """Delete the users, admin, clubs and market of the run with their bets, deposits and accruals."""
+        users = User.objects.filter(username__startswith=self.prefix)
+        clubs = Club.objects.filter(username__startswith=self.prefix)
+        matches = Match.objects.filter(team_a_name__startswith=self.prefix)
+        options = list(QuestionOption.objects.filter(betquestion__match__in=matches).values_list('id', flat=True))
+        with transaction.atomic():
+            CommissionAccrual.objects.filter(club__in=clubs).delete()
+            ReferralAccrual.objects.filter(Q(referrer__in=users) | Q(user__in=users)).delete()
+            Deposit.objects.filter(Q(user__in=users) | Q(club__in=clubs)).delete()
+            users.delete()
+            matches.delete()
+            QuestionOption.objects.filter(pk__in=options).delete()
+            clubs.delete()
+
+
+class Scenario:
+    name = ''
+    description = ''
+
+    def __init__(self, data: LoadData, requests: int, rng: random.Random):
+        self.data = data
+        self.requests = requests
+        self.rng = rng
+
+    def bet(self) -> RequestSpec:
+        index = self.rng.randrange(len(self.data.users))
+        option = self.rng.choice(self.data.options)
+        return RequestSpec('bet', 'post', '/api/bet/', self.data.tokens[index],
+                           {'bet_question': self.data.question.id, 'choice': option.id,
+                            'amount': self.rng.choice([10, 50, 100, 500])})
+
+    def specs(self) -> Iterable[RequestSpec]:
+        raise NotImplementedError
+
+    def invariants(self) -> Dict[str, dict]:
+        """Name to {'ok': bool, ...details} of every check run after the load."""
+        bets = self.data.new_bets()
+        staked = bets.aggregate(Sum('amount'))['amount__sum'] or 0
+        paid = bets.filter(status=STATUS_PAID, is_winner=True).aggregate(Sum('win_amount'))['win_amount__sum'] or 0
+        after = self.data.total_balance()
+        expected = self.data.balance_before - staked + paid
+        checks = {
+            'balance_conserved': {'ok': abs(after - expected) < 0.01, 'before': self.data.balance_before,
+                                  'staked': staked, 'paid': paid, 'after': after, 'expected': expected},
+        }
+        floor = config_float('min_balance')
+        lowest = self.data.members().aggregate(Min('balance'))['balance__min']
+        checks['balance_floor_kept'] = {'ok': lowest >= floor - 0.01, 'lowest': lowest, 'floor': floor}
+        mismatched = []
+        for option in QuestionOption.objects.filter(pk__in=[option.pk for option in self.data.options]):
+            live = option.bet_set.exclude(status=STATUS_REFUNDED)
+            totals = live.aggregate(count=Count('id'), staked=Sum('amount'),
+                                    liability=Sum('win_amount', filter=~Q(status=STATUS_PAID)))
+            totals.update(option.bet_set.aggregate(total_count=Count('id'), total_staked=Sum('amount'),
+                                                   total_to_return=Sum('win_amount')))
+            if (option.bet_count != totals['count'] or abs(option.staked - (totals['staked'] or 0)) > 0.01
+                    or abs(option.liability - (totals['liability'] or 0)) > 0.01
+                    or option.total_bet_count != totals['total_count']
+                    or abs(option.total_staked - (totals['total_staked'] or 0)) > 0.01
+                    or abs(option.total_to_return - (totals['total_to_return'] or 0)) > 0.01):
+                mismatched.append(option.id)
+        checks['option_counters_match'] = {'ok': not mismatched, 'mismatched': mismatched}
+        return checks
+
+
+class BetStorm(Scenario):
+    name = 'bet_storm'
+    description = 'Every request places a bet on the same question'
+
+    def specs(self):
+        return [self.bet() for _ in range(self.requests)]
+
+
+class MixedWorkload(Scenario):
+    name = 'mixed'
+    description = 'Browsing matches and bets, placing bets and requesting deposits'
+
+    def specs(self):
+        specs = []
+        for _ in range(self.requests):
+            draw = self.rng.random()
+            token = self.rng.choice(self.data.tokens)
+            if draw < 0.3:
+                specs.append(RequestSpec('matches', 'get', '/api/match/', None, None))
+            elif draw < 0.5:
+                specs.append(RequestSpec('my bets', 'get', '/api/bet/', token, None))
+            elif draw < 0.6:
+                specs.append(RequestSpec('notifications', 'get', '/api/notification/', token, None))
+            elif draw < 0.9:
+                specs.append(self.bet())
+            else:
+                specs.append(RequestSpec('deposit', 'post', '/api/deposit/', token,
+                                         {'amount': 500, 'method': METHOD_BKASH, 'user_account': '01700000000',
+                                          'site_account': '01800000000', 'reference': 'load'}))
+        return specs
+
+
+class SettleDuringBetting(Scenario):
+    name = 'settle_race'
+    description = 'Bets keep coming while the question is settled half way through'
+
+    def specs(self):
+        specs = [self.bet() for _ in range(self.requests)]
+        winner = self.rng.choice(self.data.options)
+        specs.insert(len(specs) // 2, RequestSpec('settle', 'post', '/api/actions/', self.data.admin_token,
+                                                  {'action_code': A_QUESTION_SELECT_WINNER,
+                                                   'question_id': self.data.question.id, 'option_id': winner.id}))
+        return specs
+
+    def invariants(self):
+        checks = super().invariants()
+        question = BetQuestion.objects.get(pk=self.data.question.pk)
+        open_bets = self.data.new_bets().exclude(status__in=[STATUS_PAID, STATUS_REFUNDED]).count()
+        checks['all_bets_settled'] = {'ok': question.winner_id is not None and not open_bets,
+                                      'winner': question.winner_id, 'open_bets': open_bets}
+        return checks
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (BetStorm, MixedWorkload, SettleDuringBetting)}
+
+
+def run_load(scenario: str, requests=1000, workers=8, pool='thread', users=100, options=2, seed=0,
+             url: str = None, keep=False, log: Callable[[str], None] = None) -> dict:
+    """
+    Build a fresh question and users, run the scenario's requests on a pool of
+    `workers` threads or processes (inline when 0) and return the report with
+    throughput, latency percentiles per request label, query counts and invariants.
+    The data of the run is deleted afterwards unless `keep` is set.
+    """
+    log = log or logger.info
+    data = LoadData(users, options, seed)
+    try:
+        return run_scenario(SCENARIOS[scenario](data, requests, random.Random(seed)), workers, pool, url, log)
+    finally:
+        if not keep:
+            data.clean_up()
+
+
+def run_scenario(load: Scenario, workers: int, pool: str, url: str, log: Callable[[str], None]) -> dict:
+    specs = load.specs()
+    log(f'Running {len(specs)} requests of {load.name} on {workers} {pool} workers')
+    started = time.perf_counter()
+    if not workers:
+        transport = HttpTransport(url) if url else ClientTransport()
+        results = [transport(spec) for spec in specs]
+    elif pool == 'process':
+        connections.close_all()
+        with ProcessPoolExecutor(workers, initializer=_start_process, initargs=(url,)) as executor:
+            results = list(executor.map(_run_in_process, specs, chunksize=max(1, len(specs) // (workers * 20))))
+    else:
+        transport = HttpTransport(url) if url else ClientTransport()
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(transport, specs))
+    elapsed = time.perf_counter() - started
+    return build_report(load, results, elapsed, workers, pool, url)
+
+
+def build_report(load: Scenario, results: List[Result], elapsed: float, workers, pool, url) -> dict:
+    by_label = defaultdict(list)
+    for result in results:
+        by_label[result.label].append(result)
+    labels = {}
+    for label, rows in by_label.items():
+        latencies = [row.latency * 1000 for row in rows]
+        queries = [row.queries for row in rows if row.queries is not None]
+        labels[label] = {
+            'requests': len(rows),
+            'statuses': dict(Counter(row.status for row in rows)),
+            'p50_ms': percentile(latencies, 50),
+            'p90_ms': percentile(latencies, 90),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': max(latencies),
+            'queries_avg': sum(queries) / len(queries) if queries else None,
+            'queries_max': max(queries) if queries else None,
+        }
+    invariants = load.invariants()
+    return {
+        'scenario': load.name,
+        'transport': url or 'client',
+        'pool': pool,
+        'workers': workers,
+        'requests': len(results),
+        'errors': sum(result.status >= 500 or result.status == 0 for result in results),
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else 0,
+        'labels': labels,
+        'invariants': invariants,
+        'ok': all(check['ok'] for check in invariants.values()),
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [f"{report['scenario']}: {report['requests']} requests in {report['elapsed']:.2f}s, "
+             f"{report['throughput']:.1f} req/s, {report['errors']} errors "
+             f"({report['workers']} {report['pool']} workers, {report['transport']})"]
+    for label, row in report['labels'].items():
+        queries = ('' if row['queries_avg'] is None
+                   else f", queries avg {row['queries_avg']:.1f} max {row['queries_max']}")
+        lines.append(f"  {label:<14} {row['requests']:>6}  p50 {row['p50_ms']:.1f}ms  p90 {row['p90_ms']:.1f}ms  "
+                     f"p99 {row['p99_ms']:.1f}ms  max {row['max_ms']:.1f}ms  {json.dumps(row['statuses'])}{queries}")
+    for name, check in report['invariants'].items():
+        details = ', '.join(f'{key}={value}' for key, value in check.items() if key != 'ok')
+        lines.append(f"  {'ok' if check['ok'] else 'FAILED':<6} {name}: {details}")
+    return '\n'.join(lines)
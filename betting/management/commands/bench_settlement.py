@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from betting.benchmarks import SIZES, THRESHOLD, compare, load_report, run_benchmarks, write_report
+
+
+class Command(BaseCommand):
+    help = ('Time select winner, unselect winner and refund on questions of each size, with queries and peak '
+            'memory. Creates its data, run it on a throwaway database (DB_ENGINE=sqlite or a local MySQL)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help='Comma separated bet counts')
+        parser.add_argument('--options', type=int, default=3, help='Options of each question')
+        parser.add_argument('--repeat', type=int, default=1, help='Select and unselect cycles per size')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='JSON report to compare with, fails on regressions')
+        parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                            help='Relative growth of time or memory counted as a regression')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError(f"Invalid sizes {options['sizes']}")
+        baseline = load_report(options['baseline']) if options['baseline'] else None
+        report = run_benchmarks(sizes, options=options['options'], repeat=options['repeat'], seed=options['seed'],
+                                log=self.stdout.write)
+        if options['output']:
+            write_report(report, options['output'])
+        if baseline is None:
+            return
+        regressions = compare(report, baseline, options['threshold'])
+        for regression in regressions:
+            self.stderr.write(regression)
+        if regressions:
+            raise CommandError(f'{len(regressions)} regressions over the baseline')
+        self.stdout.write(self.style.SUCCESS('No regressions over the baseline'))
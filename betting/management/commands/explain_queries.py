@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from betting.models import BetQuestion
+from betting.query_plans import hot_queries, uses_index
+from users.models import Club, User
+
+
+class Command(BaseCommand):
+    help = 'Explain and time the hot queries, checking each is planned with the index meant for it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='User id, the user with most bets by default')
+        parser.add_argument('--club', type=int, help='Club id, the club of the user by default')
+        parser.add_argument('--question', type=int, help='Question id, the latest question by default')
+        parser.add_argument('--repeat', type=int, default=20, help='Times each query is run for timing')
+        parser.add_argument('--limit', type=int, default=50, help='Rows fetched per run, a page of the list')
+        parser.add_argument('--plans', action='store_true', help='Print the full plan of every query')
+
+    def handle(self, *args, **options):
+        user = self.pick(User, options['user'], User.objects.order_by('-userclubinfo__total_bet'))
+        club = self.pick(Club, options['club'] or user.user_club_id, Club.objects.all())
+        question = self.pick(BetQuestion, options['question'], BetQuestion.objects.order_by('-id'))
+        missing = []
+        for label, queryset, index in hot_queries(user, club, question):
+            used, plan = uses_index(queryset, index)
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                list(queryset[:options['limit']])
+            elapsed = (time.perf_counter() - started) / max(options['repeat'], 1) * 1000
+            status = 'ok' if used else 'MISSING'
+            self.stdout.write(f'{label:<18} {index:<30} {status:<8} {elapsed:8.3f}ms')
+            if options['plans'] or not used:
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+            if not used:
+                missing.append(label)
+        if missing:
+            raise CommandError(f'Planned without their index: {", ".join(missing)}')
+
+    @staticmethod
+    def pick(model, pk, default):
+        instance = model.objects.filter(pk=pk).first() if pk else default.first()
+        if instance is None:
+            raise CommandError(f'No {model._meta.verbose_name} to explain queries with, run seed_bench first')
+        return instance
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from betting.accruals import flush_commissions, flush_referrals
+
+
+class Command(BaseCommand):
+    help = 'Pay pending club commission and referral accruals into balances'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running and flush every INTERVAL seconds, flush once if not given')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            report = flush_commissions()
+            self.stdout.write(f"Flushed {report['accruals']} commission accruals of {report['clubs']} clubs "
+                              f"in {report['elapsed']:.3f}s")
+            report = flush_referrals()
+            self.stdout.write(f"Flushed {report['accruals']} referral accruals of {report['referrers']} referrers "
+                              f"in {report['elapsed']:.3f}s")
+            if not interval:
+                break
+            time.sleep(interval)
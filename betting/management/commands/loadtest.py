@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from betting.loadtest import SCENARIOS, format_report, is_throwaway_database, run_load
+
+
+class Command(BaseCommand):
+    help = ('Run a concurrent load scenario and report throughput, latency, queries and balance invariants. '
+            'Creates its users, superuser and market and deletes them afterwards, only runs on SQLite '
+            '(DB_ENGINE=sqlite) unless --force is given')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent workers, 0 runs requests inline')
+        parser.add_argument('--pool', choices=('thread', 'process'), default='thread')
+        parser.add_argument('--users', type=int, default=100, help='Users created for the run')
+        parser.add_argument('--options', type=int, default=2, help='Options of the question under load')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--url', help='Base url of a running server, the in process test client if not given')
+        parser.add_argument('--json', dest='json_path', help='Also write the report to this file')
+        parser.add_argument('--keep', action='store_true', help='Keep the data of the run')
+        parser.add_argument('--force', action='store_true', help='Run on a database other than SQLite')
+
+    def handle(self, *args, **options):
+        if not options['force'] and not is_throwaway_database():
+            raise CommandError('Refusing to create load data outside SQLite, use a throwaway database '
+                               '(DB_ENGINE=sqlite) or pass --force')
+        report = run_load(options['scenario'], requests=options['requests'], workers=options['workers'],
+                          pool=options['pool'], users=options['users'], options=options['options'],
+                          seed=options['seed'], url=options['url'], keep=options['keep'], log=self.stdout.write)
+        self.stdout.write(format_report(report))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as file:
+                json.dump(report, file, indent=2, default=str)
+        if not report['ok']:
+            raise CommandError('Invariants failed')
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from betting.seeding import BenchSeeder, DISTRIBUTIONS
+
+
+class Command(BaseCommand):
+    help = 'Bulk insert a deterministic synthetic dataset of clubs, users, matches, bets and transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, same seed and options same data')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--clubs', type=int, default=10)
+        parser.add_argument('--matches', type=int, default=20)
+        parser.add_argument('--questions-per-match', default='1:3', help='Count or inclusive LOW:HIGH range')
+        parser.add_argument('--options-per-question', default='2:4', help='Count or inclusive LOW:HIGH range')
+        parser.add_argument('--bets-per-user', type=float, default=10, help='Mean bets of a user')
+        parser.add_argument('--bets-distribution', choices=DISTRIBUTIONS, default='exponential')
+        parser.add_argument('--transactions-per-user', type=float, default=2,
+                            help='Mean deposits, withdraws and transfers of a user')
+        parser.add_argument('--transactions-distribution', choices=DISTRIBUTIONS, default='uniform')
+        parser.add_argument('--referred', type=float, default=0.2, help='Share of users referred by another user')
+        parser.add_argument('--days', type=int, default=30, help='Rows are spread over this many past days')
+        parser.add_argument('--prefix', default='bench', help='Prefix of generated usernames and names')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        try:
+            seeder = BenchSeeder(
+                seed=options['seed'], users=options['users'], clubs=options['clubs'], matches=options['matches'],
+                questions_per_match=options['questions_per_match'],
+                options_per_question=options['options_per_question'], bets_per_user=options['bets_per_user'],
+                bets_distribution=options['bets_distribution'],
+                transactions_per_user=options['transactions_per_user'],
+                transactions_distribution=options['transactions_distribution'], referred=options['referred'],
+                days=options['days'], prefix=options['prefix'], batch_size=options['batch_size'],
+                log=self.stdout.write)
+            report = seeder.run()
+        except ValueError as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(f"Seeded in {report['elapsed']:.2f}s"))
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.7 on 2026-10-18 20:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('users', '0003_alter_user_options'),
+        ('betting', '0004_match_match_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommissionAccrual',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.FloatField(help_text='Club commission earned from the bet')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('bet', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='betting.bet')),
+                ('club', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='users.club')),
+                ('deposit', models.ForeignKey(blank=True, help_text='Deposit this accrual was paid with, empty while pending', null=True, on_delete=django.db.models.deletion.SET_NULL, to='betting.deposit')),
+                ('user', models.ForeignKey(help_text='User who made the bet', null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='commissionaccrual',
+            index=models.Index(fields=['club', 'deposit'], name='betting_com_club_id_e8b116_idx'),
+        ),
+    ]
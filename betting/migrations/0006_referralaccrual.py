@@ -0,0 +1,39 @@
+# Generated by Django 3.2.7 on 2026-10-18 20:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('betting', '0005_commissionaccrual'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralAccrual',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.FloatField(default=0, help_text='Referral commission earned from the bets')),
+                ('bet_count', models.IntegerField(default=0)),
+                ('date', models.DateField(help_text='Day the bets were made')),
+                ('deposit', models.ForeignKey(blank=True, help_text='Deposit this accrual was paid with, empty while pending', null=True, on_delete=django.db.models.deletion.SET_NULL, to='betting.deposit')),
+                ('referrer', models.ForeignKey(help_text='User who earns the commission', on_delete=django.db.models.deletion.CASCADE, related_name='referral_accruals', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(help_text='Referred user who bet', on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='referralaccrual',
+            index=models.Index(fields=['referrer', 'deposit'], name='betting_ref_referre_9fa345_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralaccrual',
+            index=models.Index(fields=['user', 'date'], name='betting_ref_user_id_8c204a_idx'),
+        ),
+    ]
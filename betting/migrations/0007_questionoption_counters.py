@@ -0,0 +1,43 @@
+# Generated by Django 3.2.7 on 2026-10-18 21:06
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def fill_counters(apps, schema_editor):
+    QuestionOption = apps.get_model('betting', 'QuestionOption')
+    rows = (QuestionOption.objects.annotate(
+        total_count=Count('bet', filter=~Q(bet__status='refunded')),
+        total_staked=Sum('bet__amount', filter=~Q(bet__status='refunded')),
+        total_liability=Sum('bet__win_amount', filter=~Q(bet__status__in=['paid', 'refunded'])),
+    ).filter(total_count__gt=0))
+    for option in rows:
+        QuestionOption.objects.filter(pk=option.pk).update(bet_count=option.total_count,
+                                                           staked=option.total_staked or 0,
+                                                           liability=option.total_liability or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0006_referralaccrual'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionoption',
+            name='bet_count',
+            field=models.IntegerField(default=0, help_text='Bets on this option, refunded bets excluded'),
+        ),
+        migrations.AddField(
+            model_name='questionoption',
+            name='liability',
+            field=models.FloatField(default=0, help_text='Total win amount of bets on this option not settled yet'),
+        ),
+        migrations.AddField(
+            model_name='questionoption',
+            name='staked',
+            field=models.FloatField(default=0, help_text='Total amount bet on this option, refunded bets excluded'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
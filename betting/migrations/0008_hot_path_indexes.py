@@ -0,0 +1,53 @@
+# Generated by Django 3.2.7 on 2026-10-18 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0007_questionoption_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bet',
+            index=models.Index(fields=['user', 'created_at'], name='bet_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bet',
+            index=models.Index(fields=['bet_question', 'choice'], name='bet_question_choice_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='betquestion',
+            index=models.Index(fields=['match', 'status'], name='question_match_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(fields=['user', 'created_at'], name='deposit_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(fields=['user', 'status', 'created_at'], name='deposit_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(fields=['club', 'created_at'], name='deposit_club_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['status', 'created_at'], name='match_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['sender', 'created_at'], name='transfer_sender_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['club', 'created_at'], name='transfer_club_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdraw',
+            index=models.Index(fields=['user', 'created_at'], name='withdraw_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.7 on 2026-10-18 22:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0008_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bet',
+            index=models.Index(fields=['bet_question', 'user', 'choice'], name='bet_question_user_idx'),
+        ),
+    ]
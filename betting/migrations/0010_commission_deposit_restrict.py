@@ -0,0 +1,19 @@
+# Generated by Django 3.2.7 on 2026-10-18 23:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0009_settlement_user_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='commissionaccrual',
+            name='deposit',
+            field=models.ForeignKey(blank=True, help_text='Deposit this accrual was paid with, empty while pending', null=True, on_delete=django.db.models.deletion.RESTRICT, to='betting.deposit'),
+        ),
+    ]
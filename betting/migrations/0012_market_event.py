@@ -0,0 +1,24 @@
+# Generated by Django 3.2.7 on 2026-10-19 01:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0011_referral_deposit_restrict'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField(help_text='JSON market delta without its seq')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
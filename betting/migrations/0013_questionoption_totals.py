@@ -0,0 +1,40 @@
+# Generated by Django 3.2.7 on 2026-10-19 01:47
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_totals(apps, schema_editor):
+    QuestionOption = apps.get_model('betting', 'QuestionOption')
+    rows = (QuestionOption.objects.annotate(bets=Count('bet'), amount=Sum('bet__amount'),
+                                            to_return=Sum('bet__win_amount')).filter(bets__gt=0))
+    for option in rows:
+        QuestionOption.objects.filter(pk=option.pk).update(total_bet_count=option.bets,
+                                                           total_staked=option.amount or 0,
+                                                           total_to_return=option.to_return or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0012_market_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionoption',
+            name='total_bet_count',
+            field=models.IntegerField(default=0, help_text='Bets on this option, refunded bets included'),
+        ),
+        migrations.AddField(
+            model_name='questionoption',
+            name='total_staked',
+            field=models.FloatField(default=0, help_text='Total amount bet on this option, refunded bets included'),
+        ),
+        migrations.AddField(
+            model_name='questionoption',
+            name='total_to_return',
+            field=models.FloatField(default=0, help_text='Total win amount of bets on this option, refunded and settled bets included'),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
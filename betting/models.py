@@ -66,6 +66,7 @@ class Match(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['status', 'created_at'], name='match_status_created_idx')]
 
 
 class QuestionOption(models.Model):
@@ -74,6 +75,15 @@ class QuestionOption(models.Model):
     hidden = models.BooleanField(default=False)
     limit = models.IntegerField(default=10_000_000)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Kept in step with bets by place_bet, settlement and refunds
+    bet_count = models.IntegerField(default=0, help_text="Bets on this option, refunded bets excluded")
+    staked = models.FloatField(default=0, help_text="Total amount bet on this option, refunded bets excluded")
+    liability = models.FloatField(default=0, help_text="Total win amount of bets on this option not settled yet")
+    # Shown in the option details, only deleting a bet takes it out of these
+    total_bet_count = models.IntegerField(default=0, help_text="Bets on this option, refunded bets included")
+    total_staked = models.FloatField(default=0, help_text="Total amount bet on this option, refunded bets included")
+    total_to_return = models.FloatField(default=0, help_text="Total win amount of bets on this option, "
+                                                             "refunded and settled bets included")
 
     def __str__(self):
         return f'{self.option} {self.rate} {self.limit}'
@@ -101,6 +111,7 @@ class BetQuestion(models.Model):
     class Meta:
         verbose_name_plural = 'Bet Options'
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['match', 'status'], name='question_match_status_idx')]
 
 
 class Bet(models.Model):
@@ -118,6 +129,12 @@ class Bet(models.Model):
 
     class Meta:
         ordering = ['bet_question', '-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='bet_user_created_idx'),
+            models.Index(fields=['bet_question', 'choice'], name='bet_question_choice_idx'),
+            # Per user sums of a question's bets in settlement
+            models.Index(fields=['bet_question', 'user', 'choice'], name='bet_question_user_idx'),
+        ]
 
 
 class DepositMethod(models.Model):
@@ -148,6 +165,11 @@ class Deposit(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='deposit_user_created_idx'),
+            models.Index(fields=['user', 'status', 'created_at'], name='deposit_user_status_idx'),
+            models.Index(fields=['club', 'created_at'], name='deposit_club_created_idx'),
+        ]
 
 
 class Transfer(models.Model):
@@ -162,8 +184,15 @@ class Transfer(models.Model):
     sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, help_text="User id of transaction maker")
     status = models.CharField(max_length=20, choices=TRANSACTION_CHOICES, default=STATUS_PENDING)
 
+    # Lowest balance the sender may be left with by the debit on creation, None for unchecked
+    balance_floor = None
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['sender', 'created_at'], name='transfer_sender_created_idx'),
+            models.Index(fields=['club', 'created_at'], name='transfer_club_created_idx'),
+        ]
 
 
 class Withdraw(models.Model):
@@ -178,5 +207,49 @@ class Withdraw(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, help_text="User id of transaction maker")
     user_account = models.CharField(max_length=255, blank=True, null=True)
 
+    # Lowest balance the user may be left with by the debit on creation, None for unchecked
+    balance_floor = None
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['user', 'created_at'], name='withdraw_user_created_idx')]
+
+
+class CommissionAccrual(models.Model):
+    amount = models.FloatField(help_text="Club commission earned from the bet")
+    bet = models.ForeignKey(Bet, on_delete=models.SET_NULL, null=True, blank=True)
+    club = models.ForeignKey(Club, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Deleting the payout deposit would cancel it and leave the accruals pending, paying them again
+    deposit = models.ForeignKey(Deposit, on_delete=models.RESTRICT, null=True, blank=True,
+                                help_text="Deposit this accrual was paid with, empty while pending")
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, help_text="User who made the bet")
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['club', 'deposit'])]
+
+
+class ReferralAccrual(models.Model):
+    amount = models.FloatField(default=0, help_text="Referral commission earned from the bets")
+    bet_count = models.IntegerField(default=0)
+    date = models.DateField(help_text="Day the bets were made")
+    # Deleting the payout deposit would cancel it and leave the accruals pending, paying them again
+    deposit = models.ForeignKey(Deposit, on_delete=models.RESTRICT, null=True, blank=True,
+                                help_text="Deposit this accrual was paid with, empty while pending")
+    referrer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='referral_accruals',
+                                 help_text="User who earns the commission")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', help_text="Referred user who bet")
+
+    class Meta:
+        ordering = ['-date']
+        indexes = [models.Index(fields=['referrer', 'deposit']), models.Index(fields=['user', 'date'])]
+
+
+class MarketEvent(models.Model):
+    # The id is the seq of the delta, read by every process serving market streams
+    message = models.TextField(help_text="JSON market delta without its seq")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
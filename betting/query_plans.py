@@ -0,0 +1,48 @@
+from typing import List, Tuple
+
+from django.db.models import QuerySet
+
+from betting.choices import STATUS_LIVE, STATUS_PENDING
+from betting.counters import WINDOW_DAY, RateCounter, window_bounds
+from betting.models import Bet, BetQuestion, Deposit, Match, Transfer, Withdraw
+from users.models import Club, Notification, User
+
+NEWEST_FIRST = ('-created_at', '-id')
+
+
+def hot_queries(user: User, club: Club, question: BetQuestion) -> List[Tuple[str, QuerySet, str]]:
+    """
+    Queries the API and settlement run most, each with the name of the index
+    meant to serve it, as (label, queryset, index name).
+    """
+    # The count the daily bet limit runs
+    bets_today = RateCounter(Bet).queryset(user.pk, *window_bounds(WINDOW_DAY)).order_by()
+    option = question.options.first()
+    return [
+        ('user bets', Bet.objects.filter(user=user).order_by(*NEWEST_FIRST), 'bet_user_created_idx'),
+        ('bets today', bets_today, 'bet_user_created_idx'),
+        ('option bets', Bet.objects.filter(bet_question=question, choice=option).order_by(),
+         'bet_question_choice_idx'),
+        ('question user bets', Bet.objects.filter(bet_question=question, user=user).order_by(),
+         'bet_question_user_idx'),
+        ('user deposits', Deposit.objects.filter(user=user).order_by(*NEWEST_FIRST), 'deposit_user_created_idx'),
+        ('pending deposits', Deposit.objects.filter(user=user, status=STATUS_PENDING).order_by(*NEWEST_FIRST),
+         'deposit_user_status_idx'),
+        ('club deposits', Deposit.objects.filter(club=club).order_by(*NEWEST_FIRST), 'deposit_club_created_idx'),
+        ('user withdraws', Withdraw.objects.filter(user=user).order_by(*NEWEST_FIRST), 'withdraw_user_created_idx'),
+        ('user transfers', Transfer.objects.filter(sender=user).order_by(*NEWEST_FIRST),
+         'transfer_sender_created_idx'),
+        ('club transfers', Transfer.objects.filter(club=club).order_by(*NEWEST_FIRST), 'transfer_club_created_idx'),
+        ('notifications', Notification.objects.filter(user=user).order_by(*NEWEST_FIRST),
+         'notification_user_created_idx'),
+        ('match questions', BetQuestion.objects.filter(match_id=question.match_id, status=STATUS_LIVE),
+         'question_match_status_idx'),
+        ('live matches', Match.objects.filter(status=STATUS_LIVE).order_by(*NEWEST_FIRST), 'match_status_created_idx'),
+        ('club users', User.objects.filter(user_club=club).order_by('balance', 'id'), 'user_club_balance_idx'),
+    ]
+
+
+def uses_index(queryset: QuerySet, index: str) -> Tuple[bool, str]:
+    """Whether the database plans `queryset` with `index`, and the plan."""
+    plan = queryset.explain()
+    return index in plan, plan
@@ -0,0 +1,278 @@
+import logging
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Callable, Iterable, List, Tuple
+
+from django.contrib.auth.hashers import make_password
+from django.db.models import Max, Model
+from django.utils import timezone
+
+from betting.choices import DEPOSIT_CHOICES, GAME_CHOICES, STATUS_ACCEPTED, STATUS_LIVE, STATUS_PENDING
+from betting.config import config_float
+from betting.models import Bet, BetQuestion, Deposit, Match, QuestionOption, Transfer, Withdraw
+from users.models import Club, User, UserClubInfo, recount_club_totals
+
+logger = logging.getLogger(__name__)
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'exponential')
+PAYMENT_METHODS = [method for method, _ in DEPOSIT_CHOICES[:8]]
+GAMES = [game for game, _ in GAME_CHOICES]
+BENCH_PASSWORD = 'bench-pass'
+BET_AMOUNTS = [10, 20, 50, 100, 100, 200, 500, 1000, 5000]
+TRANSACTION_AMOUNTS = [100, 500, 1000, 2000, 5000, 10000]
+
+
+def parse_range(value) -> Tuple[int, int]:
+    """'3' or '2:5' as an inclusive (low, high) range."""
+    low, _, high = str(value).partition(':')
+    low, high = int(low), int(high or low)
+    if low < 0 or high < low:
+        raise ValueError(f'Invalid range {value}')
+    return low, high
+
+
+def sampler(rng: random.Random, mean: float, distribution: str) -> Callable[[], int]:
+    """Draws non negative counts averaging `mean` from the named distribution."""
+    if distribution == 'fixed':
+        return lambda: int(mean)
+    if distribution == 'uniform':
+        return lambda: rng.randint(0, int(2 * mean))
+    if distribution == 'exponential':
+        return lambda: int(rng.expovariate(1 / mean)) if mean > 0 else 0
+    raise ValueError(f'Unknown distribution {distribution}')
+
+
+@contextmanager
+def explicit_timestamps(*models: Model):
+    """Let bulk_create keep the created_at given instead of stamping the current time."""
+    fields = [model._meta.get_field('created_at') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def bulk_insert(model, objects: Iterable[Model], batch_size: int) -> List[int]:
+    """bulk_create that returns primary keys in insertion order, on databases that can not return them."""
+    last = model.objects.aggregate(last=Max('pk'))['last'] or 0
+    for batch in batched(objects, batch_size):
+        model.objects.bulk_create(batch)
+    return list(model.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True))
+
+
+def batched(items: Iterable, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BenchSeeder:
+    """
+    Generates a synthetic dataset with bulk inserts, bypassing signals and
+    balance changes. Everything drawn comes from one random.Random(seed), so
+    the same options and seed give the same dataset, with times counted back from `now`.
+    QuestionOption counters and UserClubInfo totals are filled to match the bets.
+    """
+
+    def __init__(self, seed=0, users=1000, clubs=10, matches=20, questions_per_match='1:3',
+                 options_per_question='2:4', bets_per_user=10.0, bets_distribution='exponential',
+                 transactions_per_user=2.0, transactions_distribution='uniform', referred=0.2, days=30,
+                 prefix='bench', batch_size=5000, now=None, log: Callable[[str], None] = None):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.clubs = clubs
+        self.matches = matches
+        self.questions_per_match = parse_range(questions_per_match)
+        self.options_per_question = parse_range(options_per_question)
+        self.bets_per_user = sampler(self.rng, bets_per_user, bets_distribution)
+        self.transactions_per_user = sampler(self.rng, transactions_per_user, transactions_distribution)
+        self.referred = referred
+        self.days = days
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.log = log or logger.info
+        self.now = now or timezone.now()
+        self.report = {}
+        self.member_totals = defaultdict(lambda: [0.0, 0.0])  # total_bet, total_commission per user
+
+    def created_at(self):
+        return self.now - timedelta(seconds=self.rng.uniform(0, self.days * 86400))
+
+    def stage(self, name: str, function: Callable[[], int]):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        self.report[name] = result
+        self.log(f'{name}: {result} rows in {elapsed:.2f}s')
+        return result
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        if User.objects.filter(username__startswith=self.prefix).exists():
+            raise ValueError(f'Users prefixed {self.prefix} exist, seed with another prefix')
+        self.stage('clubs', self.create_clubs)
+        self.stage('users', self.create_users)
+        self.stage('matches', self.create_matches)
+        self.stage('questions', self.create_questions)
+        self.stage('bets', self.create_bets)
+        self.stage('club infos', self.create_club_infos)
+        self.stage('transactions', self.create_transactions)
+        self.report['elapsed'] = time.perf_counter() - started
+        return self.report
+
+    def create_clubs(self) -> int:
+        clubs = [Club(name=f'{self.prefix} club {i}', username=f'{self.prefix}_club{i}', password=BENCH_PASSWORD,
+                      balance=self.rng.randint(0, 100000), club_commission=self.rng.choice([1, 2, 2.5, 3]))
+                 for i in range(self.clubs)]
+        self.club_ids = bulk_insert(Club, clubs, self.batch_size)
+        self.club_commission = {pk: club.club_commission for pk, club in zip(self.club_ids, clubs)}
+        return len(self.club_ids)
+
+    def create_users(self) -> int:
+        password = make_password(BENCH_PASSWORD)  # Hashed once, hashing per user would dominate
+        clubs = [self.rng.choice(self.club_ids) if self.club_ids else None for _ in range(self.users)]
+        users = (User(username=f'{self.prefix}{i}', email=f'{self.prefix}{i}@bench.local', phone=f'{self.prefix}{i}',
+                      password=password, balance=round(self.rng.uniform(0, 20000), 2), user_club_id=club_id,
+                      date_joined=self.created_at())
+                 for i, club_id in enumerate(clubs))
+        self.user_ids = bulk_insert(User, users, self.batch_size)
+        self.user_club = dict(zip(self.user_ids, clubs))
+        recount_club_totals(Club.objects.filter(username__startswith=self.prefix))
+        # Earlier users refer later ones, the way a referral tree grows
+        self.referrer = {}
+        for index, user_id in enumerate(self.user_ids[1:], 1):
+            if self.rng.random() < self.referred:
+                self.referrer[user_id] = self.user_ids[self.rng.randrange(index)]
+        referred = [User(pk=user_id, referred_by_id=referrer) for user_id, referrer in self.referrer.items()]
+        User.objects.bulk_update(referred, ['referred_by'], batch_size=self.batch_size)
+        return len(self.user_ids)
+
+    def create_matches(self) -> int:
+        with explicit_timestamps(Match):
+            matches = [Match(game_name=self.rng.choice(GAMES), team_a_name=f'{self.prefix} team {2 * i}',
+                             team_b_name=f'{self.prefix} team {2 * i + 1}', status=STATUS_LIVE,
+                             created_at=self.created_at()) for i in range(self.matches)]
+            self.match_ids = bulk_insert(Match, matches, self.batch_size)
+        return len(self.match_ids)
+
+    def create_questions(self) -> int:
+        questions = [BetQuestion(match_id=match_id, question=f'{self.prefix} question {i}', status=STATUS_LIVE)
+                     for match_id in self.match_ids for i in range(self.rng.randint(*self.questions_per_match))]
+        question_ids = bulk_insert(BetQuestion, questions, self.batch_size)
+        sizes = [self.rng.randint(*self.options_per_question) for _ in question_ids]
+        options = [QuestionOption(option=f'Option {k}', rate=round(self.rng.uniform(1.1, 4), 2))
+                   for size in sizes for k in range(size)]
+        option_ids = bulk_insert(QuestionOption, options, self.batch_size)
+        self.rates = {option_id: option.rate for option_id, option in zip(option_ids, options)}
+        self.questions = []
+        position = 0
+        for question_id, size in zip(question_ids, sizes):
+            self.questions.append((question_id, option_ids[position:position + size]))
+            position += size
+        through = BetQuestion.options.through
+        through.objects.bulk_create(
+            (through(betquestion_id=question_id, questionoption_id=option_id)
+             for question_id, choices in self.questions for option_id in choices), batch_size=self.batch_size)
+        return len(question_ids)
+
+    def create_bets(self) -> int:
+        questions = [question for question in self.questions if question[1]]
+        if not questions:
+            return 0
+        refer_commission = config_float('refer_commission')
+        options = defaultdict(lambda: [0, 0.0, 0.0])  # bet_count, staked, liability
+        members = self.member_totals
+
+        def bets():
+            for user_id in self.user_ids:
+                club_commission = self.club_commission.get(self.user_club[user_id])
+                for _ in range(self.bets_per_user()):
+                    question_id, choices = self.rng.choice(questions)
+                    choice = self.rng.choice(choices)
+                    amount = self.rng.choice(BET_AMOUNTS)
+                    club_paid = amount * club_commission / 100 if club_commission is not None else 0
+                    refer_paid = amount * refer_commission / 100 if user_id in self.referrer else 0
+                    win_amount = (amount - club_paid - refer_paid) * self.rates[choice]
+                    counters = options[choice]
+                    counters[0] += 1
+                    counters[1] += amount
+                    counters[2] += win_amount
+                    members[user_id][0] += amount
+                    members[user_id][1] += club_paid
+                    yield Bet(user_id=user_id, bet_question_id=question_id, choice_id=choice, amount=amount,
+                              win_rate=self.rates[choice], win_amount=win_amount, created_at=self.created_at())
+
+        count = 0
+        with explicit_timestamps(Bet):
+            for batch in batched(bets(), self.batch_size):
+                Bet.objects.bulk_create(batch)
+                count += len(batch)
+        QuestionOption.objects.bulk_update(
+            [QuestionOption(pk=pk, bet_count=bet_count, staked=staked, liability=liability, total_bet_count=bet_count,
+                            total_staked=staked, total_to_return=liability)
+             for pk, (bet_count, staked, liability) in options.items()],
+            ['bet_count', 'staked', 'liability', 'total_bet_count', 'total_staked', 'total_to_return'],
+            batch_size=self.batch_size)
+        return count
+
+    def create_club_infos(self) -> int:
+        # Created after the bets so totals are inserted instead of updated row by row
+        infos = (UserClubInfo(user_id=user_id, club_id=club_id, total_bet=self.member_totals[user_id][0],
+                              total_commission=self.member_totals[user_id][1])
+                 for user_id, club_id in self.user_club.items())
+        count = 0
+        for batch in batched(infos, self.batch_size):
+            UserClubInfo.objects.bulk_create(batch)
+            count += len(batch)
+        return count
+
+    def create_transactions(self) -> int:
+        by_club = defaultdict(list)
+        for user_id, club_id in self.user_club.items():
+            by_club[club_id].append(user_id)
+        buffers = {Deposit: [], Withdraw: [], Transfer: []}
+        count = 0
+
+        def flush(model, size=self.batch_size):
+            nonlocal count
+            if len(buffers[model]) >= size:
+                model.objects.bulk_create(buffers[model], batch_size=self.batch_size)
+                count += len(buffers[model])
+                buffers[model] = []
+
+        with explicit_timestamps(Deposit, Withdraw, Transfer):
+            for user_id in self.user_ids:
+                club_id = self.user_club[user_id]
+                for _ in range(self.transactions_per_user()):
+                    kind = self.rng.random()
+                    amount = self.rng.choice(TRANSACTION_AMOUNTS)
+                    status = STATUS_ACCEPTED if self.rng.random() < 0.8 else STATUS_PENDING
+                    common = dict(amount=amount, status=status, created_at=self.created_at())
+                    if kind < 0.5:
+                        model = Deposit
+                        row = Deposit(user_id=user_id, method=self.rng.choice(PAYMENT_METHODS), **common)
+                    elif kind < 0.8:
+                        model = Withdraw
+                        row = Withdraw(user_id=user_id, method=self.rng.choice(PAYMENT_METHODS), **common)
+                    elif kind < 0.9 or club_id is None:
+                        model = Transfer
+                        row = Transfer(sender_id=user_id, recipient_id=self.rng.choice(by_club[club_id]), **common)
+                    else:
+                        model = Transfer
+                        row = Transfer(club_id=club_id, recipient_id=user_id, **common)
+                    buffers[model].append(row)
+                    flush(model)
+            for model in buffers:
+                flush(model, 1)
+        return count
@@ -0,0 +1,210 @@
+import logging
+import time
+from typing import Dict, Optional
+
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, OuterRef, Q, QuerySet, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from betting.choices import STATUS_PAID, STATUS_REFUNDED, STATUS_PENDING, STATUS_LOCKED
+from betting.live import publish_updated
+from betting.models import Bet, BetQuestion, Match, QuestionOption
+from users.cache import invalidate_users
+from users.models import Club, User, Notification, change_club_totals
+from users.outbox import queue_notifications
+
+logger = logging.getLogger(__name__)
+
+# Same amount refund_bet gives back: stake after commissions, minus winnings already paid
+REFUND_AMOUNT = Case(
+    When(is_winner=True, then=F('win_amount') / F('win_rate') - F('win_amount')),
+    default=F('win_amount') / F('win_rate'),
+    output_field=FloatField(),
+)
+
+
+def user_totals(bets: QuerySet, amount=F('win_amount')) -> Dict[int, float]:
+    """Sum `amount` over `bets` grouped by user with a single query."""
+    rows = bets.order_by().values('user_id').annotate(total=Sum(amount))
+    return {row['user_id']: row['total'] or 0 for row in rows}
+
+
+def change_user_balances(bets: QuerySet, amount=F('win_amount'), sign=1) -> int:
+    """
+    Add (or subtract when sign is -1) the per user sum of `amount` over `bets`
+    to every affected user with one UPDATE, and the per club sum to the member
+    balance counter of their clubs with another. Returns number of users changed.
+    """
+    total = Subquery(bets.filter(user=OuterRef('pk')).order_by().values('user')
+                     .annotate(total=Sum(amount)).values('total'), output_field=FloatField())
+    balance = F('balance') + total if sign > 0 else F('balance') - total
+    changed = User.objects.filter(pk__in=bets.order_by().values('user_id')).update(balance=balance)
+    # Users first, in the order credit() and debit() lock the rows
+    club_total = Subquery(bets.filter(user__user_club=OuterRef('pk')).order_by().values('user__user_club')
+                          .annotate(total=Sum(amount)).values('total'), output_field=FloatField())
+    change_club_totals(Club.objects.filter(pk__in=bets.order_by().values('user__user_club_id')),
+                       balance=club_total if sign > 0 else -club_total)
+    return changed
+
+
+def change_option_counters(bets: QuerySet, sign=1, **aggregates) -> int:
+    """
+    Add (or subtract when sign is -1) per option aggregates over `bets` to the
+    QuestionOption counters named by the keywords, e.g. liability=Sum('win_amount'),
+    with one UPDATE. Returns number of options changed.
+    """
+    updates = {}
+    for counter, aggregate in aggregates.items():
+        total = Subquery(bets.filter(choice=OuterRef('pk')).order_by().values('choice')
+                         .annotate(total=aggregate).values('total'))
+        updates[counter] = F(counter) + total if sign > 0 else F(counter) - total
+    return QuestionOption.objects.filter(pk__in=bets.order_by().values('choice_id')).update(**updates)
+
+
+def current_user_balance() -> Subquery:
+    return Subquery(User.objects.filter(pk=OuterRef('user_id')).order_by().values('balance')[:1],
+                    output_field=FloatField())
+
+
+def notify_users(totals: Dict[int, float], message) -> int:
+    """Queue one notification per user, `message` is called with the user's amount."""
+    return queue_notifications([Notification(user_id=user_id, message=message(amount))
+                                for user_id, amount in totals.items()])
+
+
+def settle_question(question: BetQuestion, winner: QuestionOption) -> Optional[dict]:
+    """
+    Pay every open bet of the question in one transaction. Winners of a user are
+    credited together, bets are marked with one UPDATE per side and
+    notifications are bulk inserted. Returns a report of rows touched, or None
+    without writing anything when the question already has a winner, is paid or
+    refunded, or `winner` is not one of its options. A winner is changed by
+    reverse_settlement first.
+    """
+    started = time.perf_counter()
+    with transaction.atomic():
+        question = BetQuestion.objects.select_for_update().get(pk=question.pk)
+        if (question.winner_id or question.status in [STATUS_PAID, STATUS_REFUNDED]
+                or not question.options.filter(pk=winner.pk).exists()):
+            return None
+        match = question.match
+        open_bets = question.bet_set.exclude(status__in=[STATUS_PAID, STATUS_REFUNDED])
+        winning_bets = open_bets.filter(choice=winner)
+        totals = user_totals(winning_bets)
+        change_option_counters(open_bets, sign=-1, liability=Sum('win_amount'))
+        users_credited = change_user_balances(winning_bets)
+        bets_won = winning_bets.update(is_winner=True, status=STATUS_PAID, user_balance=current_user_balance())
+        bets_lost = open_bets.exclude(choice=winner).update(is_winner=False, status=STATUS_PAID)
+        notifications = notify_users(totals, lambda amount: f'You won bdt {amount} for match ##{match}## '
+                                                            f'on question ##{question.question}##.')
+        question.status = STATUS_PAID
+        question.winner = winner
+        question.save()  # To avoid reprocessing the bet scope
+        invalidate_users(*totals)
+    report = {
+        'question': question.id,
+        'winner': winner.id,
+        'bets_won': bets_won,
+        'bets_lost': bets_lost,
+        'users_credited': users_credited,
+        'amount_paid': sum(totals.values()),
+        'notifications': notifications,
+        'elapsed': time.perf_counter() - started,
+    }
+    logger.info('Settled question %(question)s: %(bets_won)s won, %(bets_lost)s lost in %(elapsed).3fs', report)
+    return report
+
+
+def reverse_settlement(question: BetQuestion, dry_run=False) -> dict:
+    """
+    Undo settle_question in one transaction: winners are debited what they were
+    paid, aggregated per user, and every paid bet goes back to pending. With
+    dry_run nothing is written and the report lists each user's balance change.
+    """
+    started = time.perf_counter()
+    with transaction.atomic():
+        question = BetQuestion.objects.select_for_update().get(pk=question.pk)
+        paid_bets = question.bet_set.filter(status=STATUS_PAID)
+        winning_bets = paid_bets.filter(choice_id=question.winner_id, is_winner=True)
+        totals = user_totals(winning_bets)
+        report = {
+            'question': question.id,
+            'winner': question.winner_id,
+            'dry_run': bool(dry_run),
+            'bets_reset': paid_bets.count() if dry_run else 0,
+            'amount_reversed': sum(totals.values()),
+        }
+        if dry_run:
+            balances = dict(User.objects.filter(pk__in=totals.keys()).values_list('id', 'balance'))
+            report['users'] = [{'user': user_id, 'amount': -amount, 'balance': balances.get(user_id),
+                                'new_balance': balances.get(user_id, 0) - amount}
+                               for user_id, amount in totals.items()]
+        else:
+            match = question.match
+            report['users_debited'] = change_user_balances(winning_bets, sign=-1)
+            change_option_counters(paid_bets, liability=Sum('win_amount'))
+            report['bets_reset'] = paid_bets.update(is_winner=None, status=STATUS_PENDING)
+            report['notifications'] = notify_users(totals, lambda amount: f'match ##{match}## on question '
+                                                                          f'##{question.question}## result was '
+                                                                          f'changed, {amount} bdt won is taken back')
+            question.status = STATUS_LOCKED
+            question.winner = None
+            question.save()  # To avoid reprocessing the bet scope
+            invalidate_users(*totals)
+    report['elapsed'] = time.perf_counter() - started
+    if not dry_run:
+        logger.info('Reversed question %(question)s: %(bets_reset)s bets reset in %(elapsed).3fs', report)
+    return report
+
+
+def refund_bets(bets: QuerySet, message) -> dict:
+    """
+    Refund every bet of `bets` that is not refunded yet. Refund amounts are
+    computed in SQL and credited with one UPDATE for all users. Must run inside
+    a transaction.
+    """
+    bets = bets.exclude(status=STATUS_REFUNDED)
+    totals = user_totals(bets, REFUND_AMOUNT)
+    users_credited = change_user_balances(bets, REFUND_AMOUNT)
+    invalidate_users(*totals)
+    change_option_counters(bets, sign=-1, bet_count=Count('id'), staked=Sum('amount'),
+                           liability=Coalesce(Sum('win_amount', filter=~Q(status=STATUS_PAID)), Value(0.0)))
+    return {
+        'bets_refunded': bets.update(status=STATUS_REFUNDED),
+        'users_credited': users_credited,
+        'amount_refunded': sum(totals.values()),
+        'notifications': notify_users(totals, message),
+    }
+
+
+def refund_question_bets(question: BetQuestion) -> dict:
+    started = time.perf_counter()
+    with transaction.atomic():
+        question = BetQuestion.objects.select_for_update().select_related('match').get(pk=question.pk)
+        report = refund_bets(question.bet_set.all(),
+                             lambda amount: f'Bet cancelled for match ##{question.match}## on '
+                                            f'##{question.question}##. Balance refunded by {amount} BDT')
+        question.status = STATUS_REFUNDED
+        question.save()  # To avoid reprocessing the bet scope
+    report.update(question=question.id, elapsed=time.perf_counter() - started)
+    logger.info('Refunded question %(question)s: %(bets_refunded)s bets in %(elapsed).3fs', report)
+    return report
+
+
+def refund_match_bets(match: Match) -> dict:
+    """
+    Refund all questions of a match at once. The questions are locked first, in
+    id order, so settle_question can not pay bets of one of them meanwhile.
+    """
+    started = time.perf_counter()
+    with transaction.atomic():
+        question_ids = list(BetQuestion.objects.select_for_update().filter(match=match).order_by('id')
+                            .values_list('id', flat=True))
+        report = refund_bets(Bet.objects.filter(bet_question__in=question_ids),
+                             lambda amount: f'Bets cancelled for match ##{match}##. '
+                                            f'Balance refunded by {amount} BDT')
+        publish_updated(BetQuestion, question_ids, status=STATUS_REFUNDED)
+        report['questions'] = BetQuestion.objects.filter(pk__in=question_ids).update(status=STATUS_REFUNDED)
+    report.update(match=match.id, elapsed=time.perf_counter() - started)
+    logger.info('Refunded match %(match)s: %(bets_refunded)s bets in %(elapsed).3fs', report)
+    return report
@@ -0,0 +1,140 @@
+import asyncio
+import json
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from corsheaders.middleware import CorsMiddleware
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+from betting.live import Subscription, get_broker
+
+WEBSOCKET_PATH = '/ws/market/'
+EVENTS_PATH = '/api/market/events/'
+# Seconds between comments keeping idle event streams open through proxies
+HEARTBEAT = getattr(settings, 'MARKET_HEARTBEAT', 15)
+
+
+async def pump(subscription: Subscription, receive, write: Callable[[Optional[str]], Awaitable],
+               disconnect: str, heartbeat: float = None) -> None:
+    """
+    Write every message of the subscription until the client disconnects,
+    calling write(None) after `heartbeat` idle seconds. Anything else the
+    client sends is ignored.
+    """
+    receiver = asyncio.ensure_future(receive())
+    getter = asyncio.ensure_future(subscription.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait({receiver, getter}, timeout=heartbeat,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                await write(getter.result())
+                getter = asyncio.ensure_future(subscription.get())
+            elif not done:
+                await write(None)
+            if receiver in done:
+                if receiver.result()['type'] == disconnect:
+                    return
+                receiver = asyncio.ensure_future(receive())
+    finally:
+        receiver.cancel()
+        getter.cancel()
+
+
+def hello() -> str:
+    """First message of a stream, deltas follow from seq onwards."""
+    return json.dumps({'type': 'hello', 'seq': get_broker().last_seq})
+
+
+async def market_websocket(scope, receive, send) -> None:
+    """WebSocket sending a JSON text frame per market delta."""
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    await send({'type': 'websocket.accept'})
+    broker = get_broker()
+    subscription = broker.subscribe()
+
+    async def write(text: Optional[str]):
+        if text is not None:
+            await send({'type': 'websocket.send', 'text': text})
+
+    try:
+        await broker.wait_started()
+        await write(hello())
+        await pump(subscription, receive, write, 'websocket.disconnect')
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def cors_headers(scope) -> List[Tuple[bytes, bytes]]:
+    """
+    Headers CorsMiddleware adds to a Django response of the same request,
+    following the CORS_* settings. The event stream does not go through Django.
+    """
+    headers = {name.decode('latin1').upper().replace('-', '_'): value.decode('latin1')
+               for name, value in scope.get('headers', [])}
+    request = HttpRequest()
+    request.method = scope['method']
+    request.path = request.path_info = scope['path']
+    request.META = {f'HTTP_{name}': value for name, value in headers.items()}
+    response = CorsMiddleware(lambda request: None).process_response(request, HttpResponse())
+    return [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.items()
+            if name.lower().startswith('access-control-') or name.lower() == 'vary']
+
+
+async def market_events(scope, receive, send) -> None:
+    """Server sent events stream with a data line per market delta, for clients without WebSocket."""
+    if scope['method'] != 'GET':
+        await send({'type': 'http.response.start', 'status': 405, 'headers': [(b'allow', b'GET')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+        *cors_headers(scope),
+    ]})
+    broker = get_broker()
+    subscription = broker.subscribe()
+
+    async def write(text: Optional[str]):
+        body = b': ping\n\n' if text is None else f'data: {text}\n\n'.encode()
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+    try:
+        await broker.wait_started()
+        await write(hello())
+        await pump(subscription, receive, write, 'http.disconnect', HEARTBEAT)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def lifespan(receive, send) -> None:
+    """Acknowledge startup and shutdown of the server, Django only takes http requests."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            return await send({'type': 'lifespan.shutdown.complete'})
+
+
+def market_router(application):
+    """
+    ASGI application serving the market streams and passing everything else
+    to `application`, the Django one.
+    """
+
+    async def router(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        if scope['type'] == 'websocket':
+            if scope['path'] == WEBSOCKET_PATH:
+                return await market_websocket(scope, receive, send)
+            await receive()
+            return await send({'type': 'websocket.close'})
+        if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+            return await market_events(scope, receive, send)
+        return await application(scope, receive, send)
+
+    return router
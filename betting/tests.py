@@ -1,3 +1,746 @@
-from django.test import TestCase
+import asyncio
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.db import DatabaseCache
+from django.core.management import CommandError, call_command
+from django.db.models import Count, RestrictedError, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.timezone import utc
+
+from betting.accruals import flush_commissions, pending_commission, flush_referrals, referral_summary
+from betting.actions import select_question_winner, unselect_question_winner, refund_question, refund_match, \
+    place_bet, lock_match, refund_bet
+from betting.choices import STATUS_PAID, STATUS_PENDING, STATUS_LOCKED, STATUS_REFUNDED, STATUS_HIDDEN
+from betting.benchmarks import compare, database_version, run_benchmarks
+from betting.config import CONFIG_VERSION_KEY, config_float, config_int, invalidate_config
+from betting.counters import WINDOW_DAY, WINDOW_MONTH, WINDOW_ROLLING, RateCounter, window_bounds
+from betting.live import InProcessBroker, Subscription, get_broker
+from betting.loadtest import SCENARIOS, format_report, run_load
+from betting.models import Match, BetQuestion, QuestionOption, Bet, CommissionAccrual, ConfigModel, Deposit, \
+    MarketEvent, ReferralAccrual
+from betting.query_plans import hot_queries, uses_index
+from betting.seeding import BenchSeeder
+from betting.streams import EVENTS_PATH, WEBSOCKET_PATH, market_router
+from users.models import User, Club, Notification, UserClubInfo
+
+
+def create_market(users=3, balance=5000) -> (Club, list, BetQuestion, QuestionOption, QuestionOption):
+    cache.clear()
+    club = Club.objects.create(name='Bench Club', username='bench_club', password='bench_pass')
+    members = [User.objects.create_user(username=f'bettor{i}', email=f'bettor{i}@gmail.com', phone=f'0170{i}',
+                                        user_club=club, balance=balance, password='1234') for i in range(users)]
+    match = Match.objects.create(team_a_name='A', team_b_name='B', game_name='football')
+    question = BetQuestion.objects.create(match=match, question='Winner?')
+    option_a = QuestionOption.objects.create(option='A', rate=2)
+    option_b = QuestionOption.objects.create(option='B', rate=1.5)
+    question.options.add(option_a, option_b)
+    return club, members, question, option_a, option_b
+
+
+def place(user: User, question: BetQuestion, option: QuestionOption, amount=100) -> Bet:
+    return place_bet(user, question, option, amount)
+
+
+def member_balances(club: Club) -> (float, float):
+    """Member balance counter of the club and the sum it counts."""
+    club.refresh_from_db()
+    return club.total_user_balance, User.objects.filter(user_club=club).aggregate(total=Sum('balance'))['total']
+
+
+class SettlementTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club, self.users, self.question, self.option_a, self.option_b = create_market()
+
+    def test_select_winner_credits_winners(self):
+        first = place(self.users[0], self.question, self.option_a)
+        second = place(self.users[0], self.question, self.option_a, 200)
+        loser = place(self.users[1], self.question, self.option_b)
+        balance = User.objects.get(pk=self.users[0].pk).balance
+        with self.captureOnCommitCallbacks(execute=True):
+            select_question_winner(self.question.id, self.option_a.id)
+        user = User.objects.get(pk=self.users[0].pk)
+        self.assertAlmostEqual(user.balance, balance + first.win_amount + second.win_amount)
+        first.refresh_from_db()
+        loser.refresh_from_db()
+        self.assertEqual((first.is_winner, first.status), (True, STATUS_PAID))
+        self.assertEqual(first.user_balance, user.balance)
+        self.assertEqual((loser.is_winner, loser.status), (False, STATUS_PAID))
+        self.assertEqual(Notification.objects.filter(user=user, message__startswith='You won').count(), 1)
+        self.assertAlmostEqual(*member_balances(self.club))
+
+    def test_select_winner_is_not_paid_twice(self):
+        place(self.users[0], self.question, self.option_a)
+        select_question_winner(self.question.id, self.option_a.id)
+        balance = User.objects.get(pk=self.users[0].pk).balance
+        select_question_winner(self.question.id, self.option_a.id)
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).balance, balance)
+
+    def test_select_other_winner_needs_unselect(self):
+        place(self.users[0], self.question, self.option_a)
+        place(self.users[1], self.question, self.option_b)
+        select_question_winner(self.question.id, self.option_a.id)
+        balances = dict(User.objects.filter(pk__in=[u.id for u in self.users]).values_list('id', 'balance'))
+        self.assertFalse(select_question_winner(self.question.id, self.option_b.id))
+        self.assertEqual(BetQuestion.objects.get(pk=self.question.id).winner_id, self.option_a.id)
+        self.assertEqual(dict(User.objects.filter(pk__in=balances.keys()).values_list('id', 'balance')), balances)
+        unselect_question_winner(self.question.id)
+        self.assertTrue(select_question_winner(self.question.id, self.option_b.id))
+        self.assertEqual(Bet.objects.get(user=self.users[1]).is_winner, True)
+
+    def test_select_winner_on_refunded_question(self):
+        place(self.users[0], self.question, self.option_a)
+        refund_question(self.question.id)
+        balance = User.objects.get(pk=self.users[0].pk).balance
+        self.assertFalse(select_question_winner(self.question.id, self.option_a.id))
+        question = BetQuestion.objects.get(pk=self.question.id)
+        self.assertEqual((question.status, question.winner), (STATUS_REFUNDED, None))
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).balance, balance)
+
+    def test_select_winner_from_other_question(self):
+        other = QuestionOption.objects.create(option='C', rate=3)
+        self.assertFalse(select_question_winner(self.question.id, other.id))
+        self.assertIsNone(BetQuestion.objects.get(pk=self.question.id).winner)
+
+    def test_select_winner_query_count_is_constant(self):
+        for user in self.users:
+            place(user, self.question, self.option_a)
+            place(user, self.question, self.option_b)
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(16):
+            select_question_winner(self.question.id, self.option_a.id)
+        with self.assertNumQueries(1):
+            callbacks[0]()
+
+    def test_unselect_winner_dry_run(self):
+        bet = place(self.users[0], self.question, self.option_a)
+        place(self.users[1], self.question, self.option_b)
+        select_question_winner(self.question.id, self.option_a.id)
+        balance = User.objects.get(pk=self.users[0].pk).balance
+        report = unselect_question_winner(self.question.id, dry_run=True)
+        self.assertEqual(report['users'], [{'user': self.users[0].id, 'amount': -bet.win_amount,
+                                            'balance': balance, 'new_balance': balance - bet.win_amount}])
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).balance, balance, 'Dry run should not change balance')
+        self.assertEqual(BetQuestion.objects.get(pk=self.question.id).winner_id, self.option_a.id)
+
+    def test_unselect_winner_reverses_payment(self):
+        place(self.users[0], self.question, self.option_a)
+        place(self.users[1], self.question, self.option_b)
+        balances = {user.id: user.balance for user in User.objects.filter(pk__in=[u.id for u in self.users])}
+        select_question_winner(self.question.id, self.option_a.id)
+        unselect_question_winner(self.question.id)
+        for user in User.objects.filter(pk__in=balances.keys()):
+            self.assertAlmostEqual(user.balance, balances[user.id])
+        question = BetQuestion.objects.get(pk=self.question.id)
+        self.assertEqual((question.status, question.winner), (STATUS_LOCKED, None))
+        self.assertEqual(set(question.bet_set.values_list('status', 'is_winner')), {(STATUS_PENDING, None)})
+        self.assertAlmostEqual(*member_balances(self.club))
+
+
+class RefundTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club, self.users, self.question, self.option_a, self.option_b = create_market()
+
+    def test_refund_question(self):
+        first = place(self.users[0], self.question, self.option_a)
+        second = place(self.users[0], self.question, self.option_b, 200)
+        balance = User.objects.get(pk=self.users[0].pk).balance
+        self.assertTrue(refund_question(self.question.id))
+        self.assertAlmostEqual(User.objects.get(pk=self.users[0].pk).balance,
+                               balance + first.win_amount / first.win_rate + second.win_amount / second.win_rate)
+        self.assertEqual(set(self.question.bet_set.values_list('status', flat=True)), {STATUS_REFUNDED})
+        self.assertEqual(BetQuestion.objects.get(pk=self.question.id).status, STATUS_REFUNDED)
+        balance = User.objects.get(pk=self.users[0].pk).balance
+        refund_question(self.question.id)
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).balance, balance, 'Bets should be refunded once')
+
+    def test_refund_match(self):
+        other = BetQuestion.objects.create(match=self.question.match, question='First goal?')
+        other.options.add(self.option_a)
+        first = place(self.users[1], self.question, self.option_a)
+        second = place(self.users[1], other, self.option_a)
+        balance = User.objects.get(pk=self.users[1].pk).balance
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(11):
+            self.assertTrue(refund_match(self.question.match_id))
+        self.assertAlmostEqual(User.objects.get(pk=self.users[1].pk).balance,
+                               balance + first.win_amount / first.win_rate + second.win_amount / second.win_rate)
+        self.assertEqual(set(BetQuestion.objects.filter(match=self.question.match).values_list('status', flat=True)),
+                         {STATUS_REFUNDED})
+        self.assertEqual(Notification.objects.filter(user=self.users[1], message__startswith='Bets cancelled').count(), 1)
+        self.assertAlmostEqual(*member_balances(self.club))
+
+
+class PlaceBetTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club, self.users, self.question, self.option_a, self.option_b = create_market(balance=1000)
+
+    def test_place_bet(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            bet = place(self.users[0], self.question, self.option_a, 100)
+        self.assertEqual(bet.user_balance, 900)
+        self.assertEqual(bet.win_amount, (100 - 100 * self.club.club_commission / 100) * self.option_a.rate)
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).balance, 900)
+        info = self.users[0].userclubinfo
+        info.refresh_from_db()
+        self.assertEqual((info.total_bet, info.total_commission), (100, 100 * self.club.club_commission / 100))
+        self.assertEqual(pending_commission(self.club.id), 100 * self.club.club_commission / 100)
+
+    def test_place_bet_keeps_min_balance(self):
+        self.assertFalse(place(self.users[0], self.question, self.option_a, 995))
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).balance, 1000)
+        self.assertFalse(Bet.objects.exists())
+
+    def test_place_bet_on_settled_question(self):
+        question = self.question
+        select_question_winner(question.id, self.option_a.id)
+        # The question was validated open before the settlement committed
+        self.assertFalse(place(self.users[0], question, self.option_a, 100))
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).balance, 1000)
+        self.assertFalse(Bet.objects.exists())
+
+    def test_place_bet_accrues_commission(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            bet = place(self.users[0], self.question, self.option_a, 100)
+        self.assertEqual(Club.objects.get(pk=self.club.pk).balance, 0, 'Commission is paid by the flusher')
+        self.assertEqual(list(CommissionAccrual.objects.values_list('bet', 'club', 'deposit')),
+                         [(bet.id, self.club.id, None)])
+
+
+class OptionCounterTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club, self.users, self.question, self.option_a, self.option_b = create_market()
+
+    def counters(self, option: QuestionOption) -> tuple:
+        option.refresh_from_db()
+        return option.bet_count, option.staked, option.liability
+
+    def test_counters_follow_bets(self):
+        first = place(self.users[0], self.question, self.option_a, 100)
+        second = place(self.users[1], self.question, self.option_a, 200)
+        place(self.users[2], self.question, self.option_b, 100)
+        self.assertEqual(self.counters(self.option_a), (2, 300, first.win_amount + second.win_amount))
+        select_question_winner(self.question.id, self.option_a.id)
+        self.assertEqual(self.counters(self.option_a), (2, 300, 0), 'Settled bets are no liability')
+        self.assertEqual(self.counters(self.option_b), (1, 100, 0))
+        unselect_question_winner(self.question.id)
+        self.assertEqual(self.counters(self.option_a), (2, 300, first.win_amount + second.win_amount))
+        refund_question(self.question.id)
+        self.assertEqual(self.counters(self.option_a), (0, 0, 0))
+        self.assertEqual(self.counters(self.option_b), (0, 0, 0))
+
+    def test_deleted_bet_released(self):
+        bet = place(self.users[0], self.question, self.option_a, 100)
+        bet.delete()
+        self.assertEqual(self.counters(self.option_a), (0, 0, 0))
+        self.assertEqual((self.option_a.total_bet_count, self.option_a.total_staked, self.option_a.total_to_return),
+                         (0, 0, 0))
+
+    def test_totals_keep_refunded_bets(self):
+        first = place(self.users[0], self.question, self.option_a, 100)
+        second = place(self.users[1], self.question, self.option_a, 200)
+        refund_bet(first.id)
+        refund_question(self.question.id)
+        self.assertEqual(self.counters(self.option_a), (0, 0, 0))
+        self.assertEqual((self.option_a.total_bet_count, self.option_a.total_staked, self.option_a.total_to_return),
+                         (2, 300, first.win_amount + second.win_amount))
+
+    def test_option_limit(self):
+        QuestionOption.objects.filter(pk=self.option_a.pk).update(limit=250)
+        self.assertTrue(place(self.users[0], self.question, self.option_a, 100))
+        self.assertTrue(place(self.users[1], self.question, self.option_a, 100), 'Limit not reached yet')
+        balance = User.objects.get(pk=self.users[2].pk).balance
+        self.assertFalse(place(self.users[2], self.question, self.option_a, 100), 'Bet would pass the limit')
+        self.assertEqual(User.objects.get(pk=self.users[2].pk).balance, balance, 'Debit is rolled back')
+        self.assertEqual(self.counters(self.option_a)[:2], (2, 200))
+        self.assertTrue(place(self.users[2], self.question, self.option_a, 50), 'Bet fills the option exactly')
+        self.assertEqual(self.counters(self.option_a)[:2], (3, 250))
+
+
+class CommissionFlushTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club, self.users, self.question, self.option_a, self.option_b = create_market()
+
+    def test_flush_commissions(self):
+        for user in self.users:
+            place(user, self.question, self.option_a, 100)
+            place(user, self.question, self.option_b, 200)
+        commission = 900 * self.club.club_commission / 100
+        with self.captureOnCommitCallbacks(execute=True):
+            report = flush_commissions()
+        self.assertEqual((report['clubs'], report['accruals']), (1, 6))
+        club = Club.objects.get(pk=self.club.pk)
+        self.assertAlmostEqual(club.balance, commission)
+        deposit = club.deposit_set.get()
+        self.assertEqual((deposit.amount, deposit.balance), (club.balance, club.balance))
+        self.assertEqual(pending_commission(club.id), 0)
+        self.assertEqual(Notification.objects.filter(club=club).count(), 1)
+
+    def test_flush_commissions_pays_once(self):
+        place(self.users[0], self.question, self.option_a, 100)
+        flush_commissions()
+        balance = Club.objects.get(pk=self.club.pk).balance
+        self.assertEqual(flush_commissions()['accruals'], 0)
+        self.assertEqual(Club.objects.get(pk=self.club.pk).balance, balance)
+        self.assertEqual(self.club.deposit_set.count(), 1, 'Empty flush should not leave a deposit')
+
+    def test_payout_deposit_delete_does_not_pay_again(self):
+        place(self.users[0], self.question, self.option_a, 100)
+        flush_commissions()
+        deposit = self.club.deposit_set.get()
+        balance = Club.objects.get(pk=self.club.pk).balance
+        with self.assertRaises(RestrictedError):
+            deposit.delete()
+        self.assertEqual(flush_commissions()['accruals'], 0)
+        self.assertEqual(Club.objects.get(pk=self.club.pk).balance, balance)
+        self.assertEqual(CommissionAccrual.objects.get().deposit, deposit)
+        self.club.delete()
+        self.assertFalse(CommissionAccrual.objects.exists())
+
+
+class ReferralAccrualTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club, self.users, self.question, self.option_a, self.option_b = create_market()
+        self.referrer = self.users[0]
+        User.objects.filter(pk__in=[self.users[1].pk, self.users[2].pk]).update(referred_by=self.referrer)
+        self.users = list(User.objects.filter(pk__in=[u.pk for u in self.users]).order_by('pk'))
+
+    def test_referral_accrued_per_user_and_day(self):
+        for _ in range(3):
+            place(self.users[1], self.question, self.option_a, 100)
+        place(self.users[2], self.question, self.option_b, 200)
+        self.assertEqual(ReferralAccrual.objects.count(), 2, 'One row per referred user and day')
+        accrual = ReferralAccrual.objects.get(user=self.users[1])
+        self.assertEqual(accrual.bet_count, 3)
+        self.assertAlmostEqual(accrual.amount, 300 * config_float('refer_commission') / 100)
+        self.assertFalse(self.referrer.deposit_set.exists())
+
+    def test_flush_referrals(self):
+        place(self.users[1], self.question, self.option_a, 100)
+        place(self.users[2], self.question, self.option_b, 200)
+        balance = User.objects.get(pk=self.referrer.pk).balance
+        earned = 300 * config_float('refer_commission') / 100
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(flush_referrals()['accruals'], 2)
+        referrer = User.objects.get(pk=self.referrer.pk)
+        self.assertAlmostEqual(referrer.balance, balance + earned)
+        self.assertAlmostEqual(referrer.earn_from_refer, earned)
+        self.assertEqual(referrer.deposit_set.get().balance, referrer.balance)
+        self.assertEqual(Notification.objects.filter(user=referrer, message__startswith='You earned').count(), 1)
+        self.assertAlmostEqual(*member_balances(self.club))
+        self.assertEqual(flush_referrals()['accruals'], 0)
+        place(self.users[1], self.question, self.option_a, 100)
+        self.assertEqual(ReferralAccrual.objects.filter(deposit__isnull=True).count(), 1,
+                         'Bets after a flush start a new pending row')
+
+    def test_payout_deposit_delete_does_not_pay_again(self):
+        place(self.users[1], self.question, self.option_a, 100)
+        flush_referrals()
+        deposit = self.referrer.deposit_set.get()
+        balance = User.objects.get(pk=self.referrer.pk).balance
+        with self.assertRaises(RestrictedError):
+            deposit.delete()
+        self.assertEqual(flush_referrals()['accruals'], 0)
+        self.assertEqual(User.objects.get(pk=self.referrer.pk).balance, balance)
+        self.assertEqual(ReferralAccrual.objects.get().deposit, deposit)
+
+    def test_referral_summary(self):
+        place(self.users[1], self.question, self.option_a, 100)
+        flush_referrals()
+        place(self.users[1], self.question, self.option_a, 100)
+        place(self.users[2], self.question, self.option_b, 100)
+        commission = 100 * config_float('refer_commission') / 100
+        summary = referral_summary(self.referrer)
+        self.assertEqual((summary['bet_count'], len(summary['daily'])), (3, 1))
+        self.assertAlmostEqual(summary['amount'], 3 * commission)
+        self.assertAlmostEqual(summary['pending'], 2 * commission)
+        by_user = {row['user']: row for row in summary['users']}
+        self.assertEqual(by_user[self.users[1].pk]['bet_count'], 2)
+        self.assertAlmostEqual(by_user[self.users[1].pk]['pending'], commission)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                        'LOCATION': 'django_cache'}}, CONFIG_VERSION_CHECK_INTERVAL=5)
+class SharedConfigTestCase(TestCase):
+    def setUp(self) -> None:
+        call_command('createcachetable')
+        invalidate_config()
+        # The cache another worker process uses, only the table is shared
+        self.other_worker = DatabaseCache('django_cache', {})
+
+    def test_change_from_other_worker_reloads(self):
+        self.assertEqual(config_float('refer_commission'), 0.5)
+        # Another worker saving the row bumps the version in the shared table
+        ConfigModel.objects.filter(name='refer_commission').update(value='3')
+        self.other_worker.set(CONFIG_VERSION_KEY, 'bumped', None)
+        self.assertEqual(config_float('refer_commission'), 0.5)
+        later = time.monotonic() + settings.CONFIG_VERSION_CHECK_INTERVAL
+        with patch('betting.config.time.monotonic', return_value=later):
+            self.assertEqual(config_float('refer_commission'), 3.0)
+
+    def test_version_checked_once_per_interval(self):
+        config_float('refer_commission')
+        with self.assertNumQueries(0):
+            config_float('refer_commission')
+            config_int('max_bet')
+            config_int('min_bet')
+
+
+class RateCounterTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club, self.users, *_ = create_market(users=1)
+        self.user = self.users[0]
+
+    def deposit(self, created_at=None) -> Deposit:
+        deposit = Deposit.objects.create(user=self.user, amount=100)
+        if created_at:
+            Deposit.objects.filter(pk=deposit.pk).update(created_at=created_at)
+        return deposit
+
+    def test_day_follows_local_time(self):
+        now = datetime(2026, 10, 18, 20, tzinfo=utc)  # 19 October 02:00 in Dhaka
+        self.assertEqual(window_bounds(WINDOW_DAY, now),
+                         (datetime(2026, 10, 18, 18, tzinfo=utc), datetime(2026, 10, 19, 18, tzinfo=utc)))
+        self.assertEqual(window_bounds(WINDOW_MONTH, now),
+                         (datetime(2026, 9, 30, 18, tzinfo=utc), datetime(2026, 10, 31, 18, tzinfo=utc)))
+
+    def test_same_day_of_other_month_not_counted(self):
+        self.deposit(timezone.now() - timedelta(days=31))
+        self.deposit(timezone.now() - timedelta(days=365))
+        self.assertEqual(RateCounter(Deposit).count(self.user), 0)
+
+    def test_counted_in_one_query(self):
+        counter = RateCounter(Deposit)
+        self.deposit()
+        self.assertEqual(counter.count(self.user), 1)
+        self.deposit()
+        with self.assertNumQueries(1):
+            self.assertEqual(counter.count(self.user), 2)
+
+    def test_rolling_window(self):
+        counter = RateCounter(Deposit, window=WINDOW_ROLLING)
+        self.deposit(timezone.now() - timedelta(hours=25))
+        self.deposit(timezone.now() - timedelta(hours=23))
+        self.assertEqual(counter.count(self.user), 1)
+        self.deposit()
+        self.assertEqual(counter.count(self.user), 2)
+        self.assertEqual(counter.count(self.user, timezone.now() + timedelta(hours=2)), 1)
+
+
+class QueryPlanTestCase(TestCase):
+    def test_hot_queries_use_their_index(self):
+        club, users, question, *_ = create_market(users=1)
+        for label, queryset, index in hot_queries(users[0], club, question):
+            used, plan = uses_index(queryset, index)
+            self.assertTrue(used, f'{label} is not planned with {index}:\n{plan}')
+
+
+class SeedBenchTestCase(TestCase):
+    def seed(self, prefix, seed=7):
+        return BenchSeeder(seed=seed, users=30, clubs=3, matches=4, bets_per_user=5, transactions_per_user=3,
+                           prefix=prefix, batch_size=16, now=datetime(2026, 1, 1, tzinfo=utc),
+                           log=lambda message: None).run()
+
+    def test_counters_match_bets(self):
+        report = self.seed('seed')
+        self.assertEqual(Bet.objects.count(), report['bets'])
+        self.assertEqual(User.objects.filter(username__startswith='seed').count(), 30)
+        for option in QuestionOption.objects.all():
+            bets = option.bet_set.aggregate(count=Count('id'), staked=Sum('amount'), liability=Sum('win_amount'))
+            self.assertEqual(option.bet_count, bets['count'])
+            self.assertAlmostEqual(option.staked, bets['staked'] or 0)
+            self.assertAlmostEqual(option.liability, bets['liability'] or 0)
+        for bet in Bet.objects.select_related('bet_question')[:20]:
+            self.assertTrue(bet.bet_question.options.filter(pk=bet.choice_id).exists())
+        info = UserClubInfo.objects.filter(user__bet__isnull=False).first()
+        self.assertAlmostEqual(info.total_bet, info.user.bet_set.aggregate(Sum('amount'))['amount__sum'])
+
+    def test_deterministic(self):
+        first = self.seed('first')
+        second = self.seed('second')
+        first.pop('elapsed'), second.pop('elapsed')
+        self.assertEqual(first, second)
+        amounts = [list(Bet.objects.filter(user__username__startswith=prefix).order_by('id')
+                        .values_list('amount', 'win_amount', 'created_at')) for prefix in ('first', 'second')]
+        self.assertEqual(amounts[0], amounts[1])
+
+    def test_prefix_taken(self):
+        self.seed('taken')
+        with self.assertRaises(ValueError):
+            self.seed('taken')
+
+
+class LoadTestTestCase(TestCase):
+    def test_scenarios_keep_invariants(self):
+        for scenario in SCENARIOS:
+            report = run_load(scenario, requests=40, workers=0, users=10, log=lambda message: None)
+            self.assertTrue(report['ok'], format_report(report))
+            self.assertEqual(report['errors'], 0, format_report(report))
+            self.assertEqual(report['requests'], 41 if scenario == 'settle_race' else 40)
+
+    def test_settle_race_rejects_late_bets(self):
+        report = run_load('settle_race', requests=20, workers=0, users=5, log=lambda message: None)
+        self.assertEqual(report['labels']['settle']['statuses'], {200: 1})
+        self.assertEqual(report['labels']['bet']['statuses'].get(400), 10)
+
+    def test_run_is_cleaned_up(self):
+        run_load('mixed', requests=40, workers=0, users=10, log=lambda message: None)
+        self.assertFalse(User.objects.filter(username__startswith='load').exists())
+        self.assertFalse(Club.objects.exists())
+        self.assertFalse(Match.objects.exists())
+        self.assertFalse(QuestionOption.objects.exists())
+        self.assertFalse(Deposit.objects.exists())
+
+    def test_command_refuses_other_databases(self):
+        with patch('betting.management.commands.loadtest.is_throwaway_database', return_value=False):
+            with self.assertRaisesMessage(CommandError, '--force'):
+                call_command('loadtest', 'bet_storm', '--workers=0')
+        self.assertFalse(User.objects.exists())
+
+
+class ConcurrentLoadTestCase(TransactionTestCase):
+    def test_concurrent_scenarios_keep_invariants(self):
+        for scenario in ('bet_storm', 'mixed'):
+            report = run_load(scenario, requests=60, workers=4, users=10, keep=True, log=lambda message: None)
+            # SQLite turns away a writer that meets another one with "database is locked", those are errors
+            # here. What the load must not break are the balances and counters
+            self.assertTrue(report['ok'], format_report(report))
+            self.assertGreater(report['labels']['bet']['statuses'].get(201, 0), 0, format_report(report))
+        admins = User.objects.filter(username__endswith='_admin')
+        self.assertEqual([admin.has_usable_password() for admin in admins], [False, False])
+
+
+class SettlementBenchmarkTestCase(TestCase):
+    def test_report_and_constant_queries(self):
+        report = run_benchmarks([20, 100], repeat=2, log=lambda message: None)
+        self.assertEqual(report['database'], 'sqlite')
+        small, large = report['sizes']['20'], report['sizes']['100']
+        self.assertEqual((small['bets'], large['bets']), (20, 100))
+        for action in ('select_winner', 'unselect_winner', 'refund'):
+            self.assertEqual(small['actions'][action]['queries'], large['actions'][action]['queries'])
+            self.assertGreater(large['actions'][action]['peak_kb'], 0)
+        self.assertEqual(large['actions']['select_winner']['runs'], 2)
+        self.assertEqual(Bet.objects.filter(status=STATUS_REFUNDED).count(), 120)
+
+    def test_database_version(self):
+        self.assertEqual(database_version(), sqlite3.sqlite_version)
+        for pg_version, version in ((130004, '13.4'), (90603, '9.6.3')):
+            with patch('betting.benchmarks.connection', SimpleNamespace(vendor='postgresql', pg_version=pg_version)):
+                self.assertEqual(database_version(), version)
+        oracle = SimpleNamespace(vendor='oracle', ensure_connection=lambda: None,
+                                 connection=SimpleNamespace(version='19.3.0.0.0'))
+        with patch('betting.benchmarks.connection', oracle):
+            self.assertEqual(database_version(), '19.3.0.0.0')
+
+    def test_compare_flags_regressions(self):
+        result = {'elapsed': 1.0, 'elapsed_min': 1.0, 'queries': 10, 'peak_kb': 100.0, 'runs': 1}
+        baseline = {'database': 'sqlite', 'sizes': {'1000': {'bets': 1000, 'actions': {'refund': result}}}}
+        slower = {'database': 'sqlite', 'sizes': {'1000': {'bets': 1000, 'actions': {
+            'refund': dict(result, elapsed=1.2, queries=11, peak_kb=200.0)}}}}
+        self.assertEqual(compare(baseline, baseline), [])
+        regressions = compare(slower, baseline, threshold=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('peak_kb', regressions[0])
+        self.assertIn('11 queries', regressions[1])
+        self.assertEqual(len(compare(slower, baseline, threshold=0.1)), 3)
+
+
+class RecordingBroker(InProcessBroker):
+    """Broker that always listens and keeps what was published."""
+    active = True
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def publish(self, message: dict) -> int:
+        self.messages.append(message)
+        return super().publish(message)
+
+
+class LiveMarketTestCase(TestCase):
+    def setUp(self) -> None:
+        get_broker.cache_clear()
+        self.addCleanup(get_broker.cache_clear)
+
+    @override_settings(MARKET_BROKER='betting.tests.RecordingBroker')
+    def test_deltas_published_on_commit(self):
+        broker = get_broker()
+        match = Match.objects.create(team_a_name='A', team_b_name='B', game_name='football')
+        option = QuestionOption.objects.create(option='A wins', rate=1.5)
+        self.assertEqual(broker.messages, [], 'Published before commit')
+        with self.captureOnCommitCallbacks(execute=True):
+            question = BetQuestion.objects.create(match=match, question='Winner?')
+            question.options.add(option)
+            option.rate = 1.8
+            option.save()
+            option.bet_count = 5
+            option.save(update_fields=['bet_count'])
+            lock_match(match.id)
+            question.winner = option
+            question.save(update_fields=['winner'])
+        deltas = [(message['model'], message['id'], message['changes']) for message in broker.messages]
+        self.assertEqual(deltas, [
+            ('question', question.id, {'status': question.status, 'winner': None}),
+            ('question', question.id, {'added_options': [option.id]}),
+            ('option', option.id, {'rate': 1.8, 'hidden': False, 'option': 'A wins'}),
+            ('match', match.id, {'status': STATUS_LOCKED}),
+            ('question', question.id, {'winner': option.id}),
+        ])
+        self.assertTrue(broker.messages[0]['created'])
+        self.assertEqual(broker.messages[0]['match'], match.id)
+
+    def test_in_process_broker_idle(self):
+        broker = get_broker()
+        self.assertFalse(broker.active)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Match.objects.create(team_a_name='A', team_b_name='B', game_name='football')
+        self.assertEqual(callbacks, [], 'Nothing is queued without subscribers')
+        self.assertEqual(broker.last_seq, 0)
+
+    def test_websocket(self):
+        broker = get_broker()
+
+        async def session():
+            communicator = ApplicationCommunicator(market_router(None), {'type': 'websocket', 'path': WEBSOCKET_PATH})
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual((await communicator.receive_output(1))['type'], 'websocket.accept')
+            hello = json.loads((await communicator.receive_output(1))['text'])
+            self.assertEqual(hello, {'type': 'hello', 'seq': 0})
+            self.assertTrue(broker.active)
+            broker.publish({'type': 'delta', 'model': 'match', 'id': 1, 'changes': {'status': STATUS_LOCKED}})
+            delta = json.loads((await communicator.receive_output(1))['text'])
+            self.assertEqual((delta['seq'], delta['changes']), (1, {'status': STATUS_LOCKED}))
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(1)
+
+        async_to_sync(session)()
+        self.assertFalse(broker.active)
+
+    def test_event_stream(self):
+        broker = get_broker()
+
+        async def session():
+            communicator = ApplicationCommunicator(market_router(None), {
+                'type': 'http', 'method': 'GET', 'path': EVENTS_PATH, 'headers': []})
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output(1)
+            self.assertEqual(start['status'], 200)
+            self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+            self.assertEqual((await communicator.receive_output(1))['body'], b'data: {"type": "hello", "seq": 0}\n\n')
+            broker.publish({'type': 'delta', 'model': 'option', 'id': 2, 'changes': {'rate': 2.0}})
+            body = (await communicator.receive_output(1))['body']
+            self.assertTrue(body.startswith(b'data: {"type": "delta"'), body)
+            self.assertEqual((await communicator.receive_output(1))['body'], b': ping\n\n')
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(1)
+
+        with patch('betting.streams.HEARTBEAT', 0.05):
+            async_to_sync(session)()
+        self.assertFalse(broker.active)
+
+    @override_settings(CORS_ALLOW_ALL_ORIGINS=False, CORS_ALLOWED_ORIGINS=['https://bet65.org'])
+    def test_event_stream_cors(self):
+        async def start(origin):
+            communicator = ApplicationCommunicator(market_router(None), {
+                'type': 'http', 'method': 'GET', 'path': EVENTS_PATH, 'headers': [(b'origin', origin)]})
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            headers = (await communicator.receive_output(1))['headers']
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(1)
+            return headers
+
+        headers = async_to_sync(start)(b'https://bet65.org')
+        self.assertIn((b'access-control-allow-origin', b'https://bet65.org'), headers)
+        headers = async_to_sync(start)(b'https://other.org')
+        self.assertNotIn(b'access-control-allow-origin', [name for name, value in headers])
+
+    @override_settings(MARKET_BROKER='betting.live.DatabaseBroker')
+    def test_database_broker(self):
+        MarketEvent.objects.create(message='{}')
+        broker = get_broker()
+        broker.start()
+        self.assertTrue(broker.active)
+        with self.captureOnCommitCallbacks(execute=True):
+            match = Match.objects.create(team_a_name='A', team_b_name='B', game_name='football')
+            lock_match(match.id)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        subscription = Subscription(loop, 10)
+        broker.subscriptions.add(subscription)
+        self.assertEqual(broker.poll(), 2)
+        self.assertEqual(broker.poll(), 0)
+        loop.run_until_complete(asyncio.sleep(0))
+        deltas = [json.loads(subscription.queue.get_nowait()) for _ in range(subscription.queue.qsize())]
+        events = list(MarketEvent.objects.values_list('id', flat=True))
+        self.assertEqual([(delta['seq'], delta['changes'].get('status')) for delta in deltas],
+                         [(events[1], STATUS_HIDDEN), (events[2], STATUS_LOCKED)])
+        self.assertEqual(broker.last_seq, events[2])
+        MarketEvent.objects.filter(pk=events[0]).update(created_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(broker.prune(), 1)
+
+    @override_settings(MARKET_BROKER='betting.live.DatabaseBroker')
+    def test_database_broker_rereads_gaps(self):
+        broker = get_broker()
+        broker.start()
+        first, late, last = (broker.publish({'type': 'delta', 'id': i}) for i in range(3))
+        # Not committed yet when the poll runs
+        message = MarketEvent.objects.get(pk=late).message
+        MarketEvent.objects.filter(pk=late).delete()
+        self.assertEqual(broker.poll(), 2)
+        self.assertEqual((broker.last_seq, list(broker.gaps)), (last, [late]))
+        MarketEvent.objects.create(pk=late, message=message)
+        self.assertEqual(broker.poll(), 1)
+        self.assertEqual((broker.last_seq, broker.gaps), (last, {}))
+
+    @override_settings(MARKET_BROKER='betting.live.DatabaseBroker')
+    def test_database_broker_prunes_on_publish(self):
+        stale = MarketEvent.objects.create(message='{}')
+        MarketEvent.objects.filter(pk=stale.pk).update(created_at=timezone.now() - timedelta(hours=2))
+        broker = get_broker()
+        broker.publish({'type': 'delta'})
+        self.assertFalse(MarketEvent.objects.filter(pk=stale.pk).exists())
+        MarketEvent.objects.create(message='{}')
+        with self.assertNumQueries(1):
+            broker.publish({'type': 'delta'})
+
+    def test_router(self):
+        async def django_application(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+
+        async def request(scope):
+            communicator = ApplicationCommunicator(market_router(django_application), scope)
+            await communicator.send_input({'type': 'websocket.connect'})
+            return await communicator.receive_output(1)
+
+        response = async_to_sync(request)({'type': 'http', 'method': 'GET', 'path': '/api/match/'})
+        self.assertEqual(response['status'], 204)
+        self.assertEqual(async_to_sync(request)({'type': 'websocket', 'path': '/ws/other/'})['type'], 'websocket.close')
+
+    def test_router_lifespan(self):
+        async def lifespan():
+            communicator = ApplicationCommunicator(market_router(None), {'type': 'lifespan'})
+            await communicator.send_input({'type': 'lifespan.startup'})
+            started = await communicator.receive_output(1)
+            await communicator.send_input({'type': 'lifespan.shutdown'})
+            return started, await communicator.receive_output(1)
+
+        self.assertEqual(async_to_sync(lifespan)(), ({'type': 'lifespan.startup.complete'},
+                                                     {'type': 'lifespan.shutdown.complete'}))
+
+    def test_slow_client_resyncs(self):
+        async def overflow():
+            subscription = Subscription(asyncio.get_running_loop(), 2)
+            for seq in range(3):
+                subscription.deliver(str(seq))
+            await asyncio.sleep(0)
+            return [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+
+        self.assertEqual(async_to_sync(overflow)(), ['{"type": "resync"}'])
@@ -1,17 +1,21 @@
 from datetime import datetime, timedelta
 
-from django.db.models import Sum, QuerySet
-from django.db.models.signals import post_save, post_delete, pre_delete
+from django.db import transaction
+from django.db.models import Count, OuterRef, Prefetch, Subquery, Sum, QuerySet
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.http import HttpResponse
 from django.utils import timezone
 
-from log.views import data_error_log
+from users.models import Club, User
 from users.views import total_user_balance, total_club_balance, notify_user
-from .actions import accept_deposit, create_deposit, cancel_withdraw, cancel_deposit, cancel_transfer, refund_bet
-from .choices import SOURCE_REFER, SOURCE_COMMISSION, TYPE_WITHDRAW, METHOD_TRANSFER, METHOD_CLUB
-from .models import Bet, BetQuestion, Deposit, Withdraw, Transfer, Match, \
-    ConfigModel, default_configs
+from .actions import cancel_withdraw, cancel_deposit, cancel_transfer, refund_bet, release_option, forget_option_bet
+from .choices import TYPE_WITHDRAW, METHOD_TRANSFER, METHOD_CLUB, STATUS_REFUNDED
+from .config import config_value, invalidate_config
+from .live import publish_deleted, publish_options_changed, publish_saved
+from .models import Bet, BetQuestion, CommissionAccrual, Deposit, Withdraw, Transfer, Match, \
+    ConfigModel, QuestionOption, default_configs
 
 
 def initialize_configuration(request):
@@ -21,19 +25,43 @@ def initialize_configuration(request):
 
 
 def get_config_from_model(name: str, default=False) -> str:
-    obj = ConfigModel.objects.filter(name=name)
-    if obj:
-        return str(obj[0].value)
-    else:
-        ConfigModel.objects.create(name=name, value=str(default or default_configs[name]))
-        return str(default or default_configs[name])
+    return config_value(name, default)
 
 
 def set_config_to_model(name: str, value: str) -> None:
-    if ConfigModel.objects.filter(name=name).exists():
-        ConfigModel.objects.filter(name=name).update(value=value)
-    else:
-        ConfigModel.objects.create(name=name, value=value)
+    ConfigModel.objects.update_or_create(name=name, defaults={'value': value})
+
+
+@receiver(post_save, sender=ConfigModel)
+@receiver(post_delete, sender=ConfigModel)
+def post_change_config(*args, **kwargs):
+    invalidate_config()
+    transaction.on_commit(invalidate_config)
+
+
+@receiver(post_save, sender=Match)
+@receiver(post_save, sender=BetQuestion)
+@receiver(post_save, sender=QuestionOption)
+def publish_market_change(instance, created: bool, update_fields=None, *args, **kwargs):
+    publish_saved(instance, created, update_fields)
+
+
+@receiver(post_delete, sender=Match)
+@receiver(post_delete, sender=BetQuestion)
+@receiver(post_delete, sender=QuestionOption)
+def publish_market_delete(instance, *args, **kwargs):
+    publish_deleted(instance)
+
+
+@receiver(m2m_changed, sender=BetQuestion.options.through)
+def publish_question_options(instance, action: str, reverse: bool, pk_set, *args, **kwargs):
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    change = 'added' if action == 'post_add' else 'removed'
+    # Reverse when options were given questions, instance is then an option
+    changed = [(pk, {instance.pk}) for pk in pk_set] if reverse else [(instance.pk, pk_set)]
+    for question_id, options in changed:
+        publish_options_changed(question_id, **{change: options})
 
 
 @receiver(pre_delete, sender=Deposit)
@@ -44,12 +72,9 @@ def post_delete_deposit(instance: Deposit, *args, **kwargs):
 @receiver(post_save, sender=Withdraw)
 def post_save_withdraw(instance: Withdraw, created: bool, *args, **kwargs):
     if created:
-        # Reduce balance of user
-        instance.user.balance -= instance.amount
-        instance.user.save()
-        # Update user balance during withdraw
-        instance.balance = instance.user.balance
-        instance.save()
+        # Reduce balance of user and keep balance after withdraw
+        instance.balance = instance.user.debit(instance.amount, instance.balance_floor)
+        instance.save(update_fields=['balance'])
 
 
 @receiver(post_delete, sender=Withdraw)
@@ -60,16 +85,14 @@ def post_delete_withdraw(instance: Withdraw, *args, **kwargs):
 @receiver(post_save, sender=Transfer)
 def post_save_transfer(instance: Transfer, created: bool, *args, **kwargs):
     if created:
+        if instance.sender:
+            instance.sender.debit(instance.amount, instance.balance_floor)
+        elif instance.club:
+            instance.club.debit(instance.amount, instance.balance_floor)
         notify_user(instance.recipient, f'You will receive {instance.amount} tk from user/club '
                                         f'##{(instance.sender and instance.sender.username) or instance.club.name}## '
                                         f'with transfer id '
                                         f'##{instance.id}## as soon as admin confirms')
-        if instance.sender:
-            instance.sender.balance -= instance.amount
-            instance.sender.save()
-        elif instance.club:
-            instance.club.balance -= instance.amount
-            instance.club.save()
         if instance.sender is None and instance.club is None:
             instance.delete()
 
@@ -79,58 +102,11 @@ def post_delete_transfer(instance: Transfer, *args, **kwargs):
     cancel_transfer(instance.id)
 
 
-def pay_refer(bet: Bet) -> float:
-    refer_commission = float(get_config_from_model('refer_commission')) / 100
-    if bet.user.referred_by:
-        commission = bet.amount * refer_commission
-        bet.user.referred_by.earn_from_refer += commission
-        bet.user.referred_by.save()
-        deposit = create_deposit(bet.user.referred_by_id, commission, SOURCE_REFER, SOURCE_REFER)
-        accept_deposit(deposit.id)
-        notify_user(bet.user.referred_by, f"You earned {commission} from user "
-                                          f"{bet.user.username}. Keep referring and "
-                                          f"earn {refer_commission * 100}% commission from each bet")
-        return commission
-    return 0
-
-
-def pay_commission(bet: Bet) -> float:
-    if bet.user.user_club:
-        club = bet.user.user_club
-        commission = bet.amount * club.club_commission / 100
-        deposit = create_deposit(user_id=club.id, amount=commission,
-                                 source=SOURCE_COMMISSION, method=SOURCE_COMMISSION, club=True)
-        accept_deposit(deposit.id, message=f"{bet.user.user_club.name} has "
-                                           f"earned {commission} from "
-                                           f"{bet.user.username}")
-        bet.user.userclubinfo.total_commission += commission
-        bet.user.userclubinfo.save()
-        return commission
-    data_error_log(description=f'User {bet.user_id} does not have valid club')
-    return 0
-
-
-@receiver(post_save, sender=Bet)
-def post_save_bet(instance: Bet, created, *args, **kwargs):
-    if created:
-        # Reduce balance on bet
-        instance.user.balance -= instance.amount
-        instance.user.save()
-        # Pay refer and club
-        refer_paid = pay_refer(instance)
-        club_paid = pay_commission(instance)
-        # Update bet instance information
-        win_rate = instance.choice.rate
-        instance.win_rate = win_rate
-        instance.win_amount = (instance.amount - club_paid - refer_paid) * win_rate
-        instance.user_balance = instance.user.balance
-        instance.save()
-        instance.user.userclubinfo.total_bet += instance.amount
-        instance.user.userclubinfo.save()
-
-
 @receiver(post_delete, sender=Bet)
 def post_delete_bet(instance: Bet, *args, **kwargs):
+    if instance.status != STATUS_REFUNDED:
+        release_option(instance)
+    forget_option_bet(instance)
     refund_bet(instance.id)
 
 
@@ -176,6 +152,15 @@ def active_bet_scopes_count() -> int:
     return BetQuestion.objects.filter(processed_internally=False).count()
 
 
+def questions_with_details() -> QuerySet:
+    return BetQuestion.objects.select_related('match').prefetch_related('options')
+
+
+def matches_with_details() -> QuerySet:
+    """Matches with questions and options prefetched, a constant number of queries per page."""
+    return Match.objects.prefetch_related(Prefetch('betquestion_set', queryset=questions_with_details()))
+
+
 def test_post(request):
     if request.method == 'POST':
         print(request.POST)
@@ -190,6 +175,20 @@ def get_last_bet(user=None):
     return Bet.objects.order_by('created_at').last()
 
 
+def users_with_last_bet() -> QuerySet:
+    """Users joined with their club info and annotated with last_bet_at, the time of their latest bet."""
+    last_bet = Bet.objects.filter(user=OuterRef('pk')).order_by('-created_at').values('created_at')[:1]
+    return User.objects.select_related('userclubinfo').annotate(last_bet_at=Subquery(last_bet))
+
+
+def clubs_with_totals() -> QuerySet:
+    """Clubs annotated with member_count, member_balance and unpaid_commission for list views."""
+    pending = (CommissionAccrual.objects.filter(club=OuterRef('pk'), deposit__isnull=True).order_by()
+               .values('club').annotate(total=Sum('amount')).values('total'))
+    return Club.objects.annotate(member_count=Count('user'), member_balance=Coalesce(Sum('user__balance'), 0.0),
+                                 unpaid_commission=Coalesce(Subquery(pending), 0.0))
+
+
 def total_bet(user=None):
     if user:
         return sum_aggregate(Bet.objects.order_by('created_at').filter(user=user))
@@ -7,7 +7,7 @@ from django.utils.crypto import get_random_string
 from api.serializers import jwt_from_user
 from betting.choices import DEPOSIT_CHOICES, A_DEPOSIT_CANCEL, A_DEPOSIT_ACCEPT, A_WITHDRAW_ACCEPT, A_WITHDRAW_CANCEL, A_TRANSFER_ACCEPT, A_TRANSFER_CANCEL, GAME_CHOICES, MATCH_STATUS_CHOICES
 from betting.models import Match
-from users.models import Club, User
+from users.models import Club, User, recount_club_totals
 
 
 def add_user(how_many, base_url='http://127.0.0.1:8000'):
@@ -29,6 +29,7 @@ def add_user(how_many, base_url='http://127.0.0.1:8000'):
         user_id = response.json()['id']
         User.objects.filter(pk=user_id).update(balance=randint(1, 5000))
         print(response.status_code)
+    recount_club_totals(Club.objects.all())
 
 
 def add_club(how_many, base_url='http://127.0.0.1:8000'):
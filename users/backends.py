@@ -1,5 +1,9 @@
+import hashlib
 import json
-from functools import wraps
+import threading
+from collections import OrderedDict
+from functools import wraps, lru_cache
+from typing import Optional
 from urllib.parse import urlparse
 
 from django.conf import settings
@@ -10,15 +14,63 @@ from jwcrypto import jwt, jws, jwk
 from rest_framework.authentication import TokenAuthentication
 
 from bet.settings import JWK_KEY
+from users.cache import get_cached_user, set_cached_user, get_cached_club, set_cached_club
 from users.models import Club
 
 UserModel = get_user_model()
 
 
+@lru_cache(maxsize=None)
 def jwk_key():
     return jwk.JWK(**json.loads(JWK_KEY))
 
 
+class VerifiedTokenCache:
+    """
+    Bounded LRU of token digest to claims of tokens whose signature was already
+    verified, shared by all threads of the process.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: bytes) -> Optional[dict]:
+        with self._lock:
+            claims = self._data.get(digest)
+            if claims is not None:
+                self._data.move_to_end(digest)
+            return claims
+
+    def set(self, digest: bytes, claims: dict) -> None:
+        with self._lock:
+            self._data[digest] = claims
+            self._data.move_to_end(digest)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+verified_tokens = VerifiedTokenCache(getattr(settings, 'JWT_CACHE_SIZE', 4096))
+
+
+def verified_claims(jwt_str: str) -> Optional[dict]:
+    """Claims of a correctly signed token, the signature is checked once per process."""
+    digest = hashlib.sha256(jwt_str.encode()).digest()
+    claims = verified_tokens.get(digest)
+    if claims is None:
+        try:
+            claims = json.loads(jwt.JWT(key=jwk_key(), jwt=jwt_str).claims)
+        except (jws.InvalidJWSSignature, jws.InvalidJWSObject, ValueError):
+            return None
+        verified_tokens.set(digest, claims)
+    return claims
+
+
 def jwt_writer(**kwargs):
     key = jwk_key()
     token = jwt.JWT(header={'alg': 'HS256'}, claims=kwargs)
@@ -29,37 +81,50 @@ def jwt_writer(**kwargs):
 def validate_jwt(jwt_str):
     if not jwt_str:
         return None
+    data = verified_claims(jwt_str)
+    if data is None:
+        return None
+    login_key = data.get("login_key", "none")
+    user = get_cached_user(data.get('id'))
+    if user and (user.username, user.email, user.login_key) == (data.get('username'), data.get('email'), login_key):
+        return user
     try:
-        st = jwt.JWT(key=jwk_key(), jwt=jwt_str)
-        data = json.loads(st.claims)
-        login_key = data.get("login_key", "none")
-        try:
-            return UserModel.objects.get(username=data.get('username'), email=data.get('email'),
-                                         login_key=login_key)
-        except UserModel.DoesNotExist:
-            return None
-    except (jws.InvalidJWSSignature, jws.InvalidJWSObject, ValueError):
+        user = UserModel.objects.get(username=data.get('username'), email=data.get('email'), login_key=login_key)
+    except UserModel.DoesNotExist:
         return None
+    set_cached_user(user)
+    return user
 
 
-def get_current_club(request):
-    if request.headers.get('club-token', False):
-        jwt_str = request.headers['club-token']
-        if not jwt_str:
-            return None
+def validate_club_jwt(jwt_str):
+    if not jwt_str:
+        return None
+    data = verified_claims(jwt_str)
+    if data is None:
+        return None
+    club = get_cached_club(data.get('id'))
+    if club is None:
         try:
-            st = jwt.JWT(key=jwk_key(), jwt=jwt_str)
-            data = json.loads(st.claims)
-            password = data.get("key", "none")
-            club_id = data.get("id", "none")
-            clubs = Club.objects.filter(id=club_id)
-            if clubs:
-                club = clubs.first()
-                if club.password == password:
-                    return club
+            club = Club.objects.filter(id=data.get("id", "none")).first()
+        except (ValueError, TypeError):
             return None
-        except (jws.InvalidJWSSignature, jws.InvalidJWSObject, ValueError):
+        if club is None:
             return None
+        set_cached_club(club)
+    if club.password == data.get("key", "none"):
+        return club
+    return None
+
+
+def get_current_club(request):
+    """
+    Club of the club-token header, resolved once per request and kept as
+    request.club. Accepts a Django or a rest framework request.
+    """
+    request = getattr(request, '_request', request)
+    if not hasattr(request, 'club'):
+        request.club = validate_club_jwt(request.headers.get('club-token'))
+    return request.club
 
 
 def is_valid_jwt_header(request):
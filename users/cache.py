@@ -0,0 +1,66 @@
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+USER_CACHE_KEY = 'auth-user:{}'
+CLUB_CACHE_KEY = 'auth-club:{}'
+
+# Backends on which reading a cached row costs a query, as much as the indexed lookup it would save
+QUERYING_CACHES = ('django.core.cache.backends.db.DatabaseCache',)
+
+
+def auth_cache_enabled() -> bool:
+    """
+    Authenticated users and clubs are cached for AUTH_USER_CACHE_TIMEOUT
+    seconds, unless the default cache is stored in the database.
+    """
+    return (getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 300) > 0
+            and settings.CACHES['default']['BACKEND'] not in QUERYING_CACHES)
+
+
+def _get(key: str, pk):
+    if pk is None:
+        return None
+    return cache.get(key.format(pk))
+
+
+def _set(key: str, instance) -> None:
+    cache.set(key.format(instance.pk), instance, getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 300))
+
+
+def _invalidate(key: str, pks) -> None:
+    """Drop cached rows once the transaction commits, other workers read the old rows until then."""
+    keys = [key.format(pk) for pk in pks if pk is not None]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def get_cached_user(pk):
+    return _get(USER_CACHE_KEY, pk) if auth_cache_enabled() else None
+
+
+def set_cached_user(user) -> None:
+    if auth_cache_enabled():
+        _set(USER_CACHE_KEY, user)
+
+
+def invalidate_users(*pks: Optional[int]) -> None:
+    if auth_cache_enabled():
+        _invalidate(USER_CACHE_KEY, pks)
+
+
+def get_cached_club(pk):
+    return _get(CLUB_CACHE_KEY, pk) if auth_cache_enabled() else None
+
+
+def set_cached_club(club) -> None:
+    if auth_cache_enabled():
+        _set(CLUB_CACHE_KEY, club)
+
+
+def invalidate_clubs(*pks: Optional[int]) -> None:
+    if auth_cache_enabled():
+        _invalidate(CLUB_CACHE_KEY, pks)
+
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Backends keeping entries in the memory of each process
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Configuration versions, authenticated users and clubs are dropped from the
+    cache when they change, so every worker process has to share the cache for
+    a config change, revoked login key, permission or club password to take
+    effect everywhere.
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES:
+        return [Error(f'The default cache {backend} is local to each process.',
+                      hint='Set CACHE_BACKEND to a cache shared by the workers, such as Memcached or the database.',
+                      id='users.E001')]
+    return []
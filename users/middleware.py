@@ -0,0 +1,12 @@
+from users.backends import get_current_club
+
+
+class CurrentClubMiddleware:
+    """Set request.club to the club authenticated by the club-token header, or None."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        get_current_club(request)
+        return self.get_response(request)
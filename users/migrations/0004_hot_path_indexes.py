@@ -0,0 +1,21 @@
+# Generated by Django 3.2.7 on 2026-10-18 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_alter_user_options'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'created_at'], name='notification_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['user_club', 'balance'], name='user_club_balance_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.7 on 2026-10-19 02:35
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_totals(apps, schema_editor):
+    Club = apps.get_model('users', 'Club')
+    for club in Club.objects.annotate(members=Count('user'), amount=Sum('user__balance')).filter(members__gt=0):
+        Club.objects.filter(pk=club.pk).update(total_user=club.members, total_user_balance=club.amount or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='club',
+            name='total_user',
+            field=models.IntegerField(default=0, help_text='Member count, kept by change_club_totals'),
+        ),
+        migrations.AddField(
+            model_name='club',
+            name='total_user_balance',
+            field=models.FloatField(default=0, help_text='Member balance sum, kept by change_club_totals'),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
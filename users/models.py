@@ -1,14 +1,60 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, FloatField, IntegerField, OuterRef, QuerySet, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 
+from .cache import invalidate_users, invalidate_clubs
+
 
 def login_key():
     return get_random_string(10)
 
 
-class Club(models.Model):
+class InsufficientBalance(Exception):
+    pass
+
+
+class BalanceMixin:
+    """
+    Balance changes done by a single conditional UPDATE, so concurrent debits
+    can not overdraw the account and concurrent credits are never overwritten.
+    """
+
+    def _change_balance(self, amount, floor=None) -> float:
+        queryset = type(self)._default_manager.filter(pk=self.pk)
+        with transaction.atomic():
+            target = queryset if floor is None else queryset.filter(balance__gte=floor - amount)
+            if not target.update(balance=F('balance') + amount):
+                raise InsufficientBalance(f'{self} can not pay {-amount} keeping balance {floor}')
+            self.balance = queryset.values_list('balance', flat=True).get()
+            self.balance_changed(amount)
+            self.invalidate_cache()
+        return self.balance
+
+    def balance_changed(self, amount) -> None:
+        """Update rows derived from the balance, in the transaction that changed it."""
+
+    def invalidate_cache(self) -> None:
+        """Drop copies of this row cached by the authentication backends."""
+
+    def credit(self, amount) -> float:
+        """Add amount to balance and return the new balance."""
+        return self._change_balance(amount)
+
+    def debit(self, amount, floor=None) -> float:
+        """
+        Subtract amount from balance if it stays at or above floor (unchecked when
+        floor is None) and return the new balance, else raise InsufficientBalance.
+        """
+        return self._change_balance(-amount, floor)
+
+
+CLUB_TOTALS = ('total_user', 'total_user_balance')
+
+
+class Club(BalanceMixin, models.Model):
     admin = models.OneToOneField('User', on_delete=models.SET_NULL,
                                  null=True, blank=True, help_text="Club admin id")
     balance = models.FloatField(default=0)
@@ -16,6 +62,8 @@ class Club(models.Model):
     name = models.CharField(max_length=255)
     password = models.CharField(max_length=255)
     username = models.CharField(max_length=255, unique=True)
+    total_user = models.IntegerField(default=0, help_text="Member count, kept by change_club_totals")
+    total_user_balance = models.FloatField(default=0, help_text="Member balance sum, kept by change_club_totals")
 
     class Meta:
         ordering = ('-balance', )
@@ -23,8 +71,18 @@ class Club(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # A loaded copy of the member counters is stale as soon as a member's balance changes
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in CLUB_TOTALS]
+        super().save(*args, **kwargs)
+
+    def invalidate_cache(self) -> None:
+        invalidate_clubs(self.pk)
 
-class User(AbstractUser):
+
+class User(BalanceMixin, AbstractUser):
     balance = models.FloatField(default=0)
     earn_from_refer = models.FloatField(default=0)
     email = models.EmailField('Email address', unique=True)
@@ -37,6 +95,13 @@ class User(AbstractUser):
 
     class Meta:
         ordering = ('balance', )
+        indexes = [models.Index(fields=['user_club', 'balance'], name='user_club_balance_idx')]
+
+    def invalidate_cache(self) -> None:
+        invalidate_users(self.pk)
+
+    def balance_changed(self, amount) -> None:
+        change_club_totals(Club.objects.filter(user=self.pk), balance=amount)
 
     def is_club_admin(self):
         try:
@@ -50,6 +115,27 @@ class User(AbstractUser):
         return self.username
 
 
+def change_club_totals(clubs: QuerySet, users=0, balance=0.0) -> int:
+    """
+    Add a membership and balance change (values or expressions) to the member
+    counters of `clubs` with one UPDATE, in the transaction that changes the members.
+    """
+    changes = {}
+    if users:
+        changes['total_user'] = F('total_user') + users
+    if balance:
+        changes['total_user_balance'] = F('total_user_balance') + balance
+    return clubs.update(**changes) if changes else 0
+
+
+def recount_club_totals(clubs: QuerySet) -> int:
+    """Count the member counters of `clubs` again, after bulk writes that skip change_club_totals."""
+    members = User.objects.filter(user_club=OuterRef('pk')).order_by().values('user_club')
+    count = Subquery(members.annotate(count=Count('id')).values('count'), output_field=IntegerField())
+    balance = Subquery(members.annotate(total=Sum('balance')).values('total'), output_field=FloatField())
+    return clubs.update(total_user=Coalesce(count, 0), total_user_balance=Coalesce(balance, 0.0))
+
+
 class UserClubInfo(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     club = models.ForeignKey(Club, on_delete=models.SET_NULL, null=True, blank=True)
@@ -67,3 +153,4 @@ class Notification(models.Model):
 
     class Meta:
         ordering = ('-created_at',)
+        indexes = [models.Index(fields=['user', 'created_at'], name='notification_user_created_idx')]
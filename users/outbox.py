@@ -0,0 +1,133 @@
+import atexit
+import logging
+import queue
+import threading
+import weakref
+from typing import List
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, transaction
+
+from .models import Notification
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+_local = threading.local()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+class _Batch:
+    """
+    Notifications queued in one transaction or savepoint, written with one
+    bulk_create by a single on_commit callback. Only the commit hooks of the
+    connection hold a batch, so it is gone as soon as its savepoint or
+    transaction rolls back.
+    """
+
+    def __init__(self, using: str):
+        self.using = using
+        self.notifications = []
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        write(self.notifications, self.using)
+
+
+class OutboxWorker(threading.Thread):
+    """Daemon thread writing committed notifications, several batches per insert."""
+
+    def __init__(self):
+        super().__init__(name='notification-outbox', daemon=True)
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            notifications, using = self.queue.get()
+            done = 1
+            try:
+                while True:
+                    more, more_using = self.queue.get_nowait()
+                    done += 1
+                    if more_using != using:
+                        self._write(notifications, using)
+                        notifications, using = [], more_using
+                    notifications += more
+            except queue.Empty:
+                pass
+            self._write(notifications, using)
+            for _ in range(done):
+                self.queue.task_done()
+
+    @staticmethod
+    def _write(notifications: List[Notification], using: str):
+        try:
+            Notification.objects.using(using).bulk_create(notifications, batch_size=BATCH_SIZE)
+        except Exception:
+            logger.exception('Could not write %s notifications', len(notifications))
+        finally:
+            close_old_connections()
+
+
+def get_worker() -> OutboxWorker:
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = OutboxWorker()
+            _worker.start()
+    return _worker
+
+
+def drain() -> None:
+    """Block until the background worker wrote everything handed to it."""
+    if _worker is not None and _worker.is_alive():
+        _worker.queue.join()
+
+
+atexit.register(drain)
+
+
+def write(notifications: List[Notification], using=DEFAULT_DB_ALIAS) -> None:
+    """
+    Insert notifications with bulk_create, in the background worker thread when
+    NOTIFICATION_OUTBOX_WORKER is enabled.
+    """
+    if not notifications:
+        return
+    if getattr(settings, 'NOTIFICATION_OUTBOX_WORKER', False):
+        get_worker().queue.put((notifications, using))
+    else:
+        Notification.objects.using(using).bulk_create(notifications, batch_size=BATCH_SIZE)
+
+
+def _current_batch(using: str) -> _Batch:
+    connection = transaction.get_connection(using)
+    # Keyed by the savepoints on_commit files the callback under, a rolled back savepoint never comes back
+    key = (using, tuple(connection.savepoint_ids))
+    batches = _local.__dict__.setdefault('batches', weakref.WeakValueDictionary())
+    batch = batches.get(key)
+    if batch is None or batch.done:
+        batch = batches[key] = _Batch(using)
+        transaction.on_commit(batch, using)
+    return batch
+
+
+def queue_notifications(notifications: List[Notification], using=DEFAULT_DB_ALIAS) -> int:
+    """
+    Queue unsaved notifications. Inside a transaction they are added to its
+    batch, written once when it commits and discarded if it, or the savepoint
+    they were queued in, rolls back. Otherwise they are written now.
+    Returns number of notifications queued.
+    """
+    if not transaction.get_connection(using).in_atomic_block:
+        write(notifications, using)
+    elif notifications:
+        _current_batch(using).notifications.extend(notifications)
+    return len(notifications)
+
+
+def queue_notification(message: str, user=None, club=None, using=DEFAULT_DB_ALIAS) -> None:
+    queue_notifications([Notification(user=user, club=club, message=message)], using)
@@ -1,3 +1,279 @@
-from django.test import TestCase
+from unittest.mock import patch
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+
+from users.backends import jwt_writer, jwk_key, validate_jwt, verified_tokens, get_current_club
+from users.cache import auth_cache_enabled
+from users.checks import check_shared_cache
+from users.models import User, Club, InsufficientBalance, Notification, recount_club_totals
+from users.outbox import drain, queue_notifications, write
+from users.views import notify_user, notify_club
+
+
+class BalanceTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club = Club.objects.create(name='Club', username='club', password='pass', balance=100)
+        self.user = User.objects.create_user(username='user', email='user@gmail.com', phone='0170',
+                                             user_club=self.club, balance=100, password='1234')
+
+    def test_credit(self):
+        self.assertEqual(self.user.credit(50), 150)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 150)
+
+    def test_debit_keeps_floor(self):
+        self.assertEqual(self.user.debit(90, floor=10), 10)
+        with self.assertRaises(InsufficientBalance):
+            self.user.debit(1, floor=10)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 10)
+
+    def test_debit_without_floor(self):
+        self.assertEqual(self.club.debit(150), -50)
+        self.assertEqual(Club.objects.get(pk=self.club.pk).balance, -50)
+
+    def test_debit_does_not_overwrite_concurrent_credit(self):
+        stale = User.objects.get(pk=self.user.pk)
+        self.user.credit(100)
+        self.assertEqual(stale.debit(50, floor=10), 150)
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club = Club.objects.create(name='Club', username='club', password='pass')
+        self.user = User.objects.create_user(username='user', email='user@gmail.com', phone='0170',
+                                             user_club=self.club, password='1234')
+
+    def test_written_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            notify_user(self.user, 'first')
+            notify_club(self.club, 'second')
+            queue_notifications([Notification(user=self.user, message='third')])
+            self.assertFalse(Notification.objects.exists(), 'Should wait for commit')
+        self.assertEqual(len(callbacks), 1, 'Messages of a transaction share one batch')
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_batch_is_bulk_inserted(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for i in range(50):
+                notify_user(self.user, f'message {i}')
+        self.assertEqual(len(callbacks), 1)
+        with self.assertNumQueries(1):
+            callbacks[0]()
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 50)
+
+    def test_savepoint_rollback_drops_messages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_user(self.user, 'kept')
+            try:
+                with transaction.atomic():
+                    notify_user(self.user, 'dropped')
+                    raise InsufficientBalance
+            except InsufficientBalance:
+                pass
+            notify_user(self.user, 'also kept')
+        self.assertEqual(set(Notification.objects.values_list('message', flat=True)), {'kept', 'also kept'})
+
+
+@override_settings(NOTIFICATION_OUTBOX_WORKER=True)
+class OutboxWorkerTestCase(TransactionTestCase):
+    def test_worker_writes_notifications(self):
+        user = User.objects.create_user(username='user', email='user@gmail.com', phone='0170', password='1234')
+        write([Notification(user=user, message=f'message {i}') for i in range(10)])
+        drain()
+        self.assertEqual(Notification.objects.filter(user=user).count(), 10)
+
+    def test_rolled_back_transaction_drops_batch(self):
+        user = User.objects.create_user(username='user', email='user@gmail.com', phone='0170', password='1234')
+        try:
+            with transaction.atomic():
+                notify_user(user, 'dropped')
+                raise InsufficientBalance
+        except InsufficientBalance:
+            pass
+        with transaction.atomic():
+            notify_user(user, 'kept')
+        drain()
+        self.assertEqual(list(Notification.objects.values_list('message', flat=True)), ['kept'])
+
+
+class AuthCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        verified_tokens.clear()
+        self.user = User.objects.create_user(username='user', email='user@gmail.com', phone='0170', password='1234')
+        self.token = jwt_writer(id=self.user.id, username=self.user.username, email=self.user.email,
+                                login_key=self.user.login_key)
+
+    def test_jwk_key_cached(self):
+        self.assertIs(jwk_key(), jwk_key())
+
+    def test_user_cached(self):
+        self.assertEqual(validate_jwt(self.token), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(validate_jwt(self.token), self.user)
+
+    def test_invalid_token(self):
+        self.assertIsNone(validate_jwt(self.token[:-2]))
+        self.assertIsNone(validate_jwt('not a token'))
+
+    def test_login_key_change_invalidates(self):
+        validate_jwt(self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.login_key = 'changed'
+            self.user.save()
+        self.assertIsNone(validate_jwt(self.token))
+
+    def test_balance_change_invalidates(self):
+        validate_jwt(self.token)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.credit(50)
+        self.assertEqual(len(callbacks), 1, 'Invalidated once, on commit')
+        self.assertEqual(validate_jwt(self.token).balance, 50)
+
+    def test_not_cached_in_database_cache(self):
+        with override_settings(CACHES=SHARED_CACHES):
+            validate_jwt(self.token)
+            with self.assertNumQueries(1):
+                self.assertEqual(validate_jwt(self.token), self.user)
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.user.credit(50)
+            self.assertEqual(callbacks, [])
+
+    def test_cached_in_memcached(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+                                                   'LOCATION': '127.0.0.1:11211'}}):
+            self.assertTrue(auth_cache_enabled())
+
+
+SHARED_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'django_cache'}}
+
+
+class SharedAuthCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        verified_tokens.clear()
+        # The cache client of another worker process, only the storage is shared as with Memcached
+        self.other_worker = LocMemCache('', {})
+        self.user = User.objects.create_user(username='user', email='user@gmail.com', phone='0170', password='1234',
+                                             is_superuser=True)
+        self.token = jwt_writer(id=self.user.id, username=self.user.username, email=self.user.email,
+                                login_key=self.user.login_key)
+
+    def other_worker_saves(self, instance, **changes):
+        with patch('users.cache.cache', self.other_worker), self.captureOnCommitCallbacks(execute=True):
+            for name, value in changes.items():
+                setattr(instance, name, value)
+            instance.save()
+
+    def test_revoked_by_other_worker(self):
+        self.assertTrue(validate_jwt(self.token).is_superuser)
+        self.other_worker_saves(self.user, is_superuser=False)
+        self.assertFalse(validate_jwt(self.token).is_superuser)
+        self.other_worker_saves(self.user, login_key='changed')
+        self.assertIsNone(validate_jwt(self.token))
+
+    def test_club_password_changed_by_other_worker(self):
+        club = Club.objects.create(name='Club', username='club', password='pass')
+        request = RequestFactory().get('/', HTTP_CLUB_TOKEN=jwt_writer(id=club.id, key='pass'))
+        self.assertEqual(get_current_club(request), club)
+        self.other_worker_saves(club, password='changed')
+        self.assertIsNone(get_current_club(RequestFactory().get('/', HTTP_CLUB_TOKEN=request.headers['club-token'])))
+
+    def test_process_local_cache_rejected(self):
+        with override_settings(CACHES=SHARED_CACHES):
+            self.assertEqual(check_shared_cache(None), [])
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['users.E001'])
+
+
+class CurrentClubTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.club = Club.objects.create(name='Club', username='club', password='pass')
+        self.token = jwt_writer(id=self.club.id, key=self.club.password)
+
+    def request(self, token=None):
+        return RequestFactory().get('/', HTTP_CLUB_TOKEN=token or self.token)
+
+    def test_resolved_once_per_request(self):
+        request = self.request()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_current_club(request), self.club)
+            self.assertEqual(get_current_club(request), self.club)
+        self.assertEqual(request.club, self.club)
+
+    def test_cached_across_requests(self):
+        get_current_club(self.request())
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_club(self.request()), self.club)
+
+    def test_password_change(self):
+        get_current_club(self.request())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.club.password = 'changed'
+            self.club.save()
+        self.assertIsNone(get_current_club(self.request()))
+        self.assertEqual(get_current_club(self.request(jwt_writer(id=self.club.id, key='changed'))), self.club)
+
+    def test_without_token(self):
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_current_club(RequestFactory().get('/')))
+        self.assertIsNone(get_current_club(self.request(jwt_writer(id='none', key='pass'))))
+
+
+class ClubTotalsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.club = Club.objects.create(name='Club', username='club', password='pass')
+        self.user = User.objects.create_user(username='user', email='user@gmail.com', phone='0170',
+                                             user_club=self.club, balance=100, password='1234')
+
+    def totals(self, club=None):
+        return Club.objects.values_list('total_user', 'total_user_balance').get(pk=(club or self.club).pk)
+
+    def test_created_member(self):
+        self.assertEqual(self.totals(), (1, 100))
+
+    def test_balance_change(self):
+        with self.assertNumQueries(5):
+            self.user.credit(50)
+        self.user.debit(20)
+        self.assertEqual(self.totals(), (1, 130))
+
+    def test_rolled_back_balance_change(self):
+        with transaction.atomic():
+            self.user.credit(50)
+            transaction.set_rollback(True)
+        self.assertEqual(self.totals(), (1, 100))
+
+    def test_membership_change(self):
+        other = Club.objects.create(name='Other', username='other', password='pass')
+        User.objects.create_user(username='user2', email='user2@gmail.com', phone='0171',
+                                 user_club=self.club, balance=40, password='1234')
+        self.user.user_club = other
+        self.user.save(update_fields=['user_club'])
+        self.assertEqual(self.totals(), (1, 40))
+        self.assertEqual(self.totals(other), (1, 100))
+        self.user.delete()
+        self.assertEqual(self.totals(other), (0, 0))
+
+    def test_saved_balance(self):
+        self.user.balance = 500
+        self.user.save()
+        self.assertEqual(self.totals(), (1, 500))
+        self.user.balance = 0
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(self.totals(), (1, 500))
+
+    def test_club_save_keeps_totals(self):
+        club = Club.objects.get(pk=self.club.pk)
+        self.user.credit(50)
+        club.name = 'Renamed'
+        club.save()
+        self.assertEqual(self.totals(), (1, 150))
+
+    def test_recount(self):
+        User.objects.filter(pk=self.user.pk).update(balance=500)
+        self.assertEqual(self.totals(), (1, 100))
+        recount_club_totals(Club.objects.all())
+        self.assertEqual(self.totals(), (1, 500))
\ No newline at end of file
@@ -1,8 +1,10 @@
 from django.db.models import Sum
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 
-from .models import User, Club, Notification, UserClubInfo
+from .cache import invalidate_users, invalidate_clubs
+from .models import User, Club, UserClubInfo, change_club_totals
+from .outbox import queue_notification
 
 
 def sum_aggregate(queryset, field='amount'):
@@ -20,17 +22,70 @@ def total_club_balance() -> float:
 
 def notify_user(user: User, message, club=False):
     if club:
-        Notification.objects.create(club=user, message=message)
+        queue_notification(message, club=user)
     else:
-        Notification.objects.create(user=user, message=message)
+        queue_notification(message, user=user)
 
 
 def notify_club(club: Club, message):
-    Notification.objects.create(club=club, message=message)
+    queue_notification(message, club=club)
+
+
+def saves_club_totals(update_fields) -> bool:
+    return update_fields is None or bool({'balance', 'user_club'} & set(update_fields))
+
+
+def change_member_club(club_id, users=0, balance=0.0) -> None:
+    if club_id is not None:
+        change_club_totals(Club.objects.filter(pk=club_id), users, balance)
+
+
+@receiver(pre_save, sender=User)
+def remember_club_totals(instance: User, update_fields=None, *args, **kwargs):
+    if instance.pk and saves_club_totals(update_fields):
+        instance._saved_club = User.objects.filter(pk=instance.pk).values_list('user_club', 'balance').first()
 
 
 @receiver(post_save, sender=User)
-def create_user_club_info(instance: User, *args, **kwargs):
+def update_club_totals(instance: User, update_fields=None, *args, **kwargs):
+    """Move the member count and balance of a saved user between the counters of the old and new club."""
+    if not saves_club_totals(update_fields):
+        return
+    saved = vars(instance).pop('_saved_club', None)
+    old_club, old_balance = saved or (None, 0.0)
+    new_club = instance.user_club_id if update_fields is None or 'user_club' in update_fields else old_club
+    new_balance = instance.balance if update_fields is None or 'balance' in update_fields else old_balance
+    if not saved or old_club != new_club:
+        change_member_club(old_club, users=-1, balance=-old_balance)
+        change_member_club(new_club, users=1, balance=new_balance)
+    else:
+        change_member_club(new_club, balance=new_balance - old_balance)
+
+
+@receiver(pre_delete, sender=User)
+def remove_from_club_totals(instance: User, *args, **kwargs):
+    # Locks the user row before the club row, in the order credit() and debit() do
+    saved = User.objects.select_for_update().filter(pk=instance.pk).values_list('user_club', 'balance').first()
+    if saved:
+        change_member_club(saved[0], users=-1, balance=-saved[1])
+
+
+@receiver(post_save, sender=User)
+def create_user_club_info(instance: User, update_fields=None, *args, **kwargs):
+    if update_fields is not None and 'user_club' not in update_fields:
+        return
     if not UserClubInfo.objects.filter(user_id=instance.id, club_id=instance.user_club_id):
         UserClubInfo.objects.filter(user_id=instance.id).delete()
         UserClubInfo.objects.create(user_id=instance.id, club_id=instance.user_club_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(instance: User, *args, **kwargs):
+    invalidate_users(instance.pk)
+
+
+@receiver(post_save, sender=Club)
+@receiver(post_delete, sender=Club)
+def invalidate_cached_club(instance: Club, *args, **kwargs):
+    invalidate_clubs(instance.pk)